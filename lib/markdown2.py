@@ -116,20 +116,31 @@ __version__ = '.'.join(map(str, __version_info__))
 __author__ = "Trent Mick"
 
 import argparse
+import bisect
+import codecs
 import html
+import json
 import logging
+import os
 import re
 import sys
-from collections import defaultdict, OrderedDict
+import tempfile
+import threading
+from collections import defaultdict, deque, OrderedDict
 from abc import ABC, abstractmethod
 import functools
-from collections.abc import Iterable, Iterator
+from collections.abc import Iterable, Iterator, Mapping
 from hashlib import sha256
+from itertools import count
 from random import random
-from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, Type, TypedDict, Union, cast
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Literal, Optional, Tuple, Type, TypedDict, Union, cast
 from collections.abc import Collection
 from enum import IntEnum, auto
-from os import urandom
+from types import CodeType, FunctionType, MappingProxyType
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
 
 # ---- type defs
 _safe_mode = Literal['replace', 'escape']
@@ -145,14 +156,83 @@ log = logging.getLogger("markdown")
 DEFAULT_TAB_WIDTH = 4
 
 
-SECRET_SALT = urandom(16)
-# MD5 function was previously used for this; the "md5" prefix was kept for
-# backwards compatibility.
-def _hash_text(s: str) -> str:
-    return 'md5-' + sha256(SECRET_SALT + s.encode("utf-8")).hexdigest()[32:]
+# Text that later stages mustn't touch (escaped characters, code, URLs, raw HTML...) is
+# swapped out for a placeholder until the end of the conversion. A placeholder is a number
+# from a per-conversion counter, after a marker character that can't come from the input
+# (any in the input are swapped out too, and put back at the very end). The marker is an
+# obsolete letter rather than a private use character so that, like the text it hides, a
+# placeholder is a "word" to the regexes that run over it (eg: `\w` matches all of it).
+_PLACEHOLDER_CHAR = '\ua66e'
+_PLACEHOLDER_CHAR_REF = '&#xa66e;'
+_placeholder_re = re.compile(r'\ua66e\d+h')
+_CODE_PLACEHOLDER_CHAR = '<<code placeholder char>>'
+
+
+def _placeholder(n: int) -> str:
+    return f'{_PLACEHOLDER_CHAR}{n}h'
+
+
+def _restore_placeholders(text: str, lookup: Callable[[str], Optional[str]]) -> str:
+    '''
+    Swap the placeholders in some text for the text they stand in for, in a single scan.
+
+    Args:
+        text: the text to restore
+        lookup: gets the text that a placeholder stands in for. Placeholders that it
+            returns `None` for are left as they are
+
+    Returns:
+        The restored text, with any placeholders in the restored parts restored too
+    '''
+    if _PLACEHOLDER_CHAR not in text:
+        return text
+    restored: dict[str, str] = {}
+
+    def sub(match: re.Match[str]) -> str:
+        key = match.group()
+        value = restored.get(key)
+        if value is None:
+            # stops a placeholder that (somehow) stands in for itself from recursing forever
+            restored[key] = key
+            value = lookup(key)
+            if value is None:
+                value = key
+            elif _PLACEHOLDER_CHAR in value:
+                value = _placeholder_re.sub(sub, value)
+            restored[key] = value
+        return value
+
+    return _placeholder_re.sub(sub, text)
+
+
+# placeholders that are the same for every conversion
+_reserved_placeholders = {
+    text: _placeholder(n)
+    for n, text in enumerate([
+        *'\\`*_{}[]()>#+-.!', '"', "'", '<<footnote>>', _PLACEHOLDER_CHAR, _CODE_PLACEHOLDER_CHAR
+    ])
+}
+_reserved_placeholder_texts = {key: text for text, key in _reserved_placeholders.items()}
+_FIRST_PLACEHOLDER = len(_reserved_placeholders)
+_input_placeholder_char_re = re.compile(
+    '%s(?=\\d+h)' % re.escape(_reserved_placeholders[_PLACEHOLDER_CHAR])
+)
+
+
+def _restore_placeholder_chars(text: str) -> str:
+    '''
+    Put back the placeholder characters from the input. They're left as they are in code,
+    and elsewhere unless they're followed by something that would make them look like a
+    placeholder, in which case they come back as a character reference instead.
+    '''
+    if _PLACEHOLDER_CHAR not in text:
+        return text
+    text = _input_placeholder_char_re.sub(_PLACEHOLDER_CHAR_REF, text)
+    text = text.replace(_reserved_placeholders[_PLACEHOLDER_CHAR], _PLACEHOLDER_CHAR)
+    return text.replace(_reserved_placeholders[_CODE_PLACEHOLDER_CHAR], _PLACEHOLDER_CHAR)
 
-# Table of hash values for escaped characters:
-g_escape_table = {ch: _hash_text(ch)
+# Table of placeholders for escaped characters:
+g_escape_table = {ch: _reserved_placeholders[ch]
     for ch in '\\`*_{}[]()>#+-.!'}
 
 # Ampersand-encoding based entirely on Nat Irons's Amputator MT plugin:
@@ -179,16 +259,47 @@ def markdown_path(
     link_patterns: Optional[_link_patterns] = None,
     footnote_title: Optional[str] = None,
     footnote_return_symbol: Optional[str] = None,
-    use_file_vars: bool = False
+    use_file_vars: bool = False,
+    cache: Union[str, 'os.PathLike[str]', 'DiskCache', None] = None
 ) -> 'UnicodeWithAttrs':
-    with open(path, 'r', encoding=encoding) as f:
-        text = f.read()
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    footnote_title=footnote_title,
-                    footnote_return_symbol=footnote_return_symbol,
-                    use_file_vars=use_file_vars).convert(text)
+    """
+    Convert the contents of a file.
+
+    Args:
+        cache: a `DiskCache`, or the directory for one, to look up and store the result in.
+            Results are keyed on the file's path, modification time, size and contents,
+            the conversion options and the markdown2 version.
+    """
+    profile = _get_profile(html4tags=html4tags, tab_width=tab_width,
+                           safe_mode=safe_mode, extras=extras,
+                           link_patterns=link_patterns,
+                           footnote_title=footnote_title,
+                           footnote_return_symbol=footnote_return_symbol,
+                           use_file_vars=use_file_vars)
+    if cache is None:
+        with open(path, 'r', encoding=encoding) as f:
+            text = f.read()
+        return Markdown(profile=profile).convert(text)
+
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        data = f.read()
+    try:
+        fingerprint = profile.fingerprint
+    except TypeError:
+        # the options can't be reliably identified between processes
+        return Markdown(profile=profile).convert(data.decode(encoding))
+
+    key = sha256('\0'.join((
+        os.path.abspath(path), str(stat.st_mtime_ns), str(stat.st_size),
+        sha256(data).hexdigest(), encoding, fingerprint, __version__
+    )).encode('utf-8', 'surrogateescape')).hexdigest()
+    disk_cache = _get_disk_cache(cache)
+    rv = disk_cache.get(key)
+    if rv is None:
+        rv = Markdown(profile=profile).convert(data.decode(encoding))
+        disk_cache.put(key, rv)
+    return rv
 
 
 def markdown(
@@ -201,14 +312,92 @@ def markdown(
     footnote_title: Optional[str] = None,
     footnote_return_symbol: Optional[str] =None,
     use_file_vars: bool = False,
-    cli: bool = False
+    cli: bool = False,
+    cache: Optional['ConversionCache'] = None,
+    stats: Union[bool, Callable[['ConversionStats'], Any]] = False
+) -> 'UnicodeWithAttrs':
+    profile = _get_profile(html4tags=html4tags, tab_width=tab_width,
+                           safe_mode=safe_mode, extras=extras,
+                           link_patterns=link_patterns,
+                           footnote_title=footnote_title,
+                           footnote_return_symbol=footnote_return_symbol,
+                           use_file_vars=use_file_vars, cli=cli)
+    return Markdown(profile=profile, cache=cache, stats=stats).convert(text)
+
+
+def markdown_many(
+    texts: Iterable[str],
+    workers: Optional[int] = None,
+    chunksize: int = 16,
+    ordered: bool = True,
+    html4tags: bool = False,
+    tab_width: int = DEFAULT_TAB_WIDTH,
+    safe_mode: Optional[_safe_mode] = None,
+    extras: Optional[_extras_param] = None,
+    link_patterns: Optional[_link_patterns] = None,
+    footnote_title: Optional[str] = None,
+    footnote_return_symbol: Optional[str] = None,
+    use_file_vars: bool = False
+) -> Iterator[Union['UnicodeWithAttrs', tuple[int, 'UnicodeWithAttrs']]]:
+    """
+    Convert many documents using a pool of worker processes. See `Markdown.convert_many`.
+    """
+    profile = _get_profile(html4tags=html4tags, tab_width=tab_width,
+                           safe_mode=safe_mode, extras=extras,
+                           link_patterns=link_patterns,
+                           footnote_title=footnote_title,
+                           footnote_return_symbol=footnote_return_symbol,
+                           use_file_vars=use_file_vars)
+    return Markdown(profile=profile).convert_many(
+        texts, workers=workers, chunksize=chunksize, ordered=ordered)
+
+
+async def markdown_async(
+    text: str,
+    executor: Optional['Executor'] = None,
+    html4tags: bool = False,
+    tab_width: int = DEFAULT_TAB_WIDTH,
+    safe_mode: Optional[_safe_mode] = None,
+    extras: Optional[_extras_param] = None,
+    link_patterns: Optional[_link_patterns] = None,
+    footnote_title: Optional[str] = None,
+    footnote_return_symbol: Optional[str] = None,
+    use_file_vars: bool = False
 ) -> 'UnicodeWithAttrs':
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    footnote_title=footnote_title,
-                    footnote_return_symbol=footnote_return_symbol,
-                    use_file_vars=use_file_vars, cli=cli).convert(text)
+    """
+    Convert text without blocking the event loop. See `Markdown.convert_async`.
+    """
+    profile = _get_profile(html4tags=html4tags, tab_width=tab_width,
+                           safe_mode=safe_mode, extras=extras,
+                           link_patterns=link_patterns,
+                           footnote_title=footnote_title,
+                           footnote_return_symbol=footnote_return_symbol,
+                           use_file_vars=use_file_vars)
+    return await Markdown(profile=profile).convert_async(text, executor=executor)
+
+
+def markdown_stream(
+    chunks: Iterable[Union[str, bytes]],
+    html4tags: bool = False,
+    tab_width: int = DEFAULT_TAB_WIDTH,
+    safe_mode: Optional[_safe_mode] = None,
+    extras: Optional[_extras_param] = None,
+    link_patterns: Optional[_link_patterns] = None,
+    footnote_title: Optional[str] = None,
+    footnote_return_symbol: Optional[str] = None,
+    use_file_vars: bool = False,
+    wait_for_definitions: bool = True
+) -> Iterator[str]:
+    """
+    Convert text that arrives in pieces, a block at a time. See `Markdown.convert_stream`.
+    """
+    profile = _get_profile(html4tags=html4tags, tab_width=tab_width,
+                           safe_mode=safe_mode, extras=extras,
+                           link_patterns=link_patterns,
+                           footnote_title=footnote_title,
+                           footnote_return_symbol=footnote_return_symbol,
+                           use_file_vars=use_file_vars)
+    return Markdown(profile=profile).convert_stream(chunks, wait_for_definitions=wait_for_definitions)
 
 
 class Stage(IntEnum):
@@ -233,37 +422,52 @@ class Stage(IntEnum):
     UNHASH_HTML = auto()
 
 
-def mark_stage(stage: Stage):
+def mark_stage(stage: Stage, triggers: str = ''):
     '''
     Decorator that handles executing relevant `Extra`s before and after this `Stage` executes.
+
+    Args:
+        stage: the stage that the decorated method executes
+        triggers: characters, one of which the text must contain for the stage to have
+            anything to do. If it has none of them and no extras run at the stage, the
+            stage is skipped
     '''
     def wrapper(func):
         @functools.wraps(func)
         def inner(md: 'Markdown', text, *args, **kwargs):
             md.stage = stage
-            # set "order" prop so extras can tell if they're being invoked before/after the stage
-            md.order = stage - 0.5
+            plan = md._extras_plan.get(stage)
+            if plan is None and triggers and not _has_any(text, triggers, {}):
+                # no extras to run, and nothing for the stage to do
+                md.order = stage + 0.5
+                if md._stats is not None:
+                    md._stats._skip(stage)
+                return text
 
-            if stage in Extra._exec_order:
-                for klass in Extra._exec_order[stage][0]:
-                    if klass.name not in md.extra_classes:
-                        continue
-                    extra = md.extra_classes[klass.name]
-                    if extra.test(text):
-                        text = extra.run(text)
+            stats = md._stats
+            if stats is not None:
+                timing, started = stats._start(stage, text)
 
-            md.order = stage
-            text = func(md, text, *args, **kwargs)
-            md.order = stage + 0.5
+            if plan is None:
+                # no extras to run, so nothing to see `md.order` until afterwards
+                md.order = stage
+                text = func(md, text, *args, **kwargs)
+                md.order = stage + 0.5
+            else:
+                # set "order" prop so extras can tell if they're being invoked before/after the stage
+                md.order = stage - 0.5
 
-            if stage in Extra._exec_order:
-                for klass in Extra._exec_order[stage][1]:
-                    if klass.name not in md.extra_classes:
-                        continue
-                    extra = md.extra_classes[klass.name]
-                    if extra.test(text):
-                        text = extra.run(text)
+                before, after = plan
+                text = _run_extras(before, md._extra_instances, text)
+
+                md.order = stage
+                text = func(md, text, *args, **kwargs)
+                md.order = stage + 0.5
+
+                text = _run_extras(after, md._extra_instances, text)
 
+            if stats is not None:
+                stats._stop(timing, started, text)
             return text
 
         return inner
@@ -271,6 +475,440 @@ def mark_stage(stage: Stage):
     return wrapper
 
 
+_NO_EXTRAS: tuple[tuple[str, ...], tuple[str, ...]] = ((), ())
+
+
+def _has_any(text: str, chars: str, found: dict[str, bool]) -> bool:
+    '''
+    Whether the text contains any of the characters. `found` records which characters
+    have been looked for in the text already, so that each is only looked for once.
+    '''
+    for char in chars:
+        has = found.get(char)
+        if has is None:
+            has = found[char] = char in text
+        if has:
+            return True
+    return False
+
+
+def _run_extras(extras: tuple['_PlannedExtra', ...], instances: tuple['Extra', ...], text: str) -> str:
+    '''
+    Run the extras from a stage's plan (see `Markdown._extras_plan`) that test positive
+    against the text, without testing those whose trigger characters it doesn't contain
+
+    Args:
+        extras: the planned extras to run
+        instances: the document's extras, which the plan refers to by index
+        text: the text to run them against
+    '''
+    found: dict[str, bool] = {}
+    for triggers, index, test, run, takes_test_result in extras:
+        if triggers and not _has_any(text, triggers, found):
+            continue
+        extra = instances[index]
+        result = test(extra, text)
+        if result:
+            new_text = run(extra, text, result) if takes_test_result else run(extra, text)
+            if new_text is not text:
+                text = new_text
+                found = {}
+    return text
+
+
+_PlannedExtra = tuple[str, int, Callable[['Extra', str], Any], Callable[..., str], bool]
+'''
+The trigger characters of an extra in `Markdown._extras_plan`, its index in the document's
+`Markdown._extra_instances`, its class's `test` and `run` methods, and whether `run` takes
+the result of `test`
+'''
+
+
+class _ExtrasSetup:
+    '''
+    The extras of a `MarkdownProfile`, made for its first document, and the plan to run them
+    by. Later documents copy them rather than create their own (see `Extra.reset`)
+    '''
+    __slots__ = ('version', 'names', 'extras', 'order', 'plan')
+
+    def __init__(
+        self,
+        names: tuple[str, ...],
+        extras: tuple[tuple[type['Extra'], Any, Optional['Extra']], ...],
+        order: dict[Stage, tuple[tuple[str, ...], tuple[str, ...]]],
+        plan: dict[Stage, tuple[tuple[_PlannedExtra, ...], tuple[_PlannedExtra, ...]]]
+    ):
+        self.version = Extra._registry_version
+        '''The `Extra._registry_version` that the setup was made for'''
+        self.names = names
+        self.extras = extras
+        '''
+        The class and options of each extra, and the extra to copy for each document. `None`
+        for extras that have to be created for each document
+        '''
+        self.order = order
+        self.plan = plan
+
+    def instances(self, md: 'Markdown') -> tuple['Extra', ...]:
+        '''The extras for a new document'''
+        instances = []
+        for klass, options, prototype in self.extras:
+            if prototype is None:
+                instances.append(klass(md, options))
+                continue
+            extra = object.__new__(klass)
+            extra.__dict__.update(prototype.__dict__)
+            extra.md = md
+            extra.reset()
+            instances.append(extra)
+        return tuple(instances)
+
+
+def _extras_order_from_extras(extras: Collection[str]) -> dict[Stage, tuple[tuple[str, ...], tuple[str, ...]]]:
+    '''
+    Filter `Extra._exec_order` down to the names of the registered extras in `extras`,
+    dropping any stages that have nothing to run.
+    '''
+    order = {}
+    for stage, (before, after) in Extra._exec_order.items():
+        before_names = tuple(k.name for k in before if k.name in extras and k.name in Extra._registry)
+        after_names = tuple(k.name for k in after if k.name in extras and k.name in Extra._registry)
+        if before_names or after_names:
+            order[stage] = (before_names, after_names)
+    return order
+
+
+def _copy_option(value: Any) -> Any:
+    '''Copy the (possibly nested) dicts and lists within an option value'''
+    if isinstance(value, dict):
+        return {k: _copy_option(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_option(v) for v in value]
+    return value
+
+
+def _freeze(value: Any) -> Any:
+    '''
+    Recursively convert an option value into a hashable equivalent.
+
+    Raises:
+        TypeError: if the value contains something that cannot be hashed
+    '''
+    if isinstance(value, dict):
+        return (dict, frozenset((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return (list, tuple(_freeze(v) for v in value))
+    if isinstance(value, set):
+        return frozenset(value)
+    hash(value)
+    return value
+
+
+def _stable_repr(value: Any, _functions: Optional[set[int]] = None) -> str:
+    '''
+    A representation of an option value that doesn't depend on memory addresses or hash seeds.
+
+    Raises:
+        TypeError: if the value contains something with no such representation
+    '''
+    if _functions is None:
+        _functions = set()
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(sorted(
+            '%s: %s' % (_stable_repr(k, _functions), _stable_repr(v, _functions)) for k, v in value.items()
+        ))
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(_stable_repr(v, _functions) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return '{%s}' % ', '.join(sorted(_stable_repr(v, _functions) for v in value))
+    if isinstance(value, re.Pattern):
+        return 're.compile(%r, %d)' % (value.pattern, value.flags)
+    if value is None or isinstance(value, (bool, str, bytes, int, float)):
+        return repr(value)
+    if isinstance(value, type(sys)):
+        return 'module %s' % value.__name__
+    if isinstance(value, FunctionType) and not value.__closure__:
+        return _function_repr(value, _functions)
+    raise TypeError('cannot fingerprint %r' % (value,))
+
+
+def _function_repr(function: FunctionType, functions: set[int]) -> str:
+    '''
+    Identify a function by its code, rather than by name: its bytecode, the constants and
+    names it uses, its default arguments and the values of the globals it reads
+    '''
+    name = '%s.%s' % (function.__module__, function.__qualname__)
+    if id(function) in functions:
+        # a recursive function, which is already being represented
+        return name
+    functions.add(id(function))
+
+    def code_repr(code: CodeType, names: set[str]) -> str:
+        names.update(code.co_names)
+        consts = [
+            code_repr(c, names) if isinstance(c, CodeType) else _stable_repr(c, functions)
+            for c in code.co_consts
+        ]
+        return '%s %r [%s]' % (code.co_code.hex(), code.co_names, ', '.join(consts))
+
+    names: set[str] = set()
+    code = code_repr(function.__code__, names)
+    # `co_names` has the attributes the code looks up too, so only the ones that are globals count
+    globals_ = {name: function.__globals__[name] for name in names if name in function.__globals__}
+    digest = sha256('\0'.join((
+        code,
+        _stable_repr(function.__defaults__, functions),
+        _stable_repr(function.__kwdefaults__, functions),
+        _stable_repr(globals_, functions)
+    )).encode('utf-8', 'surrogatepass')).hexdigest()
+    return '%s:%s' % (name, digest)
+
+
+class MarkdownProfile:
+    '''
+    An immutable, hashable set of options for a `Markdown` converter.
+
+    The option normalisation, the extras execution order and the tab width dependent
+    regexes are all worked out once, when the profile is created, so a profile can be
+    reused for many conversions without paying that cost again.
+
+        >>> profile = MarkdownProfile(extras=["footnotes"])
+        >>> str(profile.convert("*boo!*"))
+        '<p><em>boo!</em></p>\\n'
+    '''
+    __slots__ = (
+        'html4tags', 'tab_width', 'safe_mode', 'extras', 'link_patterns', 'footnote_title',
+        'footnote_return_symbol', 'use_file_vars', 'cli', 'empty_element_suffix', 'tab',
+        'toc_depth', 'escape_table', 'outdent_re', 'link_def_re', 'footnote_def_re',
+        'list_res', '_extras_order', '_extras_setup', '_key', '_hash', '_fingerprint', '_has_key'
+    )
+
+    html4tags: bool
+    tab_width: int
+    safe_mode: Optional[_safe_mode]
+    extras: 'MappingProxyType[str, Any]'
+    link_patterns: Optional[_link_patterns]
+    footnote_title: Optional[str]
+    footnote_return_symbol: Optional[str]
+    use_file_vars: bool
+    cli: bool
+    empty_element_suffix: str
+    tab: str
+    toc_depth: int
+    escape_table: 'MappingProxyType[str, str]'
+    outdent_re: re.Pattern[str]
+    link_def_re: re.Pattern[str]
+    footnote_def_re: re.Pattern[str]
+    list_res: tuple[tuple[re.Pattern[str], re.Pattern[str]], tuple[re.Pattern[str], re.Pattern[str]]]
+    '''`(ul_re, ol_re)` pairs for top level lists and sub-lists, in that order'''
+
+    def __init__(
+        self,
+        html4tags: bool = False,
+        tab_width: int = DEFAULT_TAB_WIDTH,
+        safe_mode: Optional[_safe_mode] = None,
+        extras: Optional[_extras_param] = None,
+        link_patterns: Optional[_link_patterns] = None,
+        footnote_title: Optional[str] = None,
+        footnote_return_symbol: Optional[str] = None,
+        use_file_vars: bool = False,
+        cli: bool = False
+    ):
+        set_ = functools.partial(object.__setattr__, self)
+
+        set_('html4tags', html4tags)
+        set_('empty_element_suffix', ">" if html4tags else " />")
+        set_('tab_width', tab_width)
+        set_('tab', tab_width * " ")
+
+        # For compatibility with earlier markdown2.py and with
+        # markdown.py's safe_mode being a boolean,
+        #   safe_mode == True -> "replace"
+        if safe_mode is True:
+            safe_mode = "replace"
+        set_('safe_mode', safe_mode)
+
+        # Massaging and building the "extras" info. Nested options are copied
+        # so that normalising them never modifies the caller's objects
+        if not extras:
+            extras = {}
+        elif not isinstance(extras, dict):
+            extras = {e: None for e in extras}
+        extras = {k: _copy_option(v) for k, v in extras.items()}
+
+        toc_depth = 6
+        if "toc" in extras:
+            if "header-ids" not in extras:
+                extras["header-ids"] = None   # "toc" implies "header-ids"
+
+            if extras["toc"] is not None:
+                toc_depth = extras["toc"].get("depth", 6)
+        set_('toc_depth', toc_depth)
+
+        if 'header-ids' in extras:
+            if not isinstance(extras['header-ids'], dict):
+                extras['header-ids'] = {
+                    'mixed': False,
+                    'prefix': extras['header-ids'],
+                    'reset-count': True
+                }
+
+        if 'break-on-newline' in extras:
+            # `break-on-newline` is an alias for the breaks extra's `on_newline`
+            # option. When both extras are given (e.g. extras=['breaks',
+            # 'break-on-newline']) `breaks` is already a key mapped to None, so
+            # setdefault would leave it None and the assignment below would
+            # raise a TypeError. Normalise to a dict before setting the option.
+            if not isinstance(extras.get('breaks'), dict):
+                extras['breaks'] = {}
+            extras['breaks']['on_newline'] = True
+
+        if 'link-patterns' in extras:
+            # allow link patterns via extras dict without kwarg explicitly set
+            link_patterns = link_patterns or extras['link-patterns']
+            if link_patterns is None:
+                # if you have specified that the link-patterns extra SHOULD
+                # be used (via self.extras) but you haven't provided anything
+                # via the link_patterns argument then an error is raised
+                raise MarkdownError("If the 'link-patterns' extra is used, an argument for 'link_patterns' is required")
+            extras['link-patterns'] = link_patterns
+
+        set_('extras', MappingProxyType(extras))
+        set_('link_patterns', link_patterns)
+        set_('footnote_title', footnote_title)
+        set_('footnote_return_symbol', footnote_return_symbol)
+        set_('use_file_vars', use_file_vars)
+        set_('cli', cli)
+
+        escape_table = g_escape_table.copy()
+        if "smarty-pants" in extras:
+            escape_table['"'] = _reserved_placeholders['"']
+            escape_table["'"] = _reserved_placeholders["'"]
+        set_('escape_table', MappingProxyType(escape_table))
+
+        set_('outdent_re', _outdent_re_from_tab_width(tab_width))
+        set_('link_def_re', _link_def_re_from_tab_width(tab_width))
+        set_('footnote_def_re', _footnote_def_re_from_tab_width(tab_width))
+        set_('list_res', (
+            _list_res_from_tab_width(tab_width, False),
+            _list_res_from_tab_width(tab_width, True)
+        ))
+        set_('_extras_order', (-1, {}))
+        set_('_extras_setup', None)
+
+        try:
+            key = _freeze((
+                html4tags, tab_width, safe_mode, extras, link_patterns,
+                footnote_title, footnote_return_symbol, use_file_vars, cli
+            ))
+            set_('_has_key', True)
+        except TypeError:
+            # an unhashable option value (eg: a list of link patterns).
+            # Fall back to comparing by identity
+            key = object()
+            set_('_has_key', False)
+        set_('_key', key)
+        set_('_hash', hash(key))
+        set_('_fingerprint', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is immutable' % type(self).__name__)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, MarkdownProfile):
+            return NotImplemented
+        return self._key == other._key
+
+    def __repr__(self):
+        return '<%s extras=%r safe_mode=%r tab_width=%r>' % (
+            type(self).__name__, list(self.extras), self.safe_mode, self.tab_width)
+
+    def __reduce__(self):
+        # the normalised options produce the same profile when normalised again
+        return (MarkdownProfile, (
+            self.html4tags, self.tab_width, self.safe_mode, dict(self.extras), self.link_patterns,
+            self.footnote_title, self.footnote_return_symbol, self.use_file_vars, self.cli
+        ))
+
+    @property
+    def extras_order(self) -> dict[Stage, tuple[tuple[str, ...], tuple[str, ...]]]:
+        '''
+        Mapping of `Stage` to the names of the enabled extras that run before and after it.
+        Recalculated whenever an extra is registered or deregistered.
+        '''
+        version, order = self._extras_order
+        if version != Extra._registry_version:
+            order = _extras_order_from_extras(self.extras)
+            object.__setattr__(self, '_extras_order', (Extra._registry_version, order))
+        return order
+
+    @property
+    def fingerprint(self) -> str:
+        '''
+        A digest of the options that is stable between processes, eg: for keying persistent caches.
+
+        Functions (eg: in `link_patterns`) are identified by their code, default arguments and
+        the globals they read.
+
+        Raises:
+            TypeError: if an option can't be identified reliably, such as a closure in `link_patterns`
+        '''
+        if self._fingerprint is None:
+            options = (
+                self.html4tags, self.tab_width, self.safe_mode, dict(self.extras), self.link_patterns,
+                self.footnote_title, self.footnote_return_symbol, self.use_file_vars, self.cli
+            )
+            functions: set[int] = set()
+            fingerprint = sha256(_stable_repr(options, functions).encode('utf-8', 'surrogatepass')).hexdigest()
+            if functions:
+                # the defaults and globals of the functions can change after the profile is made
+                return fingerprint
+            object.__setattr__(self, '_fingerprint', fingerprint)
+        return self._fingerprint
+
+    def convert(self, text: str) -> 'UnicodeWithAttrs':
+        '''Convert `text` using a `Markdown` instance configured with this profile'''
+        return Markdown(profile=self).convert(text)
+
+
+_profile_cache: 'OrderedDict[Any, MarkdownProfile]' = OrderedDict()
+_PROFILE_CACHE_SIZE = 32
+
+
+def _get_profile(**options) -> MarkdownProfile:
+    '''
+    Get a `MarkdownProfile` for the given options, re-using a recently created
+    one where possible. Options that cannot be hashed bypass the cache.
+    '''
+    try:
+        key = _freeze(options)
+    except TypeError:
+        return MarkdownProfile(**options)
+
+    profile = _profile_cache.get(key)
+    if profile is not None:
+        try:
+            _profile_cache.move_to_end(key)
+        except KeyError:
+            # evicted by another thread in the meantime
+            pass
+        return profile
+
+    profile = _profile_cache[key] = MarkdownProfile(**options)
+    while len(_profile_cache) > _PROFILE_CACHE_SIZE:
+        try:
+            _profile_cache.popitem(last=False)
+        except KeyError:
+            break
+    return profile
+
+
 class Markdown:
     # The dict of "extras" to enable in processing -- a mapping of
     # extra name to argument for the extra. Most extras do not have an
@@ -281,6 +919,14 @@ class Markdown:
     extras: _extras_dict
     # dict of `Extra` names and associated class instances, populated during _setup_extras
     extra_classes: dict[str, 'Extra']
+    # the same instances, in the order that `_extras_plan` refers to them by
+    _extra_instances: tuple['Extra', ...] = ()
+    # the trigger characters, `test` and `run` methods (and whether `run` takes the result of
+    # `test`) of the extras to execute before and after each `Stage`, for the stages that
+    # have any, populated during _setup_extras. Shared by the documents of a profile
+    _extras_plan: dict[Stage, tuple[tuple['_PlannedExtra', ...], tuple['_PlannedExtra', ...]]] = {}
+    # the timings of the document's stages and extras, if it's being timed (see `convert`)
+    _stats: Optional['ConversionStats'] = None
 
     urls: dict[str, str]
     titles: dict[str, str]
@@ -317,105 +963,170 @@ class Markdown:
         footnote_title: Optional[str] = None,
         footnote_return_symbol: Optional[str] = None,
         use_file_vars: bool = False,
-        cli: bool = False
+        cli: bool = False,
+        profile: Optional['MarkdownProfile'] = None,
+        cache: Optional['ConversionCache'] = None,
+        stats: Union[bool, Callable[['ConversionStats'], Any]] = False
     ):
-        if html4tags:
-            self.empty_element_suffix = ">"
-        else:
-            self.empty_element_suffix = " />"
-        self.tab_width = tab_width
-        self.tab = tab_width * " "
-
-        # For compatibility with earlier markdown2.py and with
-        # markdown.py's safe_mode being a boolean,
-        #   safe_mode == True -> "replace"
-        if safe_mode is True:
-            self.safe_mode = "replace"
-        else:
-            self.safe_mode = safe_mode
-
-        # Massaging and building the "extras" info.
-        if getattr(self, 'extras', None) is None:
-            self.extras = {}
-        elif not isinstance(self.extras, dict):
-            # inheriting classes may set `self.extras` as List[str].
-            # we can't allow it through type hints but we can convert it
-            self.extras = {e: None for e in self.extras}  # type:ignore
-
-        if extras:
-            if not isinstance(extras, dict):
-                extras = {e: None for e in extras}
-            self.extras.update(extras)
-        assert isinstance(self.extras, dict)
-
+        """
+        Args:
+            profile: a pre-built `MarkdownProfile` to configure this instance from. If given,
+                all other options (including any class-level `extras`) are ignored in favour
+                of the ones in the profile.
+            cache: a `ConversionCache` to look up and store results in. Can be shared
+                between instances with different options.
+            stats: whether to time the stages and extras of each conversion, and attach the
+                `ConversionStats` to the result as `stats`. Can also be a callback to call
+                with the stats of each conversion, which is called in this process even when
+                converting in worker processes.
+        """
+        self.cache = cache
+        self.stats = stats
+        if profile is None:
+            # inheriting classes may set `self.extras` as a class attribute, to be
+            # merged with the `extras` argument
+            class_extras = getattr(self, 'extras', None)
+            if class_extras:
+                if not isinstance(class_extras, dict):
+                    class_extras = {e: None for e in class_extras}
+                if extras:
+                    if not isinstance(extras, dict):
+                        extras = {e: None for e in extras}
+                    extras = {**class_extras, **extras}
+                else:
+                    extras = class_extras
+            profile = MarkdownProfile(
+                html4tags=html4tags, tab_width=tab_width, safe_mode=safe_mode,
+                extras=extras, link_patterns=link_patterns,
+                footnote_title=footnote_title,
+                footnote_return_symbol=footnote_return_symbol,
+                use_file_vars=use_file_vars, cli=cli
+            )
+        self._apply_profile(profile)
+
+    def _apply_profile(self, profile: 'MarkdownProfile'):
+        """Configure this instance from a `MarkdownProfile`."""
+        self.profile = profile
+        self.empty_element_suffix = profile.empty_element_suffix
+        self.tab_width = profile.tab_width
+        self.tab = profile.tab
+        self.safe_mode = profile.safe_mode
+        self.extras = dict(profile.extras)
         if "toc" in self.extras:
-            if "header-ids" not in self.extras:
-                self.extras["header-ids"] = None   # "toc" implies "header-ids"
-
-            if self.extras["toc"] is None:
-                self._toc_depth = 6
-            else:
-                self._toc_depth = self.extras["toc"].get("depth", 6)
-
-        if 'header-ids' in self.extras:
-            if not isinstance(self.extras['header-ids'], dict):
-                self.extras['header-ids'] = {
-                    'mixed': False,
-                    'prefix': self.extras['header-ids'],
-                    'reset-count': True
-                }
-
-        if 'break-on-newline' in self.extras:
-            # `break-on-newline` is an alias for the breaks extra's `on_newline`
-            # option. When both extras are given (e.g. extras=['breaks',
-            # 'break-on-newline']) `breaks` is already a key mapped to None, so
-            # setdefault would leave it None and the assignment below would
-            # raise a TypeError. Normalise to a dict before setting the option.
-            if not isinstance(self.extras.get('breaks'), dict):
-                self.extras['breaks'] = {}
-            self.extras['breaks']['on_newline'] = True
-
-        if 'link-patterns' in self.extras:
-            # allow link patterns via extras dict without kwarg explicitly set
-            link_patterns = link_patterns or self.extras['link-patterns']
-            if link_patterns is None:
-                # if you have specified that the link-patterns extra SHOULD
-                # be used (via self.extras) but you haven't provided anything
-                # via the link_patterns argument then an error is raised
-                raise MarkdownError("If the 'link-patterns' extra is used, an argument for 'link_patterns' is required")
-            self.extras['link-patterns'] = link_patterns
+            self._toc_depth = profile.toc_depth
 
         self._instance_extras = self.extras.copy()
-        self.link_patterns = link_patterns
-        self.footnote_title = footnote_title
-        self.footnote_return_symbol = footnote_return_symbol
-        self.use_file_vars = use_file_vars
-        self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
-        self.cli = cli
-
-        self._escape_table = g_escape_table.copy()
-        self._code_table = {}
-        if "smarty-pants" in self.extras:
-            self._escape_table['"'] = _hash_text('"')
-            self._escape_table["'"] = _hash_text("'")
+        self.link_patterns = profile.link_patterns
+        self.footnote_title = profile.footnote_title
+        self.footnote_return_symbol = profile.footnote_return_symbol
+        self.use_file_vars = profile.use_file_vars
+        self.cli = profile.cli
+
+        self._outdent_re = profile.outdent_re
+        self._link_def_re = profile.link_def_re
+        self._footnote_def_re = profile.footnote_def_re
+        self._list_res = profile.list_res
+        self._extras_order = profile.extras_order
+
+        # header ids only get reset between documents if the `reset-count` option
+        # is set, so these live with the instance rather than the document. The lock
+        # keeps the ids unique when converting in several threads at once
+        self._count_from_header_id = defaultdict(int)
+        self._header_ids_seen = set()
+        self._header_ids_lock = threading.Lock()
+        self._placeholder_ids: Iterator[int] = count(_FIRST_PLACEHOLDER)
+
+    def __getstate__(self):
+        # eg: when sent to `convert_many` workers
+        state = self.__dict__.copy()
+        del state['_header_ids_lock']
+        if callable(state.get('stats')):
+            # the callback mightn't pickle, so it's called in this process (see `_report_stats`)
+            state['stats'] = True
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._header_ids_lock = threading.Lock()
 
     def reset(self):
+        self._placeholders: dict[str, str] = {}
+        self._placeholder_texts: dict[str, str] = {}
         self.urls = {}
         self.titles = {}
         self.html_blocks = {}
         self.html_spans = {}
         self.list_level = 0
+        self._escape_table = self.profile.escape_table.copy()
+        self._code_table = {}
+        self._iab_processor = None
+        self._link_processor = None
         self.extras = self._instance_extras.copy()
         self._setup_extras()
         self._toc = []
 
+    def _new_document(self, placeholder_ids: Optional[Iterator[int]] = None) -> 'Markdown':
+        """
+        Create a shallow copy of this instance to hold the state of a single conversion.
+
+        The copy shares the configuration (and any `reset-count: False` header id counters)
+        with this instance but gets its own URL, HTML, footnote, TOC and extras state, so
+        that concurrent conversions never see one another's state.
+
+        Args:
+            placeholder_ids: the counter to number the document's placeholders from (see
+                `_hash_text`). Documents whose hashed HTML gets mixed together must share one
+        """
+        md = object.__new__(type(self))
+        md.__dict__.update(self.__dict__)
+        md._placeholder_ids = count(_FIRST_PLACEHOLDER) if placeholder_ids is None else placeholder_ids
+        md._stats = None
+        md.reset()
+        return md
+
+    def _new_timed_document(self) -> 'Markdown':
+        """
+        Create a new document (see `_new_document`) that records its `ConversionStats`,
+        if this instance's `stats` option is set.
+        """
+        md = self._new_document()
+        if self.stats:
+            md._stats = ConversionStats()
+            md._extras_plan = md._stats._timed_plan(md._extras_plan, md._extra_instances)
+        return md
+
+    def _hash_text(self, text: str) -> str:
+        """
+        Get the placeholder to stand in for some text until it's restored. The same text
+        always gets the same placeholder within a document.
+        """
+        key = self._placeholders.get(text)
+        if key is None:
+            key = self._placeholders[text] = _placeholder(next(self._placeholder_ids))
+            self._placeholder_texts[key] = text
+        return key
+
+    def _take_hashes(self, doc: 'Markdown'):
+        """
+        Take on the text that another document hashed (see `_hash_text`), so that its
+        placeholders are restored in this document too. The two documents must number their
+        placeholders from the same counter.
+        """
+        for text, key in doc._placeholders.items():
+            self._placeholders.setdefault(text, key)
+        self._placeholder_texts.update(doc._placeholder_texts)
+        self._code_table.update(doc._code_table)
+        self._escape_table.update(doc._escape_table)
+        self.html_blocks.update(doc.html_blocks)
+        self.html_spans.update(doc.html_spans)
+
     def _setup_extras(self):
         if "footnotes" in self.extras:
             # order of insertion matters for footnotes. Use ordered dict for Python < 3.7
             # https://docs.python.org/3/whatsnew/3.7.html#summary-release-highlights
             self.footnotes = OrderedDict()
             self.footnote_ids = []
-            self._footnote_marker = _hash_text('<<footnote>>')
+            self._footnote_marker = _reserved_placeholders['<<footnote>>']
         if "header-ids" in self.extras:
             if not hasattr(self, '_count_from_header_id') or self.extras['header-ids'].get('reset-count', False):
                 self._count_from_header_id = defaultdict(int)
@@ -424,11 +1135,67 @@ class Markdown:
         if "metadata" in self.extras:
             self.metadata: dict[str, Any] = {}
 
-        self.extra_classes = {}
+        profile = self.profile
+        setup = profile._extras_setup
+        if setup is not None and setup.version == Extra._registry_version and self.extras == profile.extras:
+            instances = setup.instances(self)
+        else:
+            # the profile's first document, or the extras were changed for this document
+            # (eg: by `use_file_vars`)
+            setup, instances = self._new_extras_setup()
+            if self.extras == profile.extras:
+                object.__setattr__(profile, '_extras_setup', setup)
+
+        self.extra_classes = dict(zip(setup.names, instances))
+        self._extra_instances = instances
+        self._extras_order = setup.order
+        self._extras_plan = setup.plan
+        if self._stats is not None:
+            # the extras were changed for this document (eg: by `use_file_vars`)
+            self._extras_plan = self._stats._timed_plan(setup.plan, instances)
+
+    def _new_extras_setup(self) -> tuple['_ExtrasSetup', tuple['Extra', ...]]:
+        '''Create the document's extras and the plan to run them by'''
+        names = []
+        extras = []
+        instances = []
         for name, klass in Extra._registry.items():
             if name not in self.extras:
                 continue
-            self.extra_classes[name] = klass(self, (self.extras.get(name, {})))
+            options = self.extras[name]
+            extra = klass(self, options)
+            prototype = None
+            if _extra_is_reusable(klass):
+                prototype = object.__new__(klass)
+                prototype.__dict__.update(extra.__dict__)
+                # don't keep this document alive
+                prototype.md = None
+            names.append(name)
+            extras.append((klass, options, prototype))
+            instances.append(extra)
+
+        if self.extras.keys() == self.profile.extras.keys():
+            order = self.profile.extras_order
+        else:
+            order = _extras_order_from_extras(self.extras)
+
+        indexes = {name: index for index, name in enumerate(names)}
+
+        def plan(stage_names: tuple[str, ...]) -> tuple['_PlannedExtra', ...]:
+            planned = []
+            for name in stage_names:
+                klass = type(instances[indexes[name]])
+                planned.append((
+                    _extra_attr(klass, 'triggers', 'test'), indexes[name], klass.test, klass.run,
+                    _extra_attr(klass, 'takes_test_result', 'test', 'run')
+                ))
+            return tuple(planned)
+
+        setup = _ExtrasSetup(
+            tuple(names), tuple(extras), order,
+            {stage: (plan(before), plan(after)) for stage, (before, after) in order.items()}
+        )
+        return setup, tuple(instances)
 
     # Per <https://developer.mozilla.org/en-US/docs/HTML/Element/a> "rel"
     # should only be used in <a> tags with an "href" attribute.
@@ -449,40 +1216,177 @@ class Markdown:
     )
 
     def convert(self, text: str) -> 'UnicodeWithAttrs':
-        """Convert the given text."""
-        # Main function. The order in which other subs are called here is
-        # essential. Link and image substitutions need to happen before
-        # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
-        # and <img> tags get encoded.
+        """
+        Convert the given text.
 
-        # Clear the global hashes. If we don't clear these, you get conflicts
+        All of the state for the document lives on a per-conversion copy of this instance
+        (see `_new_document`), so a single `Markdown` instance can be shared between threads.
+        Afterwards, the state is copied back onto this instance (see `_keep_document_state`).
+
+        The `cache` isn't used when header ids are counted across documents (the `header-ids`
+        extra without `reset-count`), since the ids depend on the documents before. Nor is
+        it used when an option can't be compared by value (eg: an unhashable value in
+        `link_patterns`), as no other instance could look up the results.
+        """
+        rv = self._convert_cached(text)
+        self._report_stats((rv,))
+        return rv
+
+    def _convert_cached(self, text: str) -> 'UnicodeWithAttrs':
+        '''`convert`, without calling the `stats` callback'''
+        if self.cache is not None and self.profile._has_key and not _counts_header_ids(self.profile.extras):
+            key = self._cache_key(text)
+            stats = ConversionStats() if self.stats else None
+            rv = self.cache.get(key)
+            if rv is None:
+                doc = self._new_timed_document()
+                rv = doc._convert(text)
+                self._keep_document_state(doc)
+                if not _counts_header_ids(doc.extras):
+                    # (unless file vars enabled them for this document)
+                    self.cache.put(key, rv)
+            elif stats is not None:
+                stats.cached = True
+                stats.seconds = perf_counter() - stats.started
+                rv.stats = stats
+            return rv
+
+        # Each conversion gets fresh hashes. If we shared these, you'd get conflicts
         # from other articles when generating a page which contains more than
         # one article (e.g. an index page that shows the N most recent
-        # articles):
-        self.reset()
+        # articles), or from other threads using this instance
+        doc = self._new_timed_document()
+        rv = doc._convert(text)
+        self._keep_document_state(doc)
+        return rv
 
-        if not isinstance(text, str):
-            # TODO: perhaps shouldn't presume UTF-8 for string input?
+    def _keep_document_state(self, doc: 'Markdown'):
+        """
+        Copy the state of a finished document (eg: its `urls`, `footnotes`, `metadata` and
+        anything that subclass hooks stored on it) onto this instance, where it could be read
+        after converting before each conversion had its own copy. When converting in several
+        threads at once, this is the state of whichever conversion finished last.
+        """
+        state = doc.__dict__.copy()
+        # these belong to the instance, not the document
+        del state['_placeholder_ids'], state['_stats']
+        # these are made anew for each document, and would keep it alive
+        for name in ('_extras_plan', '_iab_processor', '_link_processor'):
+            state.pop(name, None)
+        self.__dict__.update(state)
+        for extra in doc._extra_instances:
+            extra.md = self
+
+    def _cache_key(self, text: Union[str, bytes]) -> tuple[type['Markdown'], 'MarkdownProfile', bytes]:
+        if isinstance(text, str):
+            text = text.encode('utf-8', 'surrogatepass')
+        # subclasses may produce different output for the same options
+        return type(self), self.profile, sha256(text).digest()
+
+    def parse(self, text: str) -> 'Document':
+        """
+        Find the block structure of the given text: its headers, paragraphs, lists, code
+        blocks and so on. The `Document` can be inspected (eg: for its headers or link
+        definitions), pickled, and turned into HTML later on with `render`.
+
+        The text is prepared with this instance's options, so the tabs of the text are
+        expanded to its `tab_width` and, with the `metadata` extra, its metadata is taken
+        out and kept with the document.
+        """
+        doc = self._new_document()
+        text = doc._prepare_text(text)
+        builder = _TreeBuilder(doc)
+        document = Document(text, builder.build(text), doc.metadata if "metadata" in doc.extras else None)
+        document.blocks = tuple(builder.blocks)
+        document._split_by = _BlockSplitter.options(doc)
+        return document
+
+    def render(self, document: 'Document') -> 'UnicodeWithAttrs':
+        """
+        Convert a document from `parse` to HTML. This gives the same HTML as `convert`
+        does for the text of the document, and can be used with an instance that has
+        other options (eg: `safe_mode`) than the one that parsed the document.
+
+        The text isn't split up again: the top level blocks of the document (see
+        `Document.blocks`) are converted a few at a time, the way `IncrementalMarkdown`
+        converts them. The whole text is converted in one go instead if this instance
+        would split it into other blocks, or has options that need the whole document
+        at once (see `IncrementalMarkdown`).
+        """
+        if (
+            document.blocks and not self.stats and document._split_by == _BlockSplitter.options(self)
+            and _BlockRenderer.supports(self)
+        ):
+            rv = self._render_blocks(document)
+            if rv is not None:
+                return rv
+
+        doc = self._new_timed_document()
+        if doc.use_file_vars:
+            doc._apply_file_vars(document.text)
+        if "metadata" in doc.extras:
+            doc.metadata = dict(document.metadata)
+        rv = doc._convert_prepared(document.text)
+        self._keep_document_state(doc)
+        self._report_stats((rv,))
+        return rv
+
+    _render_chunk_size = 4096
+    """
+    The blocks of a document are joined up into pieces of at least this many characters
+    for `render`, to save on converting many small pieces of text
+    """
+
+    def _render_blocks(self, document: 'Document') -> Optional['UnicodeWithAttrs']:
+        """
+        Convert the blocks of a document a few at a time, or return `None` if they can't
+        be converted separately after all.
+        """
+        renderer = _BlockRenderer(self)
+        doc = renderer.new_document()
+        if "metadata" in doc.extras:
+            doc.metadata = dict(document.metadata)
+        blocks = [renderer.prepare(source) for source in document._block_sources(self._render_chunk_size)]
+        for block in blocks:
+            renderer.define(block)
+        html = [renderer.render(block) for block in blocks]
+        if any(block.nested_headers for block in blocks):
+            # a full conversion gives ids to the headers in nested blocks last of all
+            return None
+        rv = renderer.finish(doc, html)
+        self._keep_document_state(doc)
+        return rv
+
+    def _convert(self, text: str) -> 'UnicodeWithAttrs':
+        return self._convert_prepared(self._prepare_text(text))
+
+    def _convert_prepared(self, text: str) -> 'UnicodeWithAttrs':
+        # Main function. The order in which other subs are called here is
+        # essential. Link and image substitutions need to happen before
+        # _EscapeSpecialChars(), so that any *'s or _'s in the <a>
+        # and <img> tags get encoded.
+        text = self._hash_and_strip_definitions(text)
+
+        text = self._run_block_gamut(text)
+
+        if "footnotes" in self.extras:
+            text = self._do_footnote_marker(text)
+            text = self._add_footnotes(text)
+
+        text = self._finish_html(text)
+        return self._make_result(text)
+
+    def _prepare_text(self, text: Union[str, bytes]) -> str:
+        """
+        Normalise the line endings, tabs and blank lines of the input and extract
+        any file variables and metadata.
+        """
+        if not isinstance(text, str):
+            # TODO: perhaps shouldn't presume UTF-8 for string input?
             text = str(text, 'utf-8')
 
         if self.use_file_vars:
-            # Look for emacs-style file variable hints.
-            text = self._emacs_oneliner_vars_pat.sub(self._emacs_vars_oneliner_sub, text)
-            emacs_vars = self._get_emacs_vars(text)
-            if "markdown-extras" in emacs_vars:
-                splitter = re.compile("[ ,]+")
-                for e in splitter.split(emacs_vars["markdown-extras"]):
-                    if '=' in e:
-                        ename, earg = e.split('=', 1)
-                        try:
-                            earg = int(earg)
-                        except ValueError:
-                            pass
-                    else:
-                        ename, earg = e, None
-                    self.extras[ename] = earg
-
-            self._setup_extras()
+            text = self._apply_file_vars(text)
 
         # Standardize line endings:
         text = text.replace("\r\n", "\n")
@@ -504,6 +1408,40 @@ class Markdown:
         if "metadata" in self.extras:
             text = self._extract_metadata(text)
 
+        return text
+
+    def _apply_file_vars(self, text: str) -> str:
+        """
+        Turn on the extras given by any emacs-style file variables in the text, returning
+        the text with a one-liner variables line made into an HTML comment.
+        """
+        # Look for emacs-style file variable hints.
+        text = self._emacs_oneliner_vars_pat.sub(self._emacs_vars_oneliner_sub, text)
+        emacs_vars = self._get_emacs_vars(text)
+        if "markdown-extras" in emacs_vars:
+            splitter = re.compile("[ ,]+")
+            for e in splitter.split(emacs_vars["markdown-extras"]):
+                if '=' in e:
+                    ename, earg = e.split('=', 1)
+                    try:
+                        earg = int(earg)
+                    except ValueError:
+                        pass
+                else:
+                    ename, earg = e, None
+                self.extras[ename] = earg
+
+        self._setup_extras()
+        return text
+
+    def _hash_and_strip_definitions(self, text: str) -> str:
+        """
+        Hash raw HTML and strip out link and footnote definitions, ready for the block gamut.
+        """
+        if _PLACEHOLDER_CHAR in text:
+            # so that nothing in the input can pass for a placeholder
+            text = text.replace(_PLACEHOLDER_CHAR, _reserved_placeholders[_PLACEHOLDER_CHAR])
+
         text = self.preprocess(text)
 
         if self.safe_mode:
@@ -519,18 +1457,18 @@ class Markdown:
             #   [^4]: this "looks like a link defn"
             text = self._strip_footnote_definitions(text)
         text = self._strip_link_definitions(text)
+        return text
 
-        text = self._run_block_gamut(text)
-
-        if "footnotes" in self.extras:
-            text = self._do_footnote_marker(text)
-            text = self._add_footnotes(text)
-
+    def _finish_html(self, text: str) -> str:
+        """
+        Run postprocessing and restore the escaped characters and hashed HTML.
+        """
         text = self.postprocess(text)
 
         text = self._unescape_special_chars(text)
 
         text = self._unhash_html_spans(text)
+        text = _restore_placeholder_chars(text)
         if self.safe_mode:
             # return the removed text warning to its markdown.py compatible form
             text = text.replace(self.html_removed_text, self.html_removed_text_compat)
@@ -545,6 +1483,12 @@ class Markdown:
         elif do_nofollow_links:
             text = self._a_nofollow_or_blank_links.sub(r'<\1 rel="nofollow"\2', text)
 
+        return text
+
+    def _make_result(self, text: str) -> 'UnicodeWithAttrs':
+        """
+        Add the TOC to the finished HTML and attach the TOC and metadata attributes.
+        """
         if "toc" in self.extras and self._toc:
             if self.extras['header-ids'].get('mixed'):
                 # TOC will only be out of order if mixed headers is enabled
@@ -574,8 +1518,148 @@ class Markdown:
 
         if "metadata" in self.extras:
             rv.metadata = self.metadata
+
+        if self._stats is not None:
+            self._stats.seconds = perf_counter() - self._stats.started
+            rv.stats = self._stats
+        return rv
+
+    def _report_stats(self, results: Iterable['UnicodeWithAttrs']):
+        '''
+        Call the `stats` callback, if it is one, with the stats of each result. This happens
+        in the calling process, as the callback isn't sent to `convert_many` workers or
+        process pools given to `convert_async` (see `__getstate__`).
+        '''
+        if callable(self.stats):
+            for rv in results:
+                self.stats(rv.stats)
+
+    def convert_many(
+        self,
+        texts: Iterable[str],
+        workers: Optional[int] = None,
+        chunksize: int = 16,
+        ordered: bool = True
+    ) -> Iterator[Union['UnicodeWithAttrs', tuple[int, 'UnicodeWithAttrs']]]:
+        """
+        Convert many documents using a pool of worker processes.
+
+        This instance is sent to each worker once, when the worker starts, and documents
+        are then sent to the workers in chunks. Only a few chunks per worker are queued
+        at any one time, so `texts` can be a lazy iterable over a very large corpus.
+
+        Args:
+            texts: the documents to convert
+            workers: the number of worker processes. Defaults to the number of CPUs
+            chunksize: how many documents to send to a worker at a time
+            ordered: if True, yield the results in the same order as `texts`. Otherwise,
+                yield `(index, html)` tuples as soon as each chunk is finished, where `index`
+                is the position of the document within `texts`
+
+        Returns:
+            An iterator of `UnicodeWithAttrs` (or `(int, UnicodeWithAttrs)` if not `ordered`)
+        """
+        import itertools
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+        if chunksize < 1:
+            raise ValueError('chunksize must be at least 1')
+
+        workers = workers or os.cpu_count() or 1
+        max_pending = workers * 2
+        texts = iter(texts)
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self,)) as pool:
+            pending = deque()
+            index = 0
+            try:
+                while True:
+                    while len(pending) < max_pending:
+                        chunk = list(itertools.islice(texts, chunksize))
+                        if not chunk:
+                            break
+                        pending.append((index, pool.submit(_convert_in_worker, chunk)))
+                        index += len(chunk)
+                    if not pending:
+                        break
+
+                    if ordered:
+                        _, future = pending.popleft()
+                        results = future.result()
+                        self._report_stats(results)
+                        yield from results
+                        continue
+
+                    done, _ = wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+                    for item in [item for item in pending if item[1] in done]:
+                        pending.remove(item)
+                        start, future = item
+                        results = future.result()
+                        self._report_stats(results)
+                        yield from enumerate(results, start)
+            finally:
+                # the caller stopped iterating early (or something went wrong)
+                for _, future in pending:
+                    future.cancel()
+
+    async def convert_async(self, text: str, executor: Optional['Executor'] = None) -> 'UnicodeWithAttrs':
+        """
+        Convert the given text without blocking the event loop.
+
+        Args:
+            text: the text to convert
+            executor: the `concurrent.futures.Executor` to run the conversion in. This can be
+                a thread or process pool, and its number of workers bounds how many conversions
+                run at once. Defaults to the event loop's default executor, a thread pool
+                that the loop shuts down when it's closed.
+
+        In a thread pool, the event loop still gets to run whenever the interpreter switches
+        threads, but has to wait for the conversion to give up the GIL. Process pools avoid
+        contending for the GIL at all, at the cost of pickling this instance and the text for
+        each call.
+        """
+        import asyncio
+
+        rv = await asyncio.get_running_loop().run_in_executor(executor, self._convert_cached, text)
+        self._report_stats((rv,))
         return rv
 
+    def convert_stream(
+        self,
+        chunks: Iterable[Union[str, bytes]],
+        wait_for_definitions: bool = True
+    ) -> Iterator[str]:
+        """
+        Convert text that arrives in pieces (eg: the lines of a large file), yielding the
+        HTML of each top level block as soon as it can no longer change.
+
+        Joined together, the yielded pieces are the same as the result of `convert`. The
+        footnotes come at the end, and the last piece is a `UnicodeWithAttrs` with the
+        `toc_html` and `metadata` attributes. A block that refers to a link or footnote
+        that hasn't been defined yet is held back (along with the blocks after it) until
+        the definition turns up, or the text ends. The one difference is that a block
+        which has already been yielded keeps using a definition even if the same link or
+        footnote is defined again later on, whereas `convert` uses the last definition.
+
+        Options that need the whole document at once (eg: the `numbering` extra, or a TOC
+        that's prepended to the output) are converted in one piece at the end.
+
+        Args:
+            chunks: the text, in pieces of any size. `bytes` are decoded as UTF-8
+            wait_for_definitions: if False, don't hold back blocks that refer to links or
+                footnotes that haven't been defined yet. Text that has its definitions at the
+                end then streams as well, but the references to them are left unconverted
+        """
+        if not _BlockStream.supports(self):
+            decoder = codecs.getincrementaldecoder('utf-8')()
+            text = ''.join(chunk if isinstance(chunk, str) else decoder.decode(chunk) for chunk in chunks)
+            yield self.convert(text + decoder.decode(b'', final=True))
+            return
+
+        stream = _BlockStream(self, wait_for_definitions)
+        for chunk in chunks:
+            yield from stream.feed(chunk)
+        yield from stream.close()
+
     def _do_footnote_marker(self, text):
         def footnote_sub(match):
             normed_id = match.group(1)
@@ -909,18 +1993,10 @@ class Markdown:
         '|samp|script|select|small|span|strong|sub|sup|textarea|time|tt|var'
     )
 
-    _liberal_tag_block_re = re.compile(r"""
-        (                       # save in \1
-            ^                   # start of line  (with re.M)
-            <(%s)               # start tag = \2
-            \b                  # word break
-            (.*\n)*?            # any number of lines, minimally matching
-            .*</\2>             # the matching end tag
-            [ \t]*              # trailing spaces/tabs
-            (?=\n+|\Z)          # followed by a newline or end of document
-        )
-        """ % _block_tags_b,
-        re.X | re.M)
+    _liberal_tag_re = re.compile(r'<(%s)\b' % _block_tags_b)
+
+    _void_tags = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'))
+    '''Tags that have no content, and so no closing tag'''
 
     _html_markdown_attr_re = re.compile(
         # markdown attr, with optional assignment to true, must be followed by whitespace/boundary/closing tag chars
@@ -928,11 +2004,11 @@ class Markdown:
     def _hash_html_block_sub(
         self,
         match: Union[re.Match[str], str],
-        raw: bool = False
+        raw: bool = False,
+        tag: Optional[str] = None
     ) -> str:
         if isinstance(match, str):
             html = match
-            tag = None
         else:
             html = match.group(1)
             try:
@@ -964,16 +2040,16 @@ class Markdown:
                 # remove `markdown="1"` or `markdown` attr from tag
                 first_line = first_line[:m.start()] + first_line[m.end():]
                 # hash the HTML segments to protect them
-                f_key = _hash_text(first_line)
+                f_key = self._hash_text(first_line)
                 self.html_blocks[f_key] = first_line
-                l_key = _hash_text(last_line)
+                l_key = self._hash_text(last_line)
                 self.html_blocks[l_key] = last_line
                 return ''.join(["\n\n", f_key,
                     "\n\n", middle, "\n\n",
                     l_key, "\n\n"])
         elif self.extras.get('header-ids', {}).get('mixed') and self._h_tag_re.match(html):
             html = self._h_tag_re.sub(self._h_tag_sub, html)
-        key = _hash_text(html)
+        key = self._hash_text(html)
         self.html_blocks[key] = html
         return "\n\n" + key + "\n\n"
 
@@ -1010,7 +2086,7 @@ class Markdown:
         text = self._strict_tag_block_sub(text, self._block_tags_a, hash_html_block_sub)
 
         # Now match more liberally, simply from `\n<tag>` to `</tag>\n`
-        text = self._liberal_tag_block_re.sub(hash_html_block_sub, text)
+        text = self._liberal_tag_block_sub(text, hash_html_block_sub)
 
         # now do the same for spans that are acting like blocks
         # eg: an anchor split over multiple lines for readability
@@ -1028,6 +2104,8 @@ class Markdown:
 
         # Special case for standalone HTML comments:
         if "<!--" in text:
+            output = []
+            pos = 0     # the end of the text that's been copied into `output`
             start = 0
             while True:
                 # Delimiters for next comment block.
@@ -1077,9 +2155,15 @@ class Markdown:
                 html = text[start_idx:end_idx]
                 if raw and self.safe_mode:
                     html = self._sanitize_html(html)
-                key = _hash_text(html)
+                key = self._hash_text(html)
                 self.html_blocks[key] = html
-                text = text[:start_idx] + "\n\n" + key + "\n\n" + text[end_idx:]
+                output.append(text[pos:start_idx])
+                output.append("\n\n" + key + "\n\n")
+                pos = start = end_idx
+
+            if pos:
+                output.append(text[pos:])
+                text = ''.join(output)
 
         if "xml" in self.extras:
             # Treat XML processing instructions and namespaced one-liner
@@ -1113,41 +2197,90 @@ class Markdown:
         '''
         tag_count = 0
         current_tag = html_tags_re
-        block = ''
-        result = ''
+        line_re = _html_tag_line_re(current_tag, allow_indent)
+        block: list[str] = []
+        result: list[str] = []
 
         for chunk in text.splitlines(True):
-            is_markup = re.match(
-                r'^(\s{{0,{}}})(?:</code>(?=</pre>))?(</?({})\b>?)'.format('' if allow_indent else '0', current_tag), chunk
-            )
-            block += chunk
+            # without an indent, markup has to be right at the start of the line
+            is_markup = line_re.match(chunk) if allow_indent or chunk.startswith('<') else None
+            block.append(chunk)
 
             if is_markup:
-                if chunk.startswith('%s</' % is_markup.group(1)):
+                if chunk.startswith('</', is_markup.end(1)):
                     tag_count -= 1
                 else:
-                    # if close tag is in same line
-                    if self._tag_is_closed(is_markup.group(3), chunk):
+                    # if close tag is in same line, or the tag never has one (eg: `<hr />`)
+                    if is_markup.group(3) in self._void_tags or self._tag_is_closed(is_markup.group(3), chunk):
                         # we must ignore these
                         is_markup = None
                     else:
                         tag_count += 1
                         current_tag = is_markup.group(3)
+                        line_re = _html_tag_line_re(current_tag, allow_indent)
 
             if tag_count == 0:
                 if is_markup:
-                    block = callback(block.rstrip('\n'))  # remove trailing newline
-                current_tag = html_tags_re
-                result += block
-                block = ''
+                    result.append(callback(''.join(block).rstrip('\n')))  # remove trailing newline
+                else:
+                    result.extend(block)
+                block.clear()
+                if current_tag is not html_tags_re:
+                    current_tag = html_tags_re
+                    line_re = _html_tag_line_re(current_tag, allow_indent)
+
+        result.extend(block)
+
+        return ''.join(result)
+
+    def _liberal_tag_block_sub(self, text: str, callback: Callable[..., str]) -> str:
+        '''
+        Finds and substitutes HTML blocks that run from a line starting with one of `_block_tags_b`
+        to the first line (which can be the same one) ending with the matching close tag.
+
+        The lines ending in a close tag are found up front, so that tags that are never closed
+        don't need a search to the end of the text.
+
+        Args:
+            text: the text to search
+            callback: callback function that receives the found HTML text block and its tag, and
+                returns a new str
+        '''
+        lines = text.split('\n')
+        closes: dict[str, list[int]] = {}
+        for index, line in enumerate(lines):
+            if '</' in line:
+                line = line.rstrip(' \t')
+                if line.endswith('>'):
+                    closes.setdefault(line[line.rfind('</') + 2:-1], []).append(index)
+        if not closes:
+            return text
 
-        result += block
+        # how many of the lines that close each tag have been passed
+        passed = dict.fromkeys(closes, 0)
+        result: list[str] = []
+        copied = index = 0
+        while index < len(lines):
+            match = self._liberal_tag_re.match(lines[index]) if lines[index].startswith('<') else None
+            if match and match.group(1) in closes:
+                tag = match.group(1)
+                ends = closes[tag]
+                passed[tag] = bisect.bisect_left(ends, index, passed[tag])
+                if passed[tag] < len(ends):
+                    end = ends[passed[tag]]
+                    result.extend(lines[copied:index])
+                    result.append(callback('\n'.join(lines[index:end + 1]), tag=tag))
+                    copied = index = end + 1
+                    continue
+            index += 1
 
-        return result
+        result.extend(lines[copied:])
+        return '\n'.join(result)
 
-    def _tag_is_closed(self, tag_name: str, text: str) -> bool:
+    @staticmethod
+    def _tag_is_closed(tag_name: str, text: str) -> bool:
         # check if number of open tags == number of close tags
-        if len(re.findall('<%s(?:.*?)>' % tag_name, text)) != text.count('</%s>' % tag_name):
+        if len(_tag_open_re(tag_name).findall(text)) != text.count('</%s>' % tag_name):
             return False
 
         # check that close tag position is AFTER open tag
@@ -1159,29 +2292,7 @@ class Markdown:
     def _strip_link_definitions(self, text: str) -> str:
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
-        less_than_tab = self.tab_width - 1
-
-        # Link defs are in the form:
-        #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
-            ^[ ]{0,%d}\[(.+)\]: # id = \1
-              [ \t]*
-              \n?               # maybe *one* newline
-              [ \t]*
-            <?(.+?)>?           # url = \2
-              [ \t]*
-            (?:
-                \n?             # maybe one newline
-                [ \t]*
-                (?<=\s)         # lookbehind for whitespace
-                ['"(]
-                ([^\n]*)        # title = \3
-                ['")]
-                [ \t]*
-            )?  # title is optional
-            (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
-        return _link_def_re.sub(self._extract_link_def_sub, text)
+        return self._link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match: re.Match[str]) -> str:
         id, url, title = match.groups()
@@ -1215,23 +2326,7 @@ class Markdown:
             [^note-id]:
                 Text of the note.
         """
-        less_than_tab = self.tab_width - 1
-        footnote_def_re = re.compile(r'''
-            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
-            [ \t]*
-            (                       # footnote text = \2
-              # First line need not start with the spaces.
-              (?:\s*.*\n+)
-              (?:
-                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
-                .*\n+
-              )*
-            )
-            # Lookahead for non-space at line-start, or end of doc.
-            (?:(?=^[ ]{0,%d}\S)|\Z)
-            ''' % (less_than_tab, self.tab_width, self.tab_width),
-            re.X | re.M)
-        return footnote_def_re.sub(self._extract_footnote_def_sub, text)
+        return self._footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
     _hr_re = re.compile(r'^[ ]{0,3}([-_*])[ ]{0,2}(\1[ ]{0,2}){2,}$', re.M)
 
@@ -1242,13 +2337,7 @@ class Markdown:
 
         text = self._do_headers(text)
 
-        # Do Horizontal Rules:
-        # On the number of spaces in horizontal rules: The spec is fuzzy: "If
-        # you wish, you may use spaces between the hyphens or asterisks."
-        # Markdown.pl 1.0.1's hr regexes limit the number of spaces between the
-        # hr chars to one or two. We'll reproduce that limit here.
-        hr = "\n<hr"+self.empty_element_suffix+"\n"
-        text = re.sub(self._hr_re, hr, text)
+        text = self._do_horizontal_rules(text)
 
         text = self._do_lists(text)
 
@@ -1266,31 +2355,52 @@ class Markdown:
 
         return text
 
-    @mark_stage(Stage.SPAN_GAMUT)
-    def _run_span_gamut(self, text: str) -> str:
-        # These are all the transformations that occur *within* block-level
-        # tags like paragraphs, headers, and list items.
-
-        text = self._do_code_spans(text)
-
-        text = self._escape_special_chars(text)
-
+    def _do_horizontal_rules(self, text: str) -> str:
+        # On the number of spaces in horizontal rules: The spec is fuzzy: "If
+        # you wish, you may use spaces between the hyphens or asterisks."
+        # Markdown.pl 1.0.1's hr regexes limit the number of spaces between the
+        # hr chars to one or two. We'll reproduce that limit here.
+        hr = "\n<hr"+self.empty_element_suffix+"\n"
+        return re.sub(self._hr_re, hr, text)
+
+    # The transformations that occur *within* block-level tags like
+    # paragraphs, headers, and list items, in order, with the stage that
+    # extras run around (if any) and the characters that each one looks for.
+    _span_passes: tuple[tuple[str, Optional[Stage], str], ...] = (
+        ('_do_code_spans', Stage.CODE_SPANS, '`'),
+        ('_escape_special_chars', Stage.ESCAPE_SPECIAL, '\\<'),
         # Process anchor and image tags.
-        text = self._do_links(text)
-
+        ('_do_links', Stage.LINKS, '['),
         # Make links out of things like `<http://example.com/>`
         # Must come after _do_links(), because you can use < and >
         # delimiters in inline links like [this](<url>).
-        text = self._do_auto_links(text)
-
-        text = self._encode_amps_and_angles(text)
+        ('_do_auto_links', None, '<'),
+        ('_encode_amps_and_angles', None, '&<>'),
+        ('_do_italics_and_bold', Stage.ITALIC_AND_BOLD, '*_'),
+        ('_do_hard_breaks', None, '\n'),
+    )
 
-        text = self._do_italics_and_bold(text)
+    @mark_stage(Stage.SPAN_GAMUT)
+    def _run_span_gamut(self, text: str) -> str:
+        # Spans are mostly short (table cells, list items, headers) with little
+        # markup in them, so rather than each pass going over them, the
+        # characters in them are found once to tell which passes have anything
+        # to do. Passes are skipped if they have nothing to do and no extras run
+        # at their stage. The characters are only found again when a pass
+        # changes the text.
+        chars = set(text)
+        for name, stage, looks_for in _span_passes_for(type(self)):
+            if looks_for is None or stage in self._extras_order or not chars.isdisjoint(looks_for):
+                new_text = getattr(self, name)(text)
+                if new_text is not text:
+                    text = new_text
+                    chars = set(text)
+        return text
 
-        # Do hard breaks
-        text = re.sub(r" {2,}\n(?!\<(?:\/?(ul|ol|li))\>)", "<br%s\n" % self.empty_element_suffix, text)
+    _hard_break_re = re.compile(r" {2,}\n(?!\<(?:\/?(ul|ol|li))\>)")
 
-        return text
+    def _do_hard_breaks(self, text: str) -> str:
+        return self._hard_break_re.sub("<br%s\n" % self.empty_element_suffix, text)
 
     # "Sorta" because auto-links are identified as "tag" tokens.
     _sorta_html_tokenize_re = re.compile(r"""
@@ -1379,7 +2489,7 @@ class Markdown:
             except IndexError:
                 return False
 
-            return re.match(r'<code>md5-[A-Fa-f0-9]{32}</code>', ''.join(peek_tokens))
+            return re.match(r'<code>%s</code>' % _placeholder_re.pattern, ''.join(peek_tokens))
 
         def _is_comment(token):
             if self.safe_mode == 'replace':
@@ -1426,9 +2536,7 @@ class Markdown:
 
         text = ''.join(tokens)
         # put markdown code spans back into the text for processing
-        for key, code in code_hashes.items():
-            text = text.replace(key, code)
-        return text
+        return _restore_placeholders(text, code_hashes.get)
 
     def _unhash_html_spans(self, text: str, spans=True, code=False) -> str:
         '''
@@ -1438,16 +2546,28 @@ class Markdown:
             spans: unhash anything from `self.html_spans`
             code: unhash code blocks
         '''
-        orig = ''
-        while text != orig:
-            if spans:
-                for key, sanitized in list(self.html_spans.items()):
-                    text = text.replace(key, sanitized)
+        def lookup(key: str) -> Optional[str]:
+            if spans and key in self.html_spans:
+                return self.html_spans[key]
             if code:
-                for code, key in list(self._code_table.items()):
-                    text = text.replace(key, code)
-            orig = text
-        return text
+                return self._hashed_text(key, self._code_table)
+            return None
+
+        return _restore_placeholders(text, lookup)
+
+    def _hashed_text(self, key: str, table: dict[str, str]) -> Optional[str]:
+        '''
+        Get the text that a placeholder stands in for, if it's in `table` (a mapping of
+        text to placeholder, like `self._escape_table`). The text isn't always mapped to the
+        same placeholder, as documents that took on another's hashes (see `_take_hashes`)
+        can have hashed it under both
+        '''
+        text = self._placeholder_texts.get(key)
+        if text is None:
+            text = _reserved_placeholder_texts.get(key)
+        if text is not None and text in table:
+            return text
+        return None
 
     def _sanitize_html(self, s: str) -> str:
         if self.safe_mode == "replace":
@@ -1499,16 +2619,18 @@ class Markdown:
         out - the same number of open_c and close_c are encountered - or the
         end of string if it's reached before the balance point is found.
         """
-        i = start
-        l = len(text)
+        close = text.find(close_c, start)
+        if close == -1:
+            return len(text)
+        if text.find(open_c, start, close) == -1:
+            # nothing nested, which is usually the case
+            return close + 1
         count = 1
-        while count > 0 and i < l:
-            if text[i] == open_c:
-                count += 1
-            elif text[i] == close_c:
-                count -= 1
-            i += 1
-        return i
+        for match in _balanced_re(open_c, close_c).finditer(text, start):
+            count += 1 if match.group() == open_c else -1
+            if not count:
+                return match.end()
+        return len(text)
 
     # https://developer.mozilla.org/en-US/docs/web/http/basics_of_http/data_urls
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Basics_of_HTTP/MIME_types
@@ -1529,7 +2651,7 @@ class Markdown:
         '''
         if not url:
             # ignore links with empty URLs. Don't bother putting a hash there because then we'll have
-            # `"''"": "md5-..."` as an entry in the escape table, and that will cause havok
+            # `"''": "\ua66e...h"` as an entry in the escape table, and that will cause havok
             return url
         data_url = self._data_url_re.match(url)
         charset = None
@@ -1538,7 +2660,7 @@ class Markdown:
             if mime.startswith('image/') and data_url.group('token') == ';base64':
                 charset='base64'
         url = _html_escape_url(url, safe_mode=self.safe_mode, charset=charset)
-        key = _hash_text(url)
+        key = self._hash_text(url)
         self._escape_table[url] = key
         return key
 
@@ -1562,7 +2684,8 @@ class Markdown:
 
         return re.compile(r'^(?:({})?({})({})|(#|\.{{,2}}/)({}))$'.format(self._safe_protocols, domain, fragment, fragment), re.I)
 
-    @mark_stage(Stage.LINKS)
+    _link_processor = None
+    @mark_stage(Stage.LINKS, triggers='[')
     def _do_links(self, text: str) -> str:
         """Turn Markdown link shortcuts into XHTML <a> and <img> tags.
 
@@ -1572,9 +2695,10 @@ class Markdown:
         Markdown.pl because of the lack of atomic matching support in
         Python's regex engine used in $g_nested_brackets.
         """
-        link_processor = LinkProcessor(self, None)
-        if link_processor.test(text):
-            text = link_processor.run(text)
+        if not self._link_processor:
+            self._link_processor = LinkProcessor(self, None)
+        if self._link_processor.test(text):
+            text = self._link_processor.run(text)
         return text
 
     def header_id_from_text(self,
@@ -1601,16 +2725,17 @@ class Markdown:
             header_id = prefix + '-' + header_id
 
         base_id = header_id
-        self._count_from_header_id[base_id] += 1
-        if 0 == len(base_id) or self._count_from_header_id[base_id] > 1:
-            header_id = '%s-%s' % (base_id, self._count_from_header_id[base_id])
-        # A suffixed id may still collide with a differently-named header
-        # (e.g. "# Chapter" twice yields "chapter-2", which clashes with
-        # "# Chapter 2"). Keep bumping until the id is genuinely unique.
-        while header_id in self._header_ids_seen:
+        with self._header_ids_lock:
             self._count_from_header_id[base_id] += 1
-            header_id = '%s-%s' % (base_id, self._count_from_header_id[base_id])
-        self._header_ids_seen.add(header_id)
+            if 0 == len(base_id) or self._count_from_header_id[base_id] > 1:
+                header_id = '%s-%s' % (base_id, self._count_from_header_id[base_id])
+            # A suffixed id may still collide with a differently-named header
+            # (e.g. "# Chapter" twice yields "chapter-2", which clashes with
+            # "# Chapter 2"). Keep bumping until the id is genuinely unique.
+            while header_id in self._header_ids_seen:
+                self._count_from_header_id[base_id] += 1
+                header_id = '%s-%s' % (base_id, self._count_from_header_id[base_id])
+            self._header_ids_seen.add(header_id)
 
         return header_id
 
@@ -1626,7 +2751,9 @@ class Markdown:
             return
         if self._toc is None:
             self._toc = []
-        self._toc.append((level, id, self._unescape_special_chars(name)))
+        # ids come from the raw header text, so may have a placeholder for a placeholder character
+        id = _restore_placeholder_chars(id)
+        self._toc.append((level, id, _restore_placeholder_chars(self._unescape_special_chars(name))))
 
     _h_re_base = r'''
         (^(.+)[ \t]{0,99}\n(=+|-+)[ \t]*\n+)
@@ -1702,7 +2829,7 @@ class Markdown:
             return text[:3] + ' id="%s"' % header_id + text[3:]
         return text
 
-    @mark_stage(Stage.HEADERS)
+    @mark_stage(Stage.HEADERS, triggers='#=-')
     def _do_headers(self, text: str) -> str:
         # Setext-style headers:
         #     Header 1
@@ -1749,61 +2876,42 @@ class Markdown:
     def _do_lists(self, text: str) -> str:
         # Form HTML ordered (numbered) and unordered (bulleted) lists.
 
-        # Iterate over each *non-overlapping* list match.
+        # Iterate over each *non-overlapping* list match, taking the *first* hit
+        # for either list style (ul or ol). We match ul and ol separately to avoid
+        # adjacent lists of different types running into each other (see issue #16).
+        # The HTML of each list goes into `output` rather than being spliced into
+        # the text, and a style is only searched for again once its last hit has
+        # been passed, so this is linear in the length of the text.
+        list_res = self._list_res[bool(self.list_level)]
+        hits = [list_re.search(text) for list_re in list_res]
+        output = []
         pos = 0
         while True:
-            # Find the *first* hit for either list style (ul or ol). We
-            # match ul and ol separately to avoid adjacent lists of different
-            # types running into each other (see issue #16).
-            hits = []
-            for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                other_marker_pat = self._marker_ul if marker_pat == self._marker_ol else self._marker_ol
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        ([ ]{0,%d})     # \3 = the indentation level of the list item marker
-                        (%s)            # \4 = first list item marker
-                        [ \t]+
-                        (?!\ *\4\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \5
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                        |
-                          \n+
-                          (?=
-                            \3          # lookahead for a different style of list item marker
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat, other_marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
-                match = list_re.search(text, pos)
-                if match:
-                    hits.append((match.start(), match))
-            if not hits:
+            match = None
+            for index, list_re in enumerate(list_res):
+                hit = hits[index]
+                if hit is not None and hit.start() < pos:
+                    hit = hits[index] = list_re.search(text, pos)
+                if hit is not None and (match is None or hit.start() < match.start()):
+                    match = hit
+
+            if pos and not self.list_level and not text.endswith('\n\n', 0, pos):
+                # Top level lists have to follow a blank line, which the HTML of the
+                # list before this point ends with, but the text it replaces needn't
+                for sub_list_re in self._list_res[True]:
+                    hit = sub_list_re.match(text, pos)
+                    if hit is not None:
+                        match = hit
+
+            if match is None:
                 break
-            hits.sort()
-            match = hits[0][1]
             start, end = match.span()
-            middle = self._list_sub(match)
-            text = text[:start] + middle + text[end:]
-            pos = start + len(middle)  # start pos for next attempted match
+            output.append(text[pos:start])
+            output.append(self._list_sub(match))
+            pos = end
 
-        return text
+        output.append(text[pos:])
+        return ''.join(output)
 
     _list_item_re = re.compile(r'''
         (\n)?                   # leading line = \1
@@ -1945,8 +3053,8 @@ class Markdown:
         formatter = HtmlCodeFormatter(**formatter_opts)
         return pygments.highlight(codeblock, lexer, formatter)
 
-    def _code_block_sub(self, match: re.Match[str]) -> str:
-        codeblock = match.group(1)
+    def _code_block_html(self, codeblock: str) -> str:
+        '''Render the (still indented) lines of a code block, as found by `_do_code_blocks`'''
         codeblock = self._outdent(codeblock)
         codeblock = self._detab(codeblock)
         codeblock = codeblock.lstrip('\n')  # trim leading newlines
@@ -1979,21 +3087,91 @@ class Markdown:
     @mark_stage(Stage.CODE_BLOCKS)
     def _do_code_blocks(self, text: str) -> str:
         """Process Markdown `<pre><code>` blocks."""
-        code_block_re = re.compile(r'''
-            (?:\n\n|\A\n?)
-            (               # $1 = the code block -- one or more lines, starting with a space/tab
-              (?:
-                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
-                .*\n+
-              )+
-            )
-            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
-            # Lookahead to make sure this block isn't already in a code block.
-            # Needed when syntax highlighting is being used.
-            (?!([^<]|<(/?)span)*\</code\>)
-            ''' % (self.tab_width, self.tab_width),
-            re.M | re.X)
-        return code_block_re.sub(self._code_block_sub, text)
+        # A code block is a run of lines that start with a tab or a tab-width of
+        # spaces, along with any blank lines in between. It has to start the text
+        # or follow a blank line, and has to be followed by a line starting with a
+        # non-space character (after at most a tab-width of spaces) or the end of the text.
+        # Lines are only ever looked at once, and a run that can't be a code block
+        # is skipped as a whole, since any block starting within it ends at the same line.
+        indent = ' ' * self.tab_width
+        output = []
+        pos = 0             # the end of the text that's been copied into `output`
+        code_end = -1       # the `<` the last search for a closing `</code>` stopped at
+        in_code = False
+        match_start = 0     # where the text replaced by the block starts (including the blank line)
+        start = 2 if text.startswith('\n\n') else 1 if text.startswith('\n') else 0
+        while True:
+            end = start
+            if text.startswith(indent, start) or text.startswith('\t', start):
+                while True:
+                    eol = text.find('\n', end)
+                    if eol == -1:
+                        break
+                    end = eol + 1
+                    while text.startswith('\n', end):
+                        end += 1
+                    if not (text.startswith(indent, end) or text.startswith('\t', end)):
+                        break
+
+                # Make sure this block isn't already in a code block.
+                # Needed when syntax highlighting is being used.
+                if end > code_end:
+                    code_end, in_code = _find_code_close(text, end)
+                cut = end
+                after = text[end:end + self.tab_width + 1].lstrip(' ')
+                if end == start:
+                    # the only line doesn't end in a newline
+                    cut = -1
+                elif in_code or not (end == len(text) or (after and not after[0].isspace())):
+                    cut = self._code_block_cut(text, start, end, in_code)
+                if cut != -1:
+                    output.append(text[pos:match_start])
+                    output.append(self._code_block_html(text[start:cut]))
+                    pos = cut
+
+            match_start = text.find('\n\n', end if end > start else match_start + 1)
+            if match_start == -1:
+                break
+            start = match_start + 2
+
+        output.append(text[pos:])
+        return ''.join(output)
+
+    def _code_block_cut(self, text: str, start: int, end: int, in_code: bool) -> int:
+        '''
+        Where to end the code block that starts at `start` when it can't go on to the end of its
+        lines (`end`), or -1 if it can't end anywhere. Blocks can also end before a line that starts
+        with exactly a tab-width of spaces, so this is the last of those that isn't inside a
+        highlighted `<code>`. `in_code` says whether `end` is.
+        '''
+        line = end
+        while True:
+            eol = text.rfind('\n', start, line - 1)
+            if eol == -1:
+                return -1
+            line = eol + 1
+            if not (text.startswith(' ' * self.tab_width, line) and text[line + self.tab_width:line + self.tab_width + 1].strip()):
+                continue
+
+            # whether there's a `</code>` before `end`, otherwise whether there is one after it
+            pos = line
+            while True:
+                pos = text.find('<', pos, end)
+                if pos == -1:
+                    break
+                if text.startswith('</code>', pos):
+                    in_code = True
+                    break
+                if text.startswith('<span', pos):
+                    pos += 5
+                elif text.startswith('</span', pos):
+                    pos += 6
+                else:
+                    in_code = False
+                    break
+            if not in_code:
+                return line
+            end = line
 
     # Rules for a code span:
     # - backslash escapes are not interpreted in a code span
@@ -2018,7 +3196,7 @@ class Markdown:
         c = self._encode_code(c)
         return "<code{}>{}</code>".format(self._html_class_str_from_tag("code"), c)
 
-    @mark_stage(Stage.CODE_SPANS)
+    @mark_stage(Stage.CODE_SPANS, triggers='`')
     def _do_code_spans(self, text: str) -> str:
         #   *   Backtick quotes are used for <code></code> spans.
         #
@@ -2059,7 +3237,11 @@ class Markdown:
         ]
         for before, after in replacements:
             text = text.replace(before, after)
-        hashed = _hash_text(text)
+        # placeholder characters from the input are always left as they are in code
+        text = text.replace(
+            _reserved_placeholders[_PLACEHOLDER_CHAR], _reserved_placeholders[_CODE_PLACEHOLDER_CHAR]
+        )
+        hashed = self._hash_text(text)
         self._code_table[text] = hashed
         return hashed
 
@@ -2114,7 +3296,7 @@ class Markdown:
         else:
             return '<blockquote>\n%s\n</blockquote>\n\n' % bq
 
-    @mark_stage(Stage.BLOCK_QUOTES)
+    @mark_stage(Stage.BLOCK_QUOTES, triggers='>')
     def _do_block_quotes(self, text: str) -> str:
         if '>' not in text:
             return text
@@ -2230,16 +3412,19 @@ class Markdown:
     def _encode_amps_and_angles(self, text: str) -> str:
         # Smart processing for ampersands and angle brackets that need
         # to be encoded.
-        text = _AMPERSAND_RE.sub('&amp;', text)
-        text = _ESCAPED_AMPERSAND_RE.sub(r'&amp;\1', text)
+        if '&' in text:
+            text = _AMPERSAND_RE.sub('&amp;', text)
+            text = _ESCAPED_AMPERSAND_RE.sub(r'&amp;\1', text)
 
         # Encode naked <'s
-        text = self._naked_lt_re.sub('&lt;', text)
+        if '<' in text:
+            text = self._naked_lt_re.sub('&lt;', text)
 
         # Encode naked >'s
         # Note: Other markdown implementations (e.g. Markdown.pl, PHP
         # Markdown) don't do this.
-        text = self._naked_gt_re.sub('&gt;', text)
+        if '>' in text:
+            text = self._naked_gt_re.sub('&gt;', text)
         return text
 
     _incomplete_tags_re = re.compile(r"\\*<(!--|/?\w+?(?!\w)\s*?.*?(?:[\s/]+?|$))")
@@ -2263,7 +3448,10 @@ class Markdown:
         return text
 
     def _encode_backslash_escapes(self, text: str) -> str:
-        for ch, escape in list(self._escape_table.items()):
+        if '\\' not in text:
+            return text
+        # only the escapable characters, not the URLs etc. that get added to `self._escape_table`
+        for ch, escape in self.profile.escape_table.items():
             text = text.replace("\\"+ch, escape)
         return text
 
@@ -2284,11 +3472,12 @@ class Markdown:
         """, re.I | re.X | re.U)
     def _auto_email_link_sub(self, match: re.Match[str]) -> str:
         return self._encode_email_address(
-            self._unescape_special_chars(match.group(1)))
+            _restore_placeholder_chars(self._unescape_special_chars(match.group(1))))
 
     def _do_auto_links(self, text: str) -> str:
         text = self._auto_link_re.sub(self._auto_link_sub, text)
-        text = self._auto_email_link_re.sub(self._auto_email_link_sub, text)
+        if '@' in text:
+            text = self._auto_email_link_re.sub(self._auto_email_link_sub, text)
         return text
 
     def _encode_email_address(self, addr: str) -> str:
@@ -2313,16 +3502,16 @@ class Markdown:
 
     def _unescape_special_chars(self, text: str) -> str:
         # Swap back in all the special characters we've hidden.
-        hashmap = tuple(self._escape_table.items()) + tuple(self._code_table.items())
-        # html_blocks table is in format {hash: item} compared to usual {item: hash}
-        hashmap += tuple(tuple(reversed(i)) for i in self.html_blocks.items())
-        while True:
-            orig_text = text
-            for ch, hash in hashmap:
-                text = text.replace(hash, ch)
-            if text == orig_text:
-                break
-        return text
+        def lookup(key: str) -> Optional[str]:
+            text = self._hashed_text(key, self._escape_table)
+            if text is None:
+                text = self._hashed_text(key, self._code_table)
+            if text is None:
+                # html_blocks table is in format {hash: item} compared to usual {item: hash}
+                text = self.html_blocks.get(key)
+            return text
+
+        return _restore_placeholders(text, lookup)
 
     def _outdent(self, text: str) -> str:
         # Remove one level of line-leading tabs or spaces
@@ -2340,7 +3529,7 @@ class Markdown:
         Returns:
             The hashed text
         '''
-        key = _hash_text(text)
+        key = self._hash_text(text)
         if hash_table is not None:
             hash_table[key] = text
         else:
@@ -2449,58 +3638,1754 @@ class MarkdownWithExtras(Markdown):
     extras = ["footnotes", "fenced-code-blocks"]  # type: ignore
 
 
-# ----------------------------------------------------------
-# Extras
-# ----------------------------------------------------------
+class ConversionCache:
+    """
+    A thread-safe, in-memory LRU cache of conversion results, for use with `Markdown(cache=...)`.
+
+    Results are keyed on a digest of the input text and the converter's options. Each hit
+    returns a new `UnicodeWithAttrs` with the cached `toc_html` and a copy of the cached
+    `metadata`, so a result can be modified without affecting later hits.
+
+    Note that the `obfuscate` email encoding is randomised, so a cached result will reuse
+    the same obfuscation each time.
+
+        >>> cache = ConversionCache(max_entries=100)
+        >>> md = Markdown(extras=["toc"], cache=cache)
+        >>> html = md.convert("# Title")
+        >>> md.convert("# Title") == html
+        True
+        >>> cache.hits, cache.misses
+        (1, 1)
+    """
+    def __init__(self, max_entries: Optional[int] = 1024, max_bytes: Optional[int] = 64 * 1024 * 1024):
+        """
+        Args:
+            max_entries: the max number of results to keep, or None for no limit
+            max_bytes: the max total size of the results to keep, or None for no limit. Results
+                larger than this are never cached
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        '''Approximate total size of the cached results'''
+        self._entries: OrderedDict[Any, tuple['UnicodeWithAttrs', int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __reduce__(self):
+        # eg: when sent to `convert_many` workers. Each process gets its own empty cache
+        return (ConversionCache, (self.max_entries, self.max_bytes))
 
-# Base classes
-# ----------------------------------------------------------
+    def __repr__(self):
+        return '<%s entries=%d bytes=%d hits=%d misses=%d evictions=%d>' % (
+            type(self).__name__, len(self), self.nbytes, self.hits, self.misses, self.evictions)
 
-class Extra(ABC):
-    _registry: dict[str, type['Extra']] = {}
-    _exec_order: dict[Stage, tuple[list[type['Extra']], list[type['Extra']]]] = {}
+    def get(self, key: Any) -> Optional['UnicodeWithAttrs']:
+        """Get a copy of a result, marking it as recently used. Returns None on a miss."""
+        with self._lock:
+            try:
+                rv, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return _copy_result(rv)
+
+    def put(self, key: Any, value: 'UnicodeWithAttrs'):
+        """Store a copy of a result, evicting the least recently used ones if over either limit."""
+        size = _result_size(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        # without its `stats`, and so that the caller can modify the result's metadata
+        value = _copy_result(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while self._entries and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries)
+                or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
 
-    name: str
-    '''
-    An identifiable name that users can use to invoke the extra
-    in the Markdown class
-    '''
-    order: tuple[Collection[Union[Stage, type['Extra']]], Collection[Union[Stage, type['Extra']]]]
-    '''
-    Tuple of two iterables containing the stages/extras this extra will run before and
-    after, respectively
-    '''
+    def clear(self):
+        """Remove all results. The hit, miss and eviction counts are kept."""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
 
-    def __init__(self, md: Markdown, options: Optional[dict]):
-        '''
+
+class DiskCache:
+    """
+    A persistent cache of conversion results for `markdown_path`, stored as one JSON file
+    per result in `directory`.
+
+    Entries are written atomically, so the directory can be shared between processes.
+    Each hit refreshes the entry's modification time and, when the cache grows past
+    `max_bytes`, the least recently used entries are removed. Since other processes may
+    be writing at the same time, the size limit is approximate.
+
+        >>> cache = DiskCache("/tmp/markdown2-cache")  # doctest: +SKIP
+        >>> html = markdown_path("README.md", cache=cache)  # doctest: +SKIP
+    """
+    def __init__(self, directory: Union[str, 'os.PathLike[str]'], max_bytes: Optional[int] = 256 * 1024 * 1024):
+        """
         Args:
-            md: An instance of `Markdown`
-            options: a dict of settings to alter the extra's behaviour
-        '''
-        self.md = md
-        self.options = options if options is not None else {}
+            directory: where to store the cache. Created if it doesn't exist
+            max_bytes: the approximate max total size of the cache, or None for no limit
+        """
+        self.directory = os.fspath(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._nbytes: Optional[int] = None
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
 
-    @classmethod
-    def deregister(cls):
-        '''
-        Removes the class from the extras registry and unsets its execution order.
-        '''
-        if cls.name in cls._registry:
-            del cls._registry[cls.name]
+    def __repr__(self):
+        return '<%s %r hits=%d misses=%d evictions=%d>' % (
+            type(self).__name__, self.directory, self.hits, self.misses, self.evictions)
 
-        for exec_order in Extra._exec_order.values():
-            # find everywhere this extra is mentioned and remove it
-            for section in exec_order:
-                while cls in section:
-                    section.remove(cls)
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.json')
 
-    @classmethod
+    def get(self, key: str) -> Optional['UnicodeWithAttrs']:
+        """Get a result, marking it as recently used. Returns None on a miss."""
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            rv = _unicode_with_attrs(entry['html'], entry.get('toc_html'), entry.get('metadata'))
+            os.utime(path)
+        except (OSError, ValueError, KeyError, TypeError):
+            # missing, or pruned/corrupted by another process
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return rv
+
+    def put(self, key: str, value: 'UnicodeWithAttrs'):
+        """Store a result, pruning the least recently used ones if over `max_bytes`."""
+        data = json.dumps({
+            'html': str(value), 'toc_html': value.toc_html, 'metadata': value.metadata
+        }).encode('utf-8')
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._entry_path(key))
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            if self._nbytes is None:
+                self._nbytes = sum(size for _, size, _ in self._entries())
+            else:
+                self._nbytes += len(data)
+            if self._nbytes > self.max_bytes:
+                self._prune()
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        with os.scandir(self.directory) as it:
+            for dir_entry in it:
+                if not dir_entry.name.endswith('.json'):
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+        return entries
+
+    def _prune(self):
+        # prune down to 90% of the limit, so that we don't prune on every write
+        assert self.max_bytes is not None
+        entries = sorted(self._entries())
+        nbytes = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if nbytes <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            nbytes -= size
+            self.evictions += 1
+        self._nbytes = nbytes
+
+    def clear(self):
+        """Remove all results. The hit, miss and eviction counts are kept."""
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            self._nbytes = 0
+
+
+_disk_caches: dict[str, DiskCache] = {}
+_disk_caches_lock = threading.Lock()
+
+
+def _get_disk_cache(cache: Union[str, 'os.PathLike[str]', DiskCache]) -> DiskCache:
+    '''Get the `DiskCache` for a `markdown_path` cache argument, re-using one per directory'''
+    if isinstance(cache, DiskCache):
+        return cache
+    directory = os.path.abspath(cache)
+    with _disk_caches_lock:
+        if directory not in _disk_caches:
+            _disk_caches[directory] = DiskCache(directory)
+        return _disk_caches[directory]
+
+
+class Timing:
+    '''The calls made to a stage or an extra's method during a conversion'''
+    __slots__ = ('calls', 'skips', 'seconds', 'chars_in', 'chars_out', '_running')
+
+    def __init__(self):
+        self.calls = 0
+        self.skips = 0
+        '''Times that a stage was skipped, as the text had none of its trigger characters. These aren't counted in `calls`'''
+        self.seconds = 0.0
+        '''Wall time spent in the calls, including anything they call. Recursive calls are only timed once'''
+        self.chars_in = 0
+        '''Total length of the text given to the calls'''
+        self.chars_out = 0
+        '''Total length of the text returned by the calls. Always 0 for `Extra.test`'''
+        self._running = 0
+
+    def __repr__(self):
+        return '<%s calls=%d skips=%d seconds=%.6f chars_in=%d chars_out=%d>' % (
+            type(self).__name__, self.calls, self.skips, self.seconds, self.chars_in, self.chars_out)
+
+
+class ConversionStats:
+    '''
+    How long each `Stage` and extra took during a conversion, for `Markdown(stats=...)`.
+
+    `timings` is keyed by the `Stage`s that ran (or were skipped) and, for the extras, by
+    their name and method, eg: `"fenced-code-blocks.run"`. The time of a stage includes the
+    extras that run before and after it. Printing the stats gives a table of them, slowest
+    first. A result that came from the `cache` has `cached` stats, with no timings.
+
+        >>> md = Markdown(extras=["fenced-code-blocks"], stats=True)
+        >>> stats = md.convert("```\\nprint('hi')\\n```\\n").stats
+        >>> stats.timings["fenced-code-blocks.run"].calls
+        1
+    '''
+    def __init__(self):
+        self.timings: dict[Union[Stage, str], Timing] = {}
+        self.started = perf_counter()
+        self.seconds = 0.0
+        '''Wall time of the whole conversion, or of looking it up in the cache'''
+        self.cached = False
+        '''Whether the result came from the cache, rather than being converted'''
+
+    def __repr__(self):
+        return '<%s timings=%d seconds=%.6f cached=%s>' % (
+            type(self).__name__, len(self.timings), self.seconds, self.cached)
+
+    def __str__(self):
+        lines = ['%-40s %8s %8s %10s %10s %10s' % ('', 'calls', 'skipped', 'ms', 'chars in', 'chars out')]
+        for key, timing in sorted(self.timings.items(), key=lambda item: -item[1].seconds):
+            lines.append('%-40s %8d %8d %10.3f %10d %10d' % (
+                key.name if isinstance(key, Stage) else key,
+                timing.calls, timing.skips, timing.seconds * 1000, timing.chars_in, timing.chars_out
+            ))
+        lines.append('%-40s %8s %8s %10.3f' % ('total (cached)' if self.cached else 'total', '', '', self.seconds * 1000))
+        return '\n'.join(lines)
+
+    def _skip(self, key: Stage):
+        timing = self.timings.get(key)
+        if timing is None:
+            timing = self.timings[key] = Timing()
+        timing.skips += 1
+
+    def _start(self, key: Union[Stage, str], text: str) -> tuple[Timing, float]:
+        timing = self.timings.get(key)
+        if timing is None:
+            timing = self.timings[key] = Timing()
+        timing.calls += 1
+        timing.chars_in += len(text)
+        timing._running += 1
+        return timing, perf_counter()
+
+    def _stop(self, timing: Timing, started: float, result: Any):
+        timing._running -= 1
+        if not timing._running:
+            timing.seconds += perf_counter() - started
+        if isinstance(result, str):
+            timing.chars_out += len(result)
+
+    def _timed(self, key: str, method: Callable[..., Any], returns_text: bool) -> Callable[..., Any]:
+        '''Wrap an extra's `test` or `run` method (as used in a plan) to time its calls'''
+        def timed(extra: 'Extra', text: str, *args):
+            timing, started = self._start(key, text)
+            result = method(extra, text, *args)
+            self._stop(timing, started, result if returns_text else None)
+            return result
+        return timed
+
+    def _timed_plan(
+        self,
+        plan: dict[Stage, tuple[tuple['_PlannedExtra', ...], tuple['_PlannedExtra', ...]]],
+        instances: tuple['Extra', ...]
+    ) -> dict[Stage, tuple[tuple['_PlannedExtra', ...], tuple['_PlannedExtra', ...]]]:
+        '''A copy of a document's plan of extras (see `Markdown._extras_plan`) that times them'''
+        timed = {}
+
+        def time_extras(extras: tuple['_PlannedExtra', ...]) -> tuple['_PlannedExtra', ...]:
+            planned = []
+            for triggers, index, test, run, takes_test_result in extras:
+                name = instances[index].name
+                planned.append((
+                    triggers, index, self._timed(name + '.test', test, False),
+                    self._timed(name + '.run', run, True), takes_test_result
+                ))
+            return tuple(planned)
+
+        for stage, (before, after) in plan.items():
+            timed[stage] = (time_extras(before), time_extras(after))
+        return timed
+
+
+# Block level conversion
+# ----------------------------------------------------------
+
+class Node:
+    '''
+    A block of a document parsed by `Markdown.parse`. `start` and `end` are the offsets of
+    the block within `Document.text`, which `Document.source` gives the text of.
+
+    The kinds of node and what `info` holds for them are:
+
+    - "header": the level of the header (1 to 6)
+    - "paragraph", "hr", "quote" and "html" (an HTML block or comment): nothing
+    - "code": the language of a fenced code block, if it has one
+    - "list" and "item": the marker of the (first) list item, eg: "-" or "1."
+    - "definition": a link definition's `(id, url, title)`
+    - "footnote": the id of a footnote definition
+
+    Lists have items as children, and the children of items, blockquotes and footnotes are
+    the blocks within them. Everything else is a leaf, with any inline markup left as text.
+    '''
+    __slots__ = ('kind', 'start', 'end', 'info', 'children')
+
+    def __init__(self, kind: str, start: int, end: int, info: Any = None, children: tuple['Node', ...] = ()):
+        self.kind = kind
+        self.start = start
+        self.end = end
+        self.info = info
+        self.children = children
+
+    def __repr__(self):
+        return '<%s %s %d:%d%s>' % (
+            type(self).__name__, self.kind, self.start, self.end, '' if self.info is None else ' %r' % (self.info,)
+        )
+
+    def walk(self) -> Iterator['Node']:
+        '''Iterate over this node and all of the nodes below it, depth first'''
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+class Document:
+    '''
+    The block structure of a document, as returned by `Markdown.parse`. It can be inspected,
+    pickled and rendered (possibly by a `Markdown` instance with other options) with
+    `Markdown.render`, which gives the same HTML as `Markdown.convert`.
+
+        >>> md = Markdown()
+        >>> doc = md.parse("# Title\\n\\nSome *text*\\n")
+        >>> doc.children
+        (<Node header 0:7 1>, <Node paragraph 9:20>)
+        >>> doc.source(doc.children[1])
+        'Some *text*'
+        >>> str(md.render(doc))
+        '<h1>Title</h1>\\n\\n<p>Some <em>text</em></p>\\n'
+    '''
+    __slots__ = ('text', 'children', 'metadata', 'blocks', '_split_by')
+
+    def __init__(self, text: str, children: tuple[Node, ...], metadata: Optional[dict[str, Any]] = None):
+        self.text = text
+        '''
+        The text of the document that the nodes point into, with its line endings normalised,
+        its tabs expanded and its metadata (if the `metadata` extra is used) taken out
+        '''
+        self.children = children
+        self.metadata = metadata if metadata is not None else {}
+        self.blocks: tuple[tuple[int, int], ...] = ()
+        '''
+        The `(start, end)` offsets of the top level blocks of the text, which convert the same
+        way on their own as they do together (see `_BlockSplitter`). Each holds one or more of
+        the `children`, and runs from its first line to the end of its last non-blank line
+        '''
+        self._split_by: Optional[tuple] = None
+        '''The options that the blocks were found with (see `_BlockSplitter.options`)'''
+
+    def __repr__(self):
+        return '<%s of %d blocks>' % (type(self).__name__, len(self.children))
+
+    def source(self, node: Node) -> str:
+        '''Get the text of a node'''
+        return self.text[node.start:node.end]
+
+    def walk(self) -> Iterator[Node]:
+        '''Iterate over all of the nodes of the document, depth first'''
+        for child in self.children:
+            yield from child.walk()
+
+    def _block_sources(self, chunk_size: int = 0) -> list[str]:
+        '''
+        Get the text of each block, the same as `_BlockSplitter.split` would give it, with
+        consecutive blocks joined up into pieces of at least `chunk_size` characters
+        '''
+        text = self.text
+        sources = []
+        start = None
+        for block_start, end in self.blocks:
+            if start is None:
+                start = block_start
+            if end - start >= chunk_size:
+                sources.append(text[start:end] + '\n\n')
+                start = None
+        if start is not None:
+            sources.append(text[start:self.blocks[-1][1]] + '\n\n')
+        if sources:
+            sources[-1] = sources[-1][:-2] + text[len(text.rstrip('\n')):]
+        return sources
+
+
+class _TreeBuilder:
+    '''
+    Finds the block structure of prepared text (see `Markdown._prepare_text`) for `Markdown.parse`,
+    following the same rules as the block gamut. The text is split into top level blocks by a
+    `_BlockSplitter`, the same as for `IncrementalMarkdown`, and then the nodes are found within
+    each of those. Works on `(line, offset)` pairs, where `offset` is the position of the line
+    within the whole text, so that the lines within blockquotes and list items can have their
+    markers stripped and still give the right positions.
+    '''
+    _fence_re = re.compile(r'[ \t]*(`{3,})[ \t]*([\w+-]*)[ \t]*$')
+    _quote_re = re.compile(r'[ \t]*>[ \t]?')
+    _setext_underline_re = re.compile(r'(=+|-+)[ \t]*')
+    _atx_re = re.compile(r'(\#{1,6})[ \t]*(.+?)[ \t]{0,99}(?<!\\)\#*')
+    _atx_re_tag_friendly = re.compile(r'(\#{1,6})[ \t]+(.+?)[ \t]{0,99}(?<!\\)\#*')
+    _marker_res = (re.compile(r'[*+-][ \t]'), re.compile(r'\d+\.[ \t]'))
+    '''Unordered and ordered list item markers, for finding where a list ends'''
+
+    def __init__(self, md: Markdown):
+        self._md = md
+        self._tab = md.tab
+        self._atx_re = self._atx_re_tag_friendly if 'tag-friendly' in md.extras else self._atx_re
+        self._list_start_res = _list_start_res_from_tab_width(md.tab_width)
+        self._html_re = re.compile(r'<(%s)\b' % md._block_tags_a)
+        self._outdent_re = re.compile(r'\t|[ ]{1,%d}' % md.tab_width)
+        self._footnote_re = re.compile(r'[ ]{0,%d}\[\^(.+)\]:[ \t]*' % (md.tab_width - 1))
+        self._fences = 'fenced-code-blocks' in md.extras
+        self._footnotes = 'footnotes' in md.extras
+        self._cuddled = 'cuddled-lists' in md.extras
+
+    def build(self, text: str) -> tuple[Node, ...]:
+        '''Get the top level nodes of the text, noting the offsets of its top level blocks in `blocks`'''
+        splitter = _BlockSplitter(self._md)
+        self.blocks: list[tuple[int, int]] = []
+        nodes: list[Node] = []
+        lines: list[tuple[str, int]] = []
+        offset = 0
+        for line in text.split('\n'):
+            if splitter.feed(line) is not None:
+                self._add_block(lines)
+                nodes.extend(self._blocks(lines, False))
+                lines = []
+            lines.append((line, offset))
+            offset += len(line) + 1
+        self._add_block(lines)
+        nodes.extend(self._blocks(lines, False))
+        return tuple(nodes)
+
+    def _add_block(self, lines: list[tuple[str, int]]):
+        end = len(lines)
+        while end and not lines[end - 1][0]:
+            end -= 1
+        if end:
+            last, offset = lines[end - 1]
+            self.blocks.append((lines[0][1], offset + len(last)))
+
+    def _blocks(self, lines: list[tuple[str, int]], in_list: bool) -> tuple[Node, ...]:
+        '''
+        Args:
+            lines: the lines to find the blocks in
+            in_list: whether the lines are within a list item, where sub-lists needn't
+                follow a blank line
+        '''
+        nodes: list[Node] = []
+        i = 0
+        while i < len(lines):
+            if lines[i][0].strip():
+                previous = nodes[-1].kind if nodes and nodes[-1].end >= lines[i - 1][1] else None
+                i, node = self._block(lines, i, in_list, previous)
+                nodes.append(node)
+            else:
+                i += 1
+        return tuple(nodes)
+
+    def _block(self, lines: list[tuple[str, int]], i: int, in_list: bool, previous: Optional[str]) -> tuple[int, Node]:
+        '''
+        Get the block that starts at `lines[i]`, and the index of the line after it.
+        `previous` is the kind of the block that ends on the line before, if there is one.
+        '''
+        line, offset = lines[i]
+        # headers, rules and HTML blocks end up with blank lines around them and
+        # definitions get taken out, so anything can follow them
+        after_blank = (
+            i == 0 or not lines[i - 1][0].strip() or previous in ('header', 'hr', 'html', 'definition')
+        )
+
+        fence_end = self._fence_end(lines, i)
+        if fence_end:
+            return fence_end, self._node('code', lines, i, fence_end, self._fence_re.match(line).group(2) or None)
+
+        if line.startswith('<!--'):
+            end = i
+            while end + 1 < len(lines) and '-->' not in lines[end][0]:
+                end += 1
+            return end + 1, self._node('html', lines, i, end + 1)
+        html = self._html_re.match(line)
+        if html:
+            # the block runs to the closing tag or, if there isn't one, to the next blank line
+            closing = '</%s' % html.group(1)
+            for end in range(i, len(lines)):
+                if closing in lines[end][0].lower():
+                    break
+            else:
+                end = i
+                while end + 1 < len(lines) and lines[end + 1][0].strip():
+                    end += 1
+            return end + 1, self._node('html', lines, i, end + 1)
+
+        if self._footnotes:
+            footnote = self._footnote_re.match(line)
+            if footnote:
+                end = self._indented_end(lines, i + 1)
+                content = [(line[footnote.end():], offset + footnote.end())]
+                content.extend(self._outdented(lines[i + 1:end]))
+                return end, Node(
+                    'footnote', offset, self._end_of(lines, i, end), footnote.group(1), self._blocks(content, False)
+                )
+
+        definition = self._md._link_def_re.match('\n'.join(line for line, _ in lines[i:i + 3]) + '\n')
+        if definition:
+            end = i + definition.group(0).rstrip('\n').count('\n') + 1
+            return end, self._node('definition', lines, i, end, definition.groups())
+
+        if self._atx_re.fullmatch(line):
+            return i + 1, self._node('header', lines, i, i + 1, len(line) - len(line.lstrip('#')))
+        underline = self._setext_underline(lines, i)
+        if underline:
+            return i + 2, self._node('header', lines, i, i + 2, 1 if underline[0] == '=' else 2)
+        if self._md._hr_re.match(line):
+            return i + 1, self._node('hr', lines, i, i + 1)
+
+        if after_blank or in_list or previous == 'list' or (self._cuddled and previous == 'paragraph'):
+            list_start = self._list_start(line)
+            if list_start:
+                return self._list(lines, i, list_start)
+
+        if after_blank and line.startswith((self._tab, '\t')):
+            end = self._indented_end(lines, i + 1)
+            return end, self._node('code', lines, i, end)
+
+        if self._is_quote(line):
+            end = i + 1
+            while end < len(lines) and lines[end][0].strip():
+                end += 1
+            content = []
+            for quoted, quoted_offset in lines[i:end]:
+                marker = self._quote_re.match(quoted)
+                if marker:
+                    content.append((quoted[marker.end():], quoted_offset + marker.end()))
+                else:
+                    content.append((quoted, quoted_offset))
+            return end, Node('quote', offset, self._end_of(lines, i, end), None, self._blocks(content, False))
+
+        end = i + 1
+        while end < len(lines) and lines[end][0].strip() and not self._interrupts(lines, end, in_list):
+            end += 1
+        return end, self._node('paragraph', lines, i, end)
+
+    def _interrupts(self, lines: list[tuple[str, int]], i: int, in_list: bool) -> bool:
+        '''Whether `lines[i]` starts a new block rather than carrying on a paragraph'''
+        line = lines[i][0]
+        return bool(
+            self._atx_re.fullmatch(line) or self._setext_underline(lines, i) or self._md._hr_re.match(line)
+            or self._is_quote(line) or ((in_list or self._cuddled) and self._list_start(line))
+            or self._fence_end(lines, i)
+        )
+
+    @staticmethod
+    def _is_quote(line: str) -> bool:
+        '''Whether a line starts a blockquote, which needs something after the `>`'''
+        line = line.lstrip(' \t')
+        return line[:1] == '>' and len(line) > 1
+
+    def _fence_end(self, lines: list[tuple[str, int]], i: int) -> Optional[int]:
+        '''The end of the fenced code block that starts at `lines[i]`, if there is one'''
+        fence = self._fence_re.match(lines[i][0]) if self._fences else None
+        if fence:
+            closing = re.compile(r'[ \t]*%s`*[ \t]*$' % fence.group(1))
+            for end in range(i + 1, len(lines)):
+                if closing.match(lines[end][0]):
+                    return end + 1
+        return None
+
+    def _setext_underline(self, lines: list[tuple[str, int]], i: int) -> Optional[str]:
+        '''The underline of a setext header at `lines[i]`, if there is one'''
+        if i + 1 < len(lines):
+            underline = self._setext_underline_re.fullmatch(lines[i + 1][0])
+            if underline and underline.group(1) != '-':
+                return underline.group(1)
+        return None
+
+    def _list_start(self, line: str) -> Optional[re.Match[str]]:
+        for list_start_re in self._list_start_res:
+            match = list_start_re.match(line)
+            if match:
+                return match if line[match.end():].strip() else None
+        return None
+
+    def _list(self, lines: list[tuple[str, int]], i: int, start: re.Match[str]) -> tuple[int, Node]:
+        '''
+        Get the list that starts at `lines[i]`. It carries on until a blank line is followed by an
+        unindented line that isn't an item of the same type, or until an item of the other type.
+        '''
+        ordered = start.group(2)[0].isdigit()
+        same_re, other_re = self._marker_res[ordered], self._marker_res[not ordered]
+        indent = start.group(1)
+        item_starts = [(i, start)]
+        end = i + 1
+        while end < len(lines):
+            line = lines[end][0]
+            if not line.strip():
+                after = end + 1
+                while after < len(lines) and not lines[after][0].strip():
+                    after += 1
+                if after == len(lines):
+                    break
+                line = lines[after][0]
+                if not line[0].isspace() and not same_re.match(line):
+                    break
+                end = after
+            if line.startswith(indent) and other_re.match(line, len(indent)):
+                break
+            if line.startswith(indent) and not line[len(indent):len(indent) + 1].isspace():
+                item = self._list_start(line)
+                if item and same_re.match(line, len(indent)):
+                    item_starts.append((end, item))
+            end += 1
+
+        items = []
+        for index, (item_start, marker) in enumerate(item_starts):
+            item_end = item_starts[index + 1][0] if index + 1 < len(item_starts) else end
+            line, offset = lines[item_start]
+            content = [(line[marker.end():], offset + marker.end())]
+            content.extend(self._outdented_item(lines[item_start + 1:item_end]))
+            items.append(Node(
+                'item', offset + len(marker.group(1)), self._end_of(lines, item_start, item_end),
+                marker.group(2), self._blocks(content, True)
+            ))
+        return end, Node('list', items[0].start, items[-1].end, start.group(2), tuple(items))
+
+    def _indented_end(self, lines: list[tuple[str, int]], i: int) -> int:
+        '''The end of the indented (or blank) lines from `lines[i]`, leaving out any blank lines at the end'''
+        end = i
+        for index in range(i, len(lines)):
+            line = lines[index][0]
+            if line.startswith((self._tab, '\t')):
+                end = index + 1
+            elif line.strip():
+                break
+        return end
+
+    def _outdented(self, lines: list[tuple[str, int]]) -> list[tuple[str, int]]:
+        '''Remove one level of indentation from lines'''
+        outdented = []
+        for line, offset in lines:
+            indent = self._outdent_re.match(line)
+            if indent:
+                outdented.append((line[indent.end():], offset + indent.end()))
+            else:
+                outdented.append((line, offset))
+        return outdented
+
+    def _outdented_item(self, lines: list[tuple[str, int]]) -> list[tuple[str, int]]:
+        '''
+        Remove the smallest common indentation from the lines of a list item after the first,
+        as `Markdown._list_item_sub` does. Items with blank lines in them are only outdented
+        by up to a tab.
+        '''
+        indents = [len(line) - len(line.lstrip(' ')) for line, _ in lines if line.strip()]
+        indents = [indent for indent in indents if indent]
+        if not indents:
+            return lines
+        width = min(indents)
+        if any(not line.strip() for line, _ in lines):
+            width = min(width, self._md.tab_width)
+        outdented = []
+        for line, offset in lines:
+            indent = min(width, len(line) - len(line.lstrip(' ')))
+            outdented.append((line[indent:], offset + indent))
+        return outdented
+
+    @staticmethod
+    def _end_of(lines: list[tuple[str, int]], start: int, end: int) -> int:
+        '''The offset of the end of the last non-blank line of `lines[start:end]`'''
+        end -= 1
+        while end > start and not lines[end][0].strip():
+            end -= 1
+        line, offset = lines[end]
+        return offset + len(line)
+
+    def _node(self, kind: str, lines: list[tuple[str, int]], start: int, end: int, info: Any = None) -> Node:
+        return Node(kind, lines[start][1], self._end_of(lines, start, end), info)
+
+
+class _BlockSplitter:
+    '''
+    Splits prepared text (see `Markdown._prepare_text`) into top level blocks that
+    convert the same way on their own as they do as part of the whole document. Used for
+    `IncrementalMarkdown`, streaming conversions and `Markdown.parse`.
+
+    A new block starts at the first unindented line after a blank line, unless that line
+    is a list item or a link definition, or the block so far has an HTML block, fenced code
+    block or HTML comment that hasn't been closed. Blocks are also kept together where
+    stripping a definition would join them up. Lines are fed in one at a time so that the
+    text can arrive in pieces.
+
+    HTML that `Markdown._hash_html_blocks` never sees the end of (eg: a line that starts
+    with `<img>`) affects how the rest of the document is hashed, so stops any more
+    blocks from being split off. So does a block quote when the pyshell or alerts extras
+    are on.
+    '''
+    _fence_re = re.compile(r'([ \t]*`{3,})[ \t]*[\w+-]*[ \t]*$')
+    _list_item_re = re.compile(r'(?:[*+-]|\d+\.)[ \t]')
+    _empty_item_re = re.compile(r'[ \t]*(?:[*+-]|\d+\.)[ \t]*$')
+    _underline_re = re.compile(r'(?:=+|-+)[ \t]*$')
+
+    def __init__(self, md: Markdown, in_list: bool = False):
+        '''
+        Args:
+            md: the document the text is from
+            in_list: whether the text is inside a list item, where sub-lists needn't follow a blank line
+        '''
+        self._md = md
+        self._in_list = in_list
+        self._definition_re = re.compile(r'[ ]{0,%d}\[.+\]:' % (md.tab_width - 1))
+        self._comment_re = re.compile(r'[ ]{0,%d}<!--' % (md.tab_width - 1))
+        self._liberal_re = re.compile(r'<(%s)\b' % md._block_tags_b)
+        self._fences_first = 'fenced-code-blocks' in md.extras and not md.safe_mode
+        self._tables = 'tables' in md.extras
+        # pyshell turns `>>>` lines into code blocks after block quotes are found, and an alert
+        # can run on into a later block quote, so neither can be split away from a block quote
+        self._quotes_run_on = 'pyshell' in md.extras or 'alerts' in md.extras
+        self.lines: list[str] = []
+        self._started = False
+        '''Whether the block has any non-blank lines'''
+        self._blank = False
+        self._gap = False
+        '''Whether the last line was a header, horizontal rule or closing fence, which end up with a blank line after them'''
+        self._fence: Optional[str] = None
+        '''The opening marker of the fenced code block we're in'''
+        self._liberal_tag: Optional[str] = None
+        '''The tag of the HTML block (as found by `Markdown._liberal_tag_block_sub`) we're in'''
+        self._comment = False
+        self._definition = False
+        '''Whether the block (so far) ends with a definition that follows other text'''
+        self._definition_end = 0
+        self._empty_definition = False
+        '''Whether the last non-blank line is a definition with nothing after the `]:`'''
+        self._quote = False
+        '''Whether the block has a block quote'''
+        self._table_underline = False
+        self._unsplittable = False
+        '''
+        Set when something affects how the rest of the document is converted. Eg: an HTML
+        comment that doesn't start a line after a blank line, which stops
+        `Markdown._hash_html_blocks` from looking for any more comments in the document
+        '''
+        # the state of each `Markdown._strict_tag_block_sub` call made on the whole document,
+        # as `[tag_count, current_tag, tags, allow_indent]`
+        self._strict: list[list[Any]] = [
+            [0, md._block_tags_a, md._block_tags_a, False],
+            [0, md._span_tags, md._span_tags, False]
+        ]
+        if 'markdown-in-html' in md.extras:
+            self._strict.append([0, md._block_tags_a, md._block_tags_a, True])
+
+    @property
+    def _in_html(self) -> bool:
+        return self._liberal_tag is not None or any(state[0] for state in self._strict)
+
+    @property
+    def is_open(self) -> bool:
+        '''Whether the current block can't be finished yet, regardless of the next line'''
+        return (
+            self._fence is not None or self._comment or self._definition or self._empty_definition
+            or self._table_underline or self._unsplittable or self._in_html
+        )
+
+    def feed(self, line: str) -> Optional[str]:
+        '''
+        Add a line (without its trailing newline) to the current block.
+
+        Returns:
+            The finished previous block (with a blank line at the end), if this line starts a new one
+        '''
+        block = None
+        if (
+            self._blank and line and line[0] not in ' \t' and self._started and not self.is_open
+            and not self._list_item_re.match(line) and not self._definition_re.match(line)
+        ):
+            block = self.flush()
+
+        previous_blank = self._blank
+        after_gap = previous_blank or self._gap
+        self._blank = not line
+        self._gap = False
+        self.lines.append(line)
+        if not line:
+            return block
+        self._started = True
+
+        # both the opening and closing lines of a fenced code block have a ```
+        fence = '```' in line
+        if self._fences_first:
+            # fenced code blocks are converted before raw HTML is hashed, hiding any HTML within them
+            if self._fence is not None:
+                if fence and line.rstrip(' \t').endswith(self._fence):
+                    self._fence = None
+                    self._gap = True
+                return block
+            match = self._fence_re.match(line) if fence else None
+            if match:
+                self._fence = match.group(1)
+                if self._quote and after_gap and line[0] in ' \t':
+                    # an indented fence is left indented when it's hashed, so is a code block too
+                    self._unsplittable = True
+                return block
+            if '<' in line:
+                self._scan_html(line, previous_blank)
+        else:
+            # raw HTML is hashed before code blocks are found, hiding any fences within it
+            in_html = fence and self._in_html
+            if '<' in line:
+                self._scan_html(line, previous_blank)
+                in_html = in_html or (fence and self._in_html)
+            if fence and not in_html:
+                if self._fence is not None:
+                    if line.rstrip(' \t').endswith(self._fence):
+                        self._fence = None
+                        self._gap = True
+                else:
+                    match = self._fence_re.match(line)
+                    if match:
+                        self._fence = match.group(1)
+
+        if self._tables:
+            # a table's underline row can be followed by a blank line
+            self._table_underline = '|' in line and '-' in line and not line.strip(' |:-')
+
+        match = self._definition_re.match(line) if ']:' in line else None
+        if match:
+            self._definition = self._definition or (len(self.lines) > 1 and not previous_blank)
+            # the URL or title of a link definition can be on the next line
+            self._definition_end = len(self.lines) + 1
+            # and the text of a footnote can start after any number of blank lines
+            self._empty_definition = not line[match.end():].strip()
+        elif self._empty_definition:
+            self._empty_definition = False
+            self._definition_end = len(self.lines) + 1
+        elif line[0] not in ' \t' and len(self.lines) > self._definition_end:
+            self._definition = False
+
+        if line[-1] in ' \t*+-.' and self._empty_item_re.match(line):
+            # the content of a list item that starts with an empty line can come after a blank
+            # line, and then what follows the list can depend on how it turned out
+            self._unsplittable = True
+        elif self._quote and after_gap and line[0] in ' \t':
+            # the blank lines either side of a code block are removed before block quotes are
+            # found, so a block quote followed by a code block runs on into whatever is next
+            self._unsplittable = True
+        elif self._quote and self._in_list and self._list_item_re.match(line.lstrip(' \t')):
+            # and so can one followed by a sub-list
+            self._unsplittable = True
+        elif not self._quote:
+            self._quote = '>' in line and line.lstrip(' \t').startswith('>')
+            if self._quote and self._quotes_run_on:
+                self._unsplittable = True
+        if self._quote and not self._gap:
+            self._gap = bool(line[0] == '#' or self._underline_re.match(line) or self._md._hr_re.match(line))
+        return block
+
+    def _scan_html(self, line: str, previous_blank: bool):
+        '''Follow the HTML blocks and comments in a line the same way `Markdown._hash_html_blocks` would'''
+        for state in self._strict:
+            tag_count, current_tag, tags, allow_indent = state
+            is_markup = _html_tag_line_re(current_tag, allow_indent).match(line)
+            if is_markup:
+                if line.startswith('</', is_markup.end(1)):
+                    tag_count -= 1
+                elif not (is_markup.group(3) in self._md._void_tags or self._md._tag_is_closed(is_markup.group(3), line)):
+                    tag_count += 1
+                    current_tag = is_markup.group(3)
+            if tag_count == 0:
+                current_tag = tags
+            state[0], state[1] = tag_count, current_tag
+
+        if self._liberal_tag is None:
+            match = self._liberal_re.match(line)
+            if match:
+                self._liberal_tag = match.group(1)
+        if self._liberal_tag is not None and re.search(r'</%s>[ \t]*$' % self._liberal_tag, line):
+            self._liberal_tag = None
+
+        if '<!--' in line and (
+            (self.lines[:-1] and not previous_blank) or not self._comment_re.match(line)
+            or line.count('<!--') > 1
+        ):
+            self._unsplittable = True
+        if self._comment:
+            if '-->' not in line:
+                return
+            self._comment = False
+            line = line.split('-->', 1)[1]
+        if '<!--' in line:
+            self._comment = '-->' not in line.rsplit('<!--', 1)[1]
+
+    def copy(self) -> '_BlockSplitter':
+        '''Get a copy that can be fed more lines without affecting this one'''
+        splitter = object.__new__(type(self))
+        splitter.__dict__.update(self.__dict__)
+        splitter.lines = list(self.lines)
+        splitter._strict = [list(state) for state in self._strict]
+        return splitter
+
+    def flush(self) -> str:
+        '''Finish the current block and start a new one'''
+        lines = self.lines
+        while lines and not lines[-1]:
+            lines.pop()
+        block = '\n'.join(lines) + '\n\n' if lines else ''
+        self.lines = []
+        self._started = self._blank = self._quote = False
+        self._definition_end = 0
+        return block
+
+    @staticmethod
+    def options(md: Markdown) -> tuple:
+        '''The options of `md` that decide where its text is split'''
+        return (
+            md.tab_width, 'fenced-code-blocks' in md.extras and not md.safe_mode, 'tables' in md.extras,
+            'pyshell' in md.extras or 'alerts' in md.extras, 'markdown-in-html' in md.extras,
+            md._block_tags_a, md._block_tags_b, md._span_tags, md._void_tags, md._hr_re.pattern
+        )
+
+    @classmethod
+    def split(cls, md: Markdown, text: str) -> list[str]:
+        '''
+        Split prepared text into its (non-empty) top level blocks, each ending in a blank
+        line except for the last, which keeps the newlines at the end of `text`.
+        '''
+        splitter = cls(md)
+        blocks = []
+        for line in text.split('\n'):
+            block = splitter.feed(line)
+            if block:
+                blocks.append(block)
+        block = splitter.flush()
+        if block:
+            # `Markdown._detab` can leave the text with just the one newline at the end
+            blocks.append(block[:-2] + text[len(text.rstrip('\n')):])
+        return blocks
+
+
+_MISSING: Any = object()
+
+
+class _LookupRecorder(Mapping):
+    '''
+    A read-only view of a dict that records each key that is looked up,
+    along with the value found (or `_MISSING`).
+    '''
+    def __init__(self, data: dict):
+        self._data = data
+        self.lookups: dict[str, Any] = {}
+        self.iterated = False
+
+    def __getitem__(self, key):
+        value = self.lookups[key] = self._data.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        value = self.lookups[key] = self._data.get(key, _MISSING)
+        return value is not _MISSING
+
+    def __iter__(self):
+        self.iterated = True
+        return iter(self._data)
+
+    def __len__(self):
+        self.iterated = True
+        return len(self._data)
+
+
+class _JournaledCounts(defaultdict):
+    '''
+    The header id counts of a document (see `Markdown.header_id_from_text`), noting the
+    previous value of each count that changes so that the changes can be undone.
+    '''
+    def __init__(self):
+        super().__init__(int)
+        self.journal: dict[str, Any] = {}
+
+    def __setitem__(self, key, value):
+        if key not in self.journal:
+            self.journal[key] = dict.get(self, key, _MISSING)
+        super().__setitem__(key, value)
+
+    def copy(self) -> '_JournaledCounts':
+        counts = _JournaledCounts()
+        dict.update(counts, self)
+        return counts
+
+
+class _JournaledSet(set):
+    '''A set that notes each item added to it so that the additions can be undone'''
+    def __init__(self):
+        super().__init__()
+        self.journal: list = []
+
+    def add(self, item):
+        if item not in self:
+            self.journal.append(item)
+            super().add(item)
+
+    def copy(self) -> '_JournaledSet':
+        items = _JournaledSet()
+        set.update(items, self)
+        return items
+
+
+class _Block:
+    '''The definitions and (once rendered) the HTML of a single top level block'''
+    __slots__ = (
+        'source', 'text', 'doc', 'urls', 'titles', 'footnotes', 'hashed',
+        'html', 'lookups', 'header_key', 'header_effect', 'nested_headers'
+    )
+
+    def __init__(self, source: str):
+        self.source = source
+        self.html: Optional[str] = None
+        self.lookups: Optional[tuple[dict[str, Any], ...]] = None
+        self.header_key: Any = None
+        self.header_effect: Optional[tuple] = None
+        self.nested_headers = False
+        '''
+        Whether the block has headers that get ids from within a nested block (eg: a list
+        item), which a full conversion would give ids after every top level header
+        '''
+
+    @property
+    def has_definitions(self) -> bool:
+        return bool(self.urls or self.titles or self.footnotes)
+
+    @property
+    def has_missing_lookups(self) -> bool:
+        '''Whether the block refers to a link or footnote that isn't defined (yet)'''
+        return self.lookups is None or any(_MISSING in lookups.values() for lookups in self.lookups)
+
+
+class _BlockRenderer:
+    '''
+    Converts a document one top level block at a time, so that blocks which haven't
+    changed (and don't depend on anything that has) can re-use their previous HTML.
+
+    Each block's link and footnote definitions are stripped out on their own, and then
+    every block is rendered against the definitions of the whole document. A block is
+    re-rendered if any of the definitions it looked up have changed or, if it has headers
+    that get ids, if the headers before it have changed.
+    '''
+    def __init__(self, md: Markdown):
+        self.md = md
+        self.use_footnotes = 'footnotes' in md.extras
+        self.use_header_ids = 'header-ids' in md.extras
+        self._placeholder_ids = count(_FIRST_PLACEHOLDER)
+        self.start()
+
+    @staticmethod
+    def supports(md: Markdown) -> bool:
+        '''
+        Whether the output of `md` can be worked out block by block. Extras that number
+        things across the whole document, options that change the extras per document and
+        hooks that see the whole document all need a full conversion.
+        '''
+        if md.use_file_vars or 'numbering' in md.extras:
+            return False
+        header_ids = md.extras.get('header-ids')
+        if header_ids is not None and (header_ids.get('mixed') or not header_ids.get('reset-count', False)):
+            return False
+        cls = type(md)
+        if cls.preprocess is not Markdown.preprocess or cls.postprocess is not Markdown.postprocess:
+            return False
+        if md._extras_order.get(Stage.LINK_DEFS, _NO_EXTRAS)[1]:
+            # eg: `markdown-file-links`, which rewrites the link definitions of the whole document
+            return False
+        return not any(stage in md._extras_order for stage in (Stage.POSTPROCESS, Stage.UNHASH_HTML))
+
+    def start(self):
+        '''Start a new document'''
+        self.urls: dict[str, str] = {}
+        self.titles: dict[str, str] = {}
+        self.footnotes: OrderedDict[str, str] = OrderedDict()
+        self.hashed = self.new_document()
+        '''A document with the text hashed by the blocks with definitions, which other blocks may use'''
+        self.header_counts = _JournaledCounts()
+        self.header_ids_seen = _JournaledSet()
+        self.toc: list[tuple[int, str, str]] = []
+        self.header_key: Any = None
+        self.converted = 0
+        '''The number of blocks rendered (rather than re-used) since the document was started'''
+        self._undo: Optional[tuple] = None
+
+    def copy(self) -> '_BlockRenderer':
+        '''Get a copy of the document so far that can carry on without affecting this one'''
+        renderer = object.__new__(type(self))
+        renderer.__dict__.update(self.__dict__)
+        renderer.urls = dict(self.urls)
+        renderer.titles = dict(self.titles)
+        renderer.footnotes = OrderedDict(self.footnotes)
+        renderer.hashed = self.new_document()
+        renderer.hashed._take_hashes(self.hashed)
+        renderer.header_counts = self.header_counts.copy()
+        renderer.header_ids_seen = self.header_ids_seen.copy()
+        renderer.toc = list(self.toc)
+        return renderer
+
+    def new_document(self) -> Markdown:
+        '''
+        Get a new document to convert (part of) the text with. The hashed HTML of the blocks
+        gets mixed together, so all of the documents number their placeholders from one counter
+        '''
+        return self.md._new_document(self._placeholder_ids)
+
+    def prepare(self, source: str) -> _Block:
+        '''Hash the raw HTML of a block and strip out its definitions'''
+        block = _Block(source)
+        doc = self.new_document()
+        block.text = doc._hash_and_strip_definitions(source)
+        block.doc = doc
+        block.urls = doc.urls
+        block.titles = doc.titles
+        block.footnotes = doc.footnotes if self.use_footnotes else {}
+        if block.has_definitions:
+            # definitions are used by other blocks, so hold on to any text they hashed
+            block.hashed = doc
+        return block
+
+    def define(self, block: _Block):
+        '''Add the definitions of a block to the document'''
+        self.urls.update(block.urls)
+        self.titles.update(block.titles)
+        self.footnotes.update(block.footnotes)
+        if block.has_definitions:
+            self.hashed._take_hashes(block.hashed)
+
+    def is_current(self, block: _Block) -> bool:
+        '''Whether the previously rendered HTML of a block is still valid'''
+        if block.html is None or block.lookups is None:
+            return False
+        if block.header_effect is not None and block.header_key != self.header_key:
+            return False
+        for lookups, data in zip(block.lookups, (self.urls, self.titles, self.footnotes)):
+            for key, value in lookups.items():
+                if data.get(key, _MISSING) != value:
+                    return False
+        return True
+
+    def render(self, block: _Block) -> str:
+        '''Get the HTML of a block, re-using the previous HTML if it's still valid'''
+        counts, seen = self.header_counts, self.header_ids_seen
+        counts.journal = {}
+        seen.journal = []
+        toc_count = len(self.toc)
+        self._undo = (counts.journal, seen.journal, toc_count, self.header_key)
+
+        if self.is_current(block):
+            if block.header_effect is not None:
+                for key, value in block.header_effect[0]:
+                    counts[key] = value
+                for header_id in block.header_effect[1]:
+                    seen.add(header_id)
+                self.toc.extend(block.header_effect[2])
+                self.header_key = hash((self.header_key, block.header_effect))
+            return cast(str, block.html)
+
+        self.converted += 1
+        doc = getattr(block, 'doc', None)
+        if doc is None:
+            # the text has to be hashed again along with the rest of the document state
+            prepared = self.prepare(block.source)
+            doc, block.text = prepared.doc, prepared.text
+        block.doc = None
+
+        recorders = (_LookupRecorder(self.urls), _LookupRecorder(self.titles), _LookupRecorder(self.footnotes))
+        doc.urls, doc.titles = recorders[0], recorders[1]  # type: ignore
+        if self.use_footnotes:
+            doc.footnotes = recorders[2]
+        doc._take_hashes(self.hashed)
+        doc._count_from_header_id = counts
+        doc._header_ids_seen = seen
+        doc._toc = self.toc
+        if self.use_header_ids:
+            nested = self._track_nested_headers(doc)
+
+        if block.text.strip():
+            block.html = doc._finish_html(doc._run_block_gamut(block.text))
+        else:
+            # nothing but definitions
+            block.html = ''
+        block.nested_headers = self.use_header_ids and bool(nested)
+
+        if any(recorder.iterated for recorder in recorders):
+            block.lookups = None
+        else:
+            block.lookups = tuple(recorder.lookups for recorder in recorders)
+        if seen.journal or len(self.toc) != toc_count or '<h' in block.html:
+            block.header_key = self.header_key
+            block.header_effect = (
+                tuple((k, counts[k]) for k, v in counts.journal.items() if counts[k] != v),
+                tuple(seen.journal),
+                tuple(self.toc[toc_count:])
+            )
+            self.header_key = hash((self.header_key, block.header_effect))
+        else:
+            block.header_effect = None
+        return block.html
+
+    @staticmethod
+    def _track_nested_headers(doc: Markdown) -> list[str]:
+        '''
+        Make `doc` note the text of each header that gets an id below the top level
+        of the block gamut.
+
+        Returns:
+            The (initially empty) list that the header texts are added to
+        '''
+        nested: list[str] = []
+        depth = 0
+        run_block_gamut = doc._run_block_gamut
+        header_id_from_text = doc.header_id_from_text
+
+        def _run_block_gamut(text):
+            nonlocal depth
+            depth += 1
+            try:
+                return run_block_gamut(text)
+            finally:
+                depth -= 1
+
+        def _header_id_from_text(text, *args, **kwargs):
+            if depth > 1:
+                nested.append(text)
+            return header_id_from_text(text, *args, **kwargs)
+
+        doc._run_block_gamut = _run_block_gamut  # type: ignore
+        doc.header_id_from_text = _header_id_from_text  # type: ignore
+        return nested
+
+    def undo(self):
+        '''Undo the changes that the last call to `render` made to the state of the headers'''
+        counts, seen, toc_count, self.header_key = cast(tuple, self._undo)
+        for key, value in counts.items():
+            if value is _MISSING:
+                dict.__delitem__(self.header_counts, key)
+            else:
+                dict.__setitem__(self.header_counts, key, value)
+        self.header_ids_seen.difference_update(seen)
+        del self.toc[toc_count:]
+        self._undo = None
+
+    def render_together(self, blocks: list[_Block]) -> str:
+        '''
+        Get the HTML of several blocks by converting them as one piece of text, the same
+        way that a full conversion would. Needed for blocks with `_Block.nested_headers`.
+        '''
+        doc = self.new_document()
+        # the blocks are prepared in this document, so that it has all of the text they hash
+        text = doc._hash_and_strip_definitions(''.join(block.source for block in blocks))
+        doc._take_hashes(self.hashed)
+        doc.urls = self.urls
+        doc.titles = self.titles
+        if self.use_footnotes:
+            doc.footnotes = self.footnotes
+        doc._count_from_header_id = self.header_counts
+        doc._header_ids_seen = self.header_ids_seen
+        doc._toc = self.toc
+        return doc._finish_html(doc._run_block_gamut(text)) if text.strip() else ''
+
+    def footer(self, doc: Markdown) -> str:
+        '''
+        Give `doc` (the document that prepared the text) the definitions and headers of
+        the whole document.
+
+        Returns:
+            The HTML of the footnotes, if there are any
+        '''
+        doc.urls = self.urls
+        doc.titles = self.titles
+        doc._count_from_header_id = self.header_counts
+        doc._header_ids_seen = self.header_ids_seen
+        doc._toc = self.toc
+        if not self.use_footnotes:
+            return ''
+        doc.footnotes = self.footnotes
+        doc._take_hashes(self.hashed)
+        footer = doc._add_footnotes('')
+        return doc._finish_html(footer) if footer else ''
+
+    def finish(self, doc: Markdown, html: list[str]) -> 'UnicodeWithAttrs':
+        '''
+        Join the HTML of the blocks, number the footnotes and add the TOC and metadata
+        attributes, using the `doc` that prepared the text.
+        '''
+        text = '\n\n'.join(part for part in html if part)
+        if not text:
+            # an empty document (or one with nothing but definitions) is an empty paragraph
+            text = doc._finish_html(doc._run_block_gamut(text))
+        if self.use_footnotes:
+            text = doc._do_footnote_marker(text)
+        return doc._make_result(text + self.footer(doc))
+
+
+class IncrementalMarkdown:
+    '''
+    Converts successive versions of a document, such as a document that is being edited,
+    only re-converting the top level blocks that have changed since the previous version.
+
+    The output is the same as that of `Markdown.convert`. A block is also re-converted when
+    a link or footnote definition it uses changes, or when it has headers whose ids depend
+    on the headers before it. Options that need to see the whole document at once (eg: the
+    `numbering` extra, `use_file_vars` or an overridden `preprocess`) fall back to
+    converting the whole document every time.
+
+        >>> md = IncrementalMarkdown(extras=["toc"])
+        >>> str(md.convert("# One\\n\\nSome text"))
+        '<h1 id="one">One</h1>\\n\\n<p>Some text</p>\\n'
+        >>> str(md.convert("# One\\n\\nSome more text"))
+        '<h1 id="one">One</h1>\\n\\n<p>Some more text</p>\\n'
+        >>> md.blocks_converted
+        1
+    '''
+    def __init__(self, markdown: Optional[Markdown] = None, **options):
+        """
+        Args:
+            markdown: the converter to use. Otherwise, one is created from `options`
+            **options: the options for a new `Markdown` instance
+        """
+        self.markdown = markdown if markdown is not None else Markdown(**options)
+        self.blocks_converted = 0
+        '''The number of blocks that were (re-)converted by the last call to `convert`'''
+        self._renderer = _BlockRenderer(self.markdown) if _BlockRenderer.supports(self.markdown) else None
+        self._blocks: dict[tuple[str, int], _Block] = {}
+        self._lock = threading.Lock()
+
+    def convert(self, text: str) -> 'UnicodeWithAttrs':
+        '''Convert the latest version of the document'''
+        if self._renderer is None:
+            return self.markdown.convert(text)
+
+        with self._lock:
+            renderer = self._renderer
+            doc = renderer.new_document()
+            renderer.start()
+
+            # blocks are matched up with those of the previous version by their source and,
+            # for repeated blocks, by which occurrence of that source they are
+            blocks = {}
+            occurrences: defaultdict[str, int] = defaultdict(int)
+            for source in _BlockSplitter.split(self.markdown, doc._prepare_text(text)):
+                key = (source, occurrences[source])
+                occurrences[source] += 1
+                block = self._blocks.get(key)
+                if block is None:
+                    block = renderer.prepare(source)
+                blocks[key] = block
+                renderer.define(block)
+            self._blocks = blocks
+
+            html = [renderer.render(block) for block in blocks.values()]
+            self.blocks_converted = renderer.converted
+
+            if any(block.nested_headers for block in blocks.values()):
+                # a full conversion gives ids to the headers in nested blocks last of all
+                return self.markdown.convert(text)
+            return renderer.finish(doc, html)
+
+
+class _BlockStream:
+    '''
+    Converts a document that arrives in pieces, one top level block at a time.
+
+    Each line is prepared the way that `Markdown._prepare_text` prepares the whole text,
+    and the lines are split into blocks by a `_BlockSplitter`. A finished block is held
+    back while it refers to a link or footnote that hasn't been defined yet, since a later
+    block could define it, and until the end of the text if it has headers in nested
+    blocks (see `_Block.nested_headers`). The blocks after a held block are held with it.
+    '''
+    _metadata_fence_re = re.compile(r'---[ \t]*$')
+
+    def __init__(self, md: Markdown, wait_for_definitions: bool = True):
+        self.md = md
+        self.wait_for_definitions = wait_for_definitions
+        self.renderer = _BlockRenderer(md)
+        self.doc = self.renderer.new_document()
+        '''Extracts the metadata, numbers the footnotes and makes the final result'''
+        self.splitter = _BlockSplitter(md)
+        self.started = False
+        '''Whether any HTML has been output'''
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        '''The last, unfinished line'''
+        self._head: Optional[list[str]] = [] if 'metadata' in md.extras else None
+        '''The lines at the start of the text that might be metadata'''
+        self._head_fences = 0
+        self._has_tab = False
+        self._trailing_blank_lines = 0
+        self._held: deque[_Block] = deque()
+        self._front_rendered = False
+        '''Whether the first held block has been rendered (which changes the state of the headers)'''
+
+    @staticmethod
+    def supports(md: Markdown) -> bool:
+        '''Whether `md` can convert a document a block at a time, and output the TOC at the end'''
+        if md.cli or ('toc' in md.extras and (md.extras['toc'] or {}).get('prepend')):
+            return False
+        return _BlockRenderer.supports(md)
+
+    def feed(self, chunk: Union[str, bytes]) -> list[str]:
+        '''
+        Add the next piece of the text.
+
+        Returns:
+            The HTML of any blocks that can no longer change
+        '''
+        if isinstance(chunk, bytes):
+            chunk = self._decoder.decode(chunk)
+        text = self._buffer + chunk
+        held = ''
+        if text.endswith('\r'):
+            # the rest of a `\r\n` could be in the next chunk
+            text, held = text[:-1], '\r'
+        lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        self._buffer = lines.pop() + held
+
+        output: list[str] = []
+        for line in lines:
+            for line in self._prepare_line(line):
+                self._add_line(line, output)
+        return output
+
+    def close(self) -> list[str]:
+        '''
+        Finish the text.
+
+        Returns:
+            The HTML of the remaining blocks. The last item is a `UnicodeWithAttrs` with
+            the footnotes (if any) and the TOC and metadata attributes
+        '''
+        text = self._buffer + self._decoder.decode(b'', final=True)
+        self._buffer = ''
+        lines = []
+        for line in text.replace('\r\n', '\n').replace('\r', '\n').split('\n') + ['', '']:
+            lines.extend(self._prepare_line(line))
+        if self._has_tab:
+            # `Markdown._detab` drops the last newline
+            lines.pop()
+
+        output: list[str] = []
+        if self._head is not None:
+            self._head.extend(lines)
+            lines = self._end_head(final=True)
+        for line in lines:
+            self._split_line(line, output)
+
+        source = self.splitter.flush()
+        if source:
+            self._add_block(source[:-2] + '\n' * self._trailing_blank_lines, output)
+        self._release(output, final=True)
+
+        if not self.started:
+            # an empty document (or one with nothing but definitions) is an empty paragraph
+            output.append(self.doc._finish_html(self.doc._run_block_gamut('')))
+        output.append(self.doc._make_result(self.renderer.footer(self.doc)))
+        return output
+
+    def preview(self) -> 'UnicodeWithAttrs':
+        '''Get all of the HTML that `close` would output if the text ended now, without ending it'''
+        stream = object.__new__(type(self))
+        stream.__dict__.update(self.__dict__)
+        stream.renderer = self.renderer.copy()
+        stream.splitter = self.splitter.copy()
+        stream.doc = stream.renderer.new_document()
+        if self.renderer.use_footnotes:
+            stream.doc.footnote_ids = list(self.doc.footnote_ids)
+        if 'metadata' in self.md.extras:
+            stream.doc.metadata = dict(self.doc.metadata)
+        stream._decoder = codecs.getincrementaldecoder('utf-8')()
+        if self._head is not None:
+            stream._head = list(self._head)
+        stream._held = deque(self._held)
+
+        *parts, result = stream.close()
+        return _unicode_with_attrs(''.join(parts) + result, result.toc_html, result.metadata)
+
+    def _prepare_line(self, line: str) -> list[str]:
+        if '\t' in line:
+            self._has_tab = True
+            return ['' if not line.strip(' \t') else line for line in self.md._detab(line).split('\n')]
+        return ['' if not line.strip(' \t') else line]
+
+    def _add_line(self, line: str, output: list[str]):
+        if self._head is None:
+            self._split_line(line, output)
+            return
+
+        # hold on to the start of the text until it's clear where any metadata ends
+        self._head.append(line)
+        if self._head[0].startswith('---'):
+            self._head_fences += bool(self._metadata_fence_re.match(line))
+            if self._head_fences < 2:
+                return
+        elif line:
+            return
+        for line in self._end_head(final=False):
+            self._split_line(line, output)
+
+    def _end_head(self, final: bool) -> list[str]:
+        '''Extract the metadata from the start of the text, returning the lines that follow it'''
+        head = cast(list[str], self._head)
+        self._head = None
+        text = '\n'.join(head)
+        if not final:
+            text += '\n'
+        lines = self.doc._extract_metadata(text).split('\n')
+        if not final:
+            lines.pop()
+        return lines
+
+    def _split_line(self, line: str, output: list[str]):
+        self._trailing_blank_lines = 0 if line else self._trailing_blank_lines + 1
+        source = self.splitter.feed(line)
+        if source:
+            self._add_block(source, output)
+
+    def _add_block(self, source: str, output: list[str]):
+        block = self.renderer.prepare(source)
+        self.renderer.define(block)
+        self._held.append(block)
+        if len(self._held) == 1 or block.has_definitions:
+            self._release(output)
+
+    def _release(self, output: list[str], final: bool = False):
+        '''Output the held blocks that can no longer change'''
+        renderer = self.renderer
+        while self._held:
+            block = self._held[0]
+            if self._front_rendered:
+                # render it again, in case a definition that it looked up has turned up
+                renderer.undo()
+            html = renderer.render(block)
+            self._front_rendered = True
+
+            if block.nested_headers:
+                if not final:
+                    return
+                renderer.undo()
+                html = renderer.render_together(list(self._held))
+                self._held.clear()
+            elif block.has_missing_lookups and self.wait_for_definitions and not final:
+                return
+            else:
+                self._held.popleft()
+            self._front_rendered = False
+
+            if html:
+                if self.renderer.use_footnotes:
+                    html = self.doc._do_footnote_marker(html)
+                output.append('\n\n' + html if self.started else html)
+                self.started = True
+
+
+class StreamingMarkdown:
+    '''
+    Converts a document that is only ever added to, such as a chat message that arrives
+    a few words at a time, re-converting just the blocks at the end that are still open
+    (eg: the last paragraph, a growing list or an unclosed fenced code block).
+
+    `append` returns the HTML that has become final, which won't change again, separately
+    from the HTML of the rest of the text so far, which will. All of the final HTML so far
+    followed by the latest tail is the same as converting all of the text so far with
+    `Markdown.convert` (see `Markdown.convert_stream` for the exception).
+
+        >>> md = StreamingMarkdown()
+        >>> md.append("Hello *wor")
+        ('', '<p>Hello *wor</p>\\n')
+        >>> md.append("ld*\\n\\nBye")
+        ('', '<p>Hello <em>world</em></p>\\n\\n<p>Bye</p>\\n')
+        >>> md.append("!\\n")
+        ('<p>Hello <em>world</em></p>', '\\n\\n<p>Bye!</p>\\n')
+        >>> str(md.close())
+        '\\n\\n<p>Bye!</p>\\n'
+    '''
+    def __init__(self, markdown: Optional[Markdown] = None, **options):
+        """
+        Args:
+            markdown: the converter to use. Otherwise, one is created from `options`
+            **options: the options for a new `Markdown` instance
+        """
+        self.markdown = markdown if markdown is not None else Markdown(**options)
+        self.closed = False
+        self._stream = _BlockStream(self.markdown) if _BlockStream.supports(self.markdown) else None
+        self._text: list[str] = []
+        '''All of the text so far, when `markdown` has to convert the whole document each time'''
+        self._lock = threading.Lock()
+
+    def append(self, text: str) -> tuple[str, 'UnicodeWithAttrs']:
+        '''
+        Add some text to the end of the document.
+
+        Returns:
+            A tuple of the HTML that has become final with this text, to be added to the
+            end of the final HTML so far, and the HTML of everything after that, as it
+            stands. The tail has the `toc_html` and `metadata` attributes of the document
+            so far
+        '''
+        with self._lock:
+            if self.closed:
+                raise ValueError('append() called after close()')
+            if self._stream is None:
+                self._text.append(text)
+                return '', self.markdown.convert(''.join(self._text))
+            return ''.join(self._stream.feed(text)), self._stream.preview()
+
+    def close(self) -> 'UnicodeWithAttrs':
+        '''
+        Finish the document.
+
+        Returns:
+            The rest of the HTML, which is the final version of the last tail
+        '''
+        with self._lock:
+            if self.closed:
+                raise ValueError('close() called more than once')
+            self.closed = True
+            if self._stream is None:
+                return self.markdown.convert(''.join(self._text))
+            *parts, result = self._stream.close()
+            return _unicode_with_attrs(''.join(parts) + result, result.toc_html, result.metadata)
+
+
+# ----------------------------------------------------------
+# Extras
+# ----------------------------------------------------------
+
+# Base classes
+# ----------------------------------------------------------
+
+class Extra(ABC):
+    _registry: dict[str, type['Extra']] = {}
+    _exec_order: dict[Stage, tuple[list[type['Extra']], list[type['Extra']]]] = {}
+    _registry_version: int = 0
+    '''Incremented whenever an extra is (de)registered so that cached execution orders can be refreshed'''
+
+    name: str
+    '''
+    An identifiable name that users can use to invoke the extra
+    in the Markdown class
+    '''
+    order: tuple[Collection[Union[Stage, type['Extra']]], Collection[Union[Stage, type['Extra']]]]
+    '''
+    Tuple of two iterables containing the stages/extras this extra will run before and
+    after, respectively
+    '''
+    triggers: str = ''
+    '''
+    Characters, one of which a section of markdown must contain for `test` to return True.
+    Sections without any of them aren't tested. Leave empty to test every section.
+    Subclasses that override `test` don't inherit their parent's triggers.
+    '''
+    takes_test_result: bool = False
+    '''
+    Whether `run` takes what `test` returned (eg: the first match it found) as a second
+    argument, so that it can carry on from there rather than search the text again.
+    Subclasses that override `test` or `run` don't inherit this.
+    '''
+
+    def __init__(self, md: Markdown, options: Optional[dict]):
+        '''
+        Args:
+            md: An instance of `Markdown`
+            options: a dict of settings to alter the extra's behaviour
+        '''
+        self.md = md
+        self.options = options if options is not None else {}
+
+    @classmethod
+    def deregister(cls):
+        '''
+        Removes the class from the extras registry and unsets its execution order.
+        '''
+        if cls.name in cls._registry:
+            del cls._registry[cls.name]
+        Extra._registry_version += 1
+
+        for exec_order in Extra._exec_order.values():
+            # find everywhere this extra is mentioned and remove it
+            for section in exec_order:
+                while cls in section:
+                    section.remove(cls)
+
+    @classmethod
     def register(cls):
         '''
         Registers the class for use with `Markdown` and calculates its execution order based on
         the `order` class attribute.
         '''
         cls._registry[cls.name] = cls
+        Extra._registry_version += 1
 
         for index, item in enumerate((*cls.order[0], *cls.order[1])):
             before = index < len(cls.order[0])
@@ -2543,6 +5428,17 @@ class Extra(ABC):
         '''
         return True
 
+    def reset(self):
+        '''
+        Get ready to convert another document. Extras are created for the first document
+        of a `MarkdownProfile` and shallow copied for the rest, with `md` set to the new
+        document's `Markdown` instance, before this is called on the copy. Replace (rather
+        than clear) any state kept per document here, as the copy shares it with the original.
+
+        Subclasses that override `__init__` but not `reset` are created anew for each document.
+        '''
+        pass
+
 
 class ItalicAndBoldProcessor(Extra):
     '''
@@ -2555,6 +5451,7 @@ class ItalicAndBoldProcessor(Extra):
     '''
     name = 'italic-and-bold-processor'
     order = (Stage.ITALIC_AND_BOLD,), (Stage.ITALIC_AND_BOLD,)
+    triggers = '*_' + _PLACEHOLDER_CHAR
 
     strong_re = Markdown._strong_re
     em_re = Markdown._em_re
@@ -2563,17 +5460,16 @@ class ItalicAndBoldProcessor(Extra):
         super().__init__(md, options)
         self.hash_table = {}
 
+    def reset(self):
+        self.hash_table = {}
+
     def run(self, text: str):
         if self.md.order < Stage.ITALIC_AND_BOLD:
             text = self.strong_re.sub(self.sub, text)
             text = self.em_re.sub(self.sub, text)
         else:
-            # push any hashed values back, using a while loop to deal with recursive hashes
-            orig_text = ''
-            while orig_text != text:
-                orig_text = text
-                for key, substr in self.hash_table.items():
-                    text = text.replace(key, substr)
+            # push any hashed values back, including any hashes within them
+            text = _restore_placeholders(text, self.hash_table.get)
         return text
 
     @abstractmethod
@@ -2587,373 +5483,285 @@ class ItalicAndBoldProcessor(Extra):
 
     def test(self, text: str):
         if self.md.order < Stage.ITALIC_AND_BOLD:
-            return '*' in text or '_' in text
-        return self.hash_table and re.search(r'md5-[0-9a-z]{32}', text)
-
-
-class GFMItalicAndBoldProcessor(Extra):
-    '''
-    An upgraded version of the `ItalicAndBoldProcessor` that covers far more edge cases and gets close
-    to Github Flavoured Markdown compliance.
-    '''
-    name = 'gfm-italic-and-bold-processor'
-    order = (Stage.ITALIC_AND_BOLD,), tuple()
-
-    def run(self, text: str):
-        nesting = True
-        orig_text = ""
-        while nesting and orig_text != _hash_text(text):
-            orig_text = _hash_text(text)
-            nesting = False
-
-            opens = {'*': [], '_': []}
-            '''Mapping of em type to a list of opening runs of that em type'''
-            unused_opens = {'*': {}, '_': {}}
-            '''
-            Mapping of em type to another mapping of unused opening runs of that em type.
-            An unused run is one that has been skipped, or only partially consumed (eg: **foo*) and
-            could be consumed by another closing run. The inner mapping is a mapping of the
-            delimiter run to an offset number, which is the number of characters from that run that
-            have been consumed so far
-            '''
-            unused_closes = {'*': [], '_': []}
-            '''
-            Mapping of em type to a list of closing delimiter runs that have not been fully consumed.
-            EG: *foo*bar*
-            '''
-            tokens = []
-            '''List of processed spans of text that will be joined to form the new `text`'''
-            index = 0
-            '''Number of chars of `text` that has been processed so far'''
-
-            delim_runs_iter = re.finditer(r'(\*+|_+)', text)
-            next_delim_run = self._next_run(delim_runs_iter)
-
-            while next_delim_run:
-                delim_run, left, right = next_delim_run
-                next_delim_run = self._next_run(delim_runs_iter)
-
-                syntax = delim_run.group(1)
-                em_type = syntax[0]
-
-                # if not a closing run, or there are no opens to consume
-                if not right or not opens[em_type]:
-                    # if it can also be an opening run
-                    if left:
-                        opens[em_type].append(delim_run)
-                    continue
-
-                # grab the open run. If it crosses a span, keep looking backwards
-                while opens[em_type] and self.body_crosses_span_borders(opens[em_type][-1], delim_run):
-                    opens[em_type].pop(-1)
-                if not opens[em_type]:
-                    if left:
-                        opens[em_type].append(delim_run)
-                    continue
-                open = opens[em_type].pop(-1)
-
-                if open.start() < index:
-                    # this happens with things like `*(**foo**)*`. We process LTR so the strong gets
-                    # processed first (since that has the first closing delimiter). We now have
-                    # `*(<strong>foo</strong>)*` and now we get round to processing the em.
-                    # It's hard compare the match (against the original text var) to the processed text
-                    # so it's easier to just note down that nesting is detected and re-run the loop
-                    nesting = True
-                    continue
-
-                # if the opening run was joined to a previous closing run (eg: **strong***em*)
-                # then re-use that previous closing run, but ignore the part that was used to
-                # close the previous emphasis
-                open_offset = unused_opens[em_type].pop(open, 0)
-                open_syntax = open.group(1)[open_offset:]
-
-                middle = None
-
-                # if the delimiter runs don't match then we need to figure out how to resolve this
-                if open_syntax != syntax:
-                    has_middle = self.has_middle(
-                        open, delim_run, opens[em_type],
-                        unused_opens[em_type], unused_closes[em_type]
-                    )
-
-                    if has_middle is not False:
-                        middle = has_middle[1]
-                        if has_middle[0] != open:
-                            # only re-assign and re-calc opening offsets if that run HAS changed
-                            open = has_middle[0]
-                            open_offset = unused_opens[em_type].pop(open, 0)
-                            open_syntax = open.group(1)[open_offset:]
-                    elif not self.should_process_imbalanced_delimiter_runs(
-                        open, delim_run, unused_opens[em_type], next_delim_run
-                    ):
-                        # if we shouldn't process them now, save these opens for a future pass
-                        unused_opens[em_type][open] = open_offset
-                        opens[em_type].append(open)
-                        if left:
-                            unused_opens[em_type][delim_run] = 0
-                            opens[em_type].append(delim_run)
-                        else:
-                            unused_closes[em_type].append(delim_run)
-                        continue
+            return '*' in text or '_' in text
+        return self.hash_table and _PLACEHOLDER_CHAR in text
 
-                # add all the text leading up to the opening delimiter
-                tokens.append(delim_run.string[index: open.start() + open_offset])
 
-                span, close_syntax_used_chars = self.process_span(
-                    open, delim_run, middle,
-                    open_syntax=open_syntax, close_syntax=syntax
-                )
-                tokens.extend(span)
-
-                if close_syntax_used_chars is None:
-                    close_syntax_used_chars = len(syntax)
-                elif close_syntax_used_chars < len(syntax):
-                    # if we didn't use up the entire closing delimiter, mark it as unused
-                    unused_opens[em_type][delim_run] = close_syntax_used_chars
-                    opens[em_type].append(delim_run)
-                elif close_syntax_used_chars < len(open_syntax) and opens[em_type]:
-                    # if we skipped an open before, perhaps it wasn't a close at the time but now is?
-                    # eg: *a->***b**
-                    prev_open = opens[em_type][-1]
-                    prev_open_syntax = prev_open.group(1)
-                    if len(prev_open_syntax) >= (len(open_syntax) - close_syntax_used_chars):
-                        nesting = True
-
-                # Move index to end of the used delim run
-                index = delim_run.start() + close_syntax_used_chars
-
-            if index < len(text):
-                tokens.append(text[index:])
-
-            text = ''.join(tokens)
+class _DelimiterRun:
+    '''A run of `*` or `_` chars that can open and/or close emphasis'''
+    __slots__ = (
+        'start', 'end', 'syntax', 'length', 'can_open', 'can_close', 'remaining', 'opened', 'closed',
+        'open_tags', 'close_tags'
+    )
 
-        return text
+    def __init__(self, start: int, end: int, syntax: str, can_open: bool, can_close: bool):
+        self.start = start
+        self.end = end
+        self.syntax = syntax
+        self.length = len(syntax)
+        '''The length of the run, as far as the rule of 3 is concerned'''
+        self.can_open = can_open
+        self.can_close = can_close
+        self.remaining = self.length
+        '''Number of chars from the run that haven't been used up by an emphasis yet'''
+        self.opened = 0
+        '''Number of chars from the end of the run used to open emphasis'''
+        self.closed = 0
+        '''Number of chars from the start of the run used to close emphasis'''
+        self.open_tags = ''
+        '''The opening tags the run turns into'''
+        self.close_tags = ''
+        '''The closing tags the run turns into'''
+
+
+class _SpanTags:
+    '''
+    Where each span tag is opened and closed in the text given to `GFMItalicAndBoldProcessor`,
+    found once so that whether the body of an emphasis crosses a span border can be told
+    from counts of the tags before either end of it, rather than by searching the body.
+    The answer is the same as from `Markdown._tag_is_closed` for each tag in the body.
+    '''
+    __slots__ = ('_tags',)
+
+    def __init__(self, text: str, span_tags: str):
+        mentions: dict[str, list[int]] = {}
+        for match in re.finditer(rf'</?({span_tags})', text):
+            mentions.setdefault(match.group(1), []).append(match.start())
+        self._tags = []
+        for tag, starts in mentions.items():
+            opens = [match.span() for match in _tag_open_re(tag).finditer(text)]
+            self._tags.append((
+                tag, starts,
+                [start for start, _ in opens], [end for _, end in opens],
+                [match.start() for match in re.finditer(f'</{tag}>', text)],
+                [match.start() for match in re.finditer(f'<{tag}', text)],
+                [match.start() for match in re.finditer(f'</{tag}', text)],
+            ))
 
-    def process_span(
-            self, open: re.Match[str], close: re.Match[str],
-            middle: Optional[re.Match[str]] = None,
-            open_syntax: Optional[str] = None,
-            close_syntax: Optional[str] = None
-        ) -> Tuple[List[str], Optional[int]]:
+    def crosses(self, start: int, end: int) -> Optional[bool]:
         '''
-        Args:
-            open: the match against the opening delimiter run
-            close: the match against the closing delimiter run
-            middle: an optional delimiter run in the middle of the span
-            open_syntax: the string of the opening delimiter run. If omitted `open.group(1)` will be used.
-                Useful if there are characters in the delimiter run that need to be skipped
-            close_syntax: the string of the opening delimiter run. If omitted `close.group(1)` will be used.
-                Useful if there are characters in the delimiter run that need to be skipped
-
-        Returns:
-            A list of processed tokens, and then the number of chars from the closing syntax that were
-            consumed. If the latter item is None, then assume all chars were consumed
-        '''
-        open_syntax = open_syntax or cast(str, open.group(1))
-        middle_syntax = middle.group(1) if middle else ''
-        close_syntax = close_syntax or cast(str, close.group(1))
-
-        # calculate what em type the inner and outer emphasis is
-        outer_syntax_length = len(min(open_syntax, close_syntax))
-        inner_syntax_length = len(min(max(open_syntax, close_syntax), middle_syntax)) if middle else 0
-
-        tokens = [
-            # add anything from the opening syntax that will not be consumed
-            # eg: **one*
-            open_syntax[:-(outer_syntax_length + inner_syntax_length)],
-            # add opening tags
-            '<em>' * (outer_syntax_length % 2),
-            '<strong>' * (outer_syntax_length // 2)
-        ]
-
-        if middle:
-            # if there is a middle em (eg: ***abc*def**) then do some wrangling to figure
-            # out where to put the opening/closing inner tags depending on the size of the
-            # opening delim run
-            inner_tag = 'strong' if len(middle_syntax) == 2 else 'em'
-            if open_syntax > close_syntax:
-                tokens.append(f'<{inner_tag}>')
+        Whether the text from `start` to `end` has a span tag that isn't closed within it, or
+        `None` if that can't be told from the index, because a tag starts before `start` and ends within it
+        '''
+        bisect_left, bisect_right = bisect.bisect_left, bisect.bisect_right
+        for tag, starts, open_starts, open_ends, closes, open_finds, close_finds in self._tags:
+            index = bisect_left(starts, start)
+            if index == len(starts) or starts[index] >= end:
+                # not in the body
+                continue
+            first_open = bisect_left(open_starts, start)
+            if first_open and open_ends[first_open - 1] > start:
+                return None
+            length = len(tag)
+            opened = bisect_right(open_ends, end) - first_open
+            closed = bisect_right(closes, end - length - 3) - bisect_left(closes, start)
+            if opened != closed:
+                return True
+            # the tag must be opened before it's first closed
+            index = bisect_left(open_finds, start)
+            if index == len(open_finds) or open_finds[index] > end - length - 1:
+                return True
+            open_index = open_finds[index]
+            index = bisect_left(close_finds, start)
+            if index == len(close_finds) or close_finds[index] > end - length - 2 or close_finds[index] < open_index:
+                return True
+        return False
 
-            tokens.append(close.string[open.end(): middle.start()])
 
-            if open_syntax > close_syntax:
-                tokens.append(f'</{inner_tag}>')
-            else:
-                tokens.append(f'<{inner_tag}>')
+class GFMItalicAndBoldProcessor(Extra):
+    '''
+    An upgraded version of the `ItalicAndBoldProcessor` that covers far more edge cases and gets close
+    to Github Flavoured Markdown compliance.
 
-            tokens.append(close.string[middle.end(): close.start()])
+    Emphasis is matched in a single pass over the delimiter runs in the text, using a stack of
+    potential openers as in the "process emphasis" procedure from the CommonMark spec
+    (https://spec.commonmark.org/0.31.2/#phase-2-inline-structure), so it takes linear time.
+    '''
+    name = 'gfm-italic-and-bold-processor'
+    order = (Stage.ITALIC_AND_BOLD,), tuple()
+    triggers = '*_'
 
-            if open_syntax < close_syntax:
-                tokens.append(f'</{inner_tag}>')
-        else:
-            # if no middle em then it's easy. Just add the whole text body
-            tokens.append(close.string[open.end(): close.start()])
+    _delimiter_run_re = re.compile(r'(\*+|_+)')
 
-        # now add closing tags
-        tokens.append(
-            ('</strong>' * (outer_syntax_length // 2))
-            + ('</em>' * (outer_syntax_length % 2))
-        )
+    def run(self, text: str):
+        runs: list[_DelimiterRun] = []
+        '''All the delimiter runs in the text, in order'''
+        flanking = self._flanking
+        for match in self._delimiter_run_re.finditer(text):
+            start, end = match.span()
+            left, right = flanking(text[start - 1] if start else '', text[end: end + 1])
+            if left or right:
+                runs.append(_DelimiterRun(start, end, match.group(), left, right))
+        if len(runs) < 2:
+            return text
 
-        # figure out how many chars from the closing delimiter we've actually used
-        close_delim_chars_used = outer_syntax_length
-        if middle and open_syntax < close_syntax:
-            # if there's a middle part and it's right-aligned then add that on
-            close_delim_chars_used += inner_syntax_length
+        openers: list[_DelimiterRun] = []
+        '''Runs that could still open emphasis, in order'''
+        bottoms: dict[tuple[str, bool, int], int] = {}
+        '''
+        How far down `openers` it's worth looking for an opener for each kind of closer. Once a
+        closer fails to find an opener, the same kind of closer won't find one below that point either
+        '''
+        self._text = text
+        self._span_tags: Optional[_SpanTags] = None
+        for index, run in enumerate(runs, 1):
+            if run.can_close and openers:
+                self._close_emphasis(run, openers, bottoms, runs[index] if index < len(runs) else None)
+            if run.can_open and run.remaining:
+                openers.append(run)
 
-        return tokens, close_delim_chars_used
+        tokens = []
+        '''List of processed spans of text that will be joined to form the new `text`'''
+        index = 0
+        '''Number of chars of `text` that has been processed so far'''
+        for run in runs:
+            if run.opened or run.closed:
+                tokens.append(text[index: run.start])
+                tokens.append(run.close_tags)
+                tokens.append(run.syntax[run.closed: len(run.syntax) - run.opened])
+                tokens.append(run.open_tags)
+                index = run.end
+        if not tokens:
+            return text
+        tokens.append(text[index:])
+        return ''.join(tokens)
 
-    def has_middle(
-        self, open: re.Match[str], close: re.Match[str], opens: List[re.Match[str]],
-        unused_opens: Dict[re.Match[str], int], unused_closes: List[re.Match[str]]
-    ) -> Union[Tuple[re.Match[str], Optional[re.Match[str]]], Literal[False]]:
+    def _close_emphasis(
+        self, closer: _DelimiterRun, openers: List[_DelimiterRun],
+        bottoms: Dict[tuple[str, bool, int], int], next_run: Optional[_DelimiterRun]
+    ):
         '''
-        Check if an emphasis span has a middle delimiter run, which may change the outer tags
+        Match a closing delimiter run against the runs in `openers`, for as long as
+        it has chars left to use up
 
         Args:
-            open: the current opening delimiter run
-            close: the closing delimiter run
-            opens: a list of all opening delimiter runs in the text
-            unused_opens: a mapping of unused opens within the text to their offset values
-            unused_closes: a list of unused closes within the text
-
-        Returns:
-            False if there is no middle run. Otherwise, a tuple of the new opening run and the optional
-            middle span. The middle span may be None if it is invalid
+            closer: the closing delimiter run
+            openers: the runs before `closer` that could open emphasis. Used up runs are removed,
+                along with any runs between an opener and `closer`, which can't be matched any more
+            bottoms: how far down `openers` to look for each kind of closer
+            next_run: the delimiter run after `closer`
         '''
-        open_offset = unused_opens.get(open, 0)
-        open_syntax = open.group(1)[open_offset:]
-
-        syntax = close.group(1)
-
-        if open_syntax < syntax and opens:
-            # expand the em span to the left, meaning we're covering additional chars.
-            # check we don't cross an existing span border
-            if self.body_crosses_span_borders(opens[-1], open):
-                return False
-
-            middle = open
-
-            open = opens.pop(-1)
-            open_offset = unused_opens.pop(open, 0)
-            open_syntax = open.group(1)[open_offset:]
-
-            if open_syntax == syntax:
-                # if it turns out the previous open is a perfect match then ignore the middle part
-                # eg: **foo*bar**
-                middle = None
-        elif open_syntax > syntax and unused_closes:
-            # check if there is a previous closing delim run in the current body
-            # since this is already within the body we don't need to do a cross-span border check
-            # as we're not expanding into new ground and that is covered later
-            middle = next((i for i in unused_closes if open.end() < i.start() < close.start()), None)
-        else:
+        em_type = closer.syntax[0]
+        key = (em_type, closer.can_open, closer.length % 3)
+
+        while closer.remaining and openers:
+            index = len(openers) - 1
+            bottom = bottoms.get(key, 0)
+            fallback = None
+            '''The nearest opener that was skipped because of the rule of 3'''
+            while index >= bottom:
+                opener = openers[index]
+                if opener.syntax[0] == em_type:
+                    if self.body_crosses_span_borders(opener, closer):
+                        # an opener that would break up an HTML span can't be used
+                        del openers[index]
+                        for other, other_bottom in bottoms.items():
+                            if other_bottom > index:
+                                bottoms[other] = other_bottom - 1
+                        if fallback is not None and fallback > index:
+                            fallback -= 1
+                    elif not self._rule_of_three(opener, closer):
+                        break
+                    elif fallback is None:
+                        fallback = index
+                index -= 1
+            else:
+                bottoms[key] = len(openers)
+                if fallback is None or not self.should_process_imbalanced_delimiter_runs(
+                    openers[fallback], closer, next_run
+                ):
+                    return
+                index = fallback
+                opener = openers[index]
+
+            used = 2 if opener.remaining >= 2 and closer.remaining >= 2 else 1
+            tag = 'strong' if used == 2 else 'em'
+            opener.remaining -= used
+            opener.opened += used
+            # the opening tags of a run go from the outside in, and the closing tags from the inside out
+            opener.open_tags = f'<{tag}>' + opener.open_tags
+            closer.remaining -= used
+            closer.closed += used
+            closer.close_tags += f'</{tag}>'
+
+            # anything between the opener and closer is now inside the emphasis, so can't be
+            # matched with anything outside of it
+            del openers[index:]
+            for other, other_bottom in bottoms.items():
+                if other_bottom > index:
+                    bottoms[other] = index
+
+            if opener.remaining:
+                if not closer.remaining and not opener.can_close:
+                    # what's left of the opener is now followed by a tag, which can make it a
+                    # closer. EG: `*a->***b**` is `<em>a-></em><strong>b</strong>`
+                    _, opener.can_close = self._flanking(self._text[opener.start - 1] if opener.start else '', '<')
+                    if opener.can_close:
+                        opener.length = opener.remaining
+                        self._close_emphasis(opener, openers, bottoms, closer)
+                if opener.remaining:
+                    openers.append(opener)
+
+    def _rule_of_three(self, opener: _DelimiterRun, closer: _DelimiterRun) -> bool:
+        '''
+        Check if CommonMark's "rule of 3" stops two delimiter runs from being matched: if either run
+        can both open and close emphasis, the sum of their lengths can't be a multiple of 3 unless
+        both of them are
+        '''
+        if not (opener.can_close or closer.can_open):
             return False
-
-        return open, middle
+        opener_length, closer_length = opener.length, closer.length
+        return (opener_length + closer_length) % 3 == 0 and bool(opener_length % 3 or closer_length % 3)
 
     def should_process_imbalanced_delimiter_runs(
-        self, open: re.Match[str], close: re.Match[str],
-        unused_opens: Dict[re.Match[str], int],
-        next_delim_run: Optional[Tuple[re.Match[str], Optional[re.Match[str]], Optional[re.Match[str]]]] = None
-    ):
+        self, open: _DelimiterRun, close: _DelimiterRun, next_delim_run: Optional[_DelimiterRun]
+    ) -> bool:
         '''
-        Check if an imbalanced delimiter run should be consumed now, or left for a later pass
+        Check if two delimiter runs that the rule of 3 would keep apart should be matched anyway,
+        because there's nothing else for them to be matched with. This is where GFM differs from
+        CommonMark, so that `*foo**bar*` is `<em>foo</em><em>bar</em>` rather than `<em>foo**bar</em>`
 
         Args:
             open: the opening delimiter run
             close: the closing delimiter run
-            unused_opens: a mapping of unused opens within the text to their offset values
             next_delim_run: the next delimiter run after the closing run
         '''
-        # if no delimiter run after then close span immediately
-        if next_delim_run is None:
+        # if no delimiter run after (of the same type) then close span immediately
+        if next_delim_run is None or next_delim_run.syntax[0] != close.syntax[0]:
             return True
 
-        open_offset = unused_opens.get(open, 0)
-        open_syntax = open.group(1)[open_offset:]
-        syntax = close.group(1)
-
-        if open_syntax < syntax and len(syntax) >= 3:
-            # if closing syntax is bigger and its >= three long then focus on closing any
-            # open em spans
-            return True
+        if open.remaining >= close.remaining:
+            return False
 
-        em_type = syntax[0]
-        next_delim_run_syntax = next_delim_run[0].group(1)
-        # if next run is of a different syntax
-        if next_delim_run_syntax[0] != em_type:
+        # if closing syntax is bigger and its >= three long then focus on closing any open em spans
+        if len(close.syntax) >= 3:
             return True
 
-        left, right = self.delimiter_left_or_right(close)
-
-        if open_syntax < syntax and (
+        return (
             # if this run can be an opener, but the next run won't close both of them
-            (left and (
-                not next_delim_run[2]
-                or next_delim_run_syntax < open_syntax + syntax
-            ))
+            close.can_open and (
+                not next_delim_run.can_close
+                or len(next_delim_run.syntax) < open.remaining + close.remaining
+            )
             # if the next run is not an opener and won't consume this run
-            and not next_delim_run[1]
-        ):
-            return True
-
-        if open_syntax > syntax and (
-            # if this run can be a closer, but the next run is not a fresh opener
-            (right and not next_delim_run[1])
-            # if the next run is not a closer
-            and not next_delim_run[2]
-        ):
-            return True
-
-        # if there are no unused opens or closes to use up then this is just imbalanced.
-        # mark as unused and leave for later processing
-        return False
-
-    def delimiter_left_or_right(self, delim_run: re.Match[str]):
-        '''
-        Determine if a delimiter run is left or right flanking
-
-        Returns:
-            Tuple of bools that mean left and right flanking respectively
-        '''
-        run = delim_run.string[max(0, delim_run.start() - 1): delim_run.end() + 1]
-
-        return self._delimiter_left_or_right(run, delim_run.group(1))
+            and not next_delim_run.can_open
+        )
 
-    @functools.lru_cache(maxsize=512)
-    def _delimiter_left_or_right(self, run: str, syntax: str):
+    @staticmethod
+    def _flanking(before: str, after: str) -> Tuple[bool, bool]:
         '''
-        Cached version of `delimiter_left_or_right` that massively speeds things up when dealing
-        with many repetetive delimiter runs - eg: in a ReDoS scenario
+        Determine if a delimiter run is left or right flanking from the chars either side of it
+        (empty at the start or end of the text)
         '''
-        syntax_re = syntax.replace('*', r'\*')
-
-        left = (
-            # not followed by whitespace
-            re.match(r'.*%s\S' % syntax_re, run, re.S)
-            and (
-                # either not followed by punctuation
-                re.match(r'.*%s[\s\w]' % syntax_re, run, re.S)
-                # or followed by punct and preceded by punct/whitespace
-                or re.match(r'(^|[\s\W])%s([^\s\w]|$)' % syntax_re, run, re.S | re.M)
-            )
-        )
-
-        right =  (
-            # not preceded by whitespace
-            re.match(r'\S%s.*' % syntax_re, run, re.S)
-            and (
-                # either not preceded by punct
-                re.match(r'[\s\w]%s.*' % syntax_re, run, re.S)
-                # or preceded by punct and followed by whitespace or punct
-                or re.match(r'[^\s\w]%s(\s|[^\s\w]|$)' % syntax_re, run, re.S | re.M)
-            )
-        )
-
+        before_word = before.isalnum() or before == '_'
+        after_word = after.isalnum() or after == '_'
+        # left flanking if not followed by whitespace, and either not followed by punctuation or
+        # preceded by punctuation/whitespace. Right flanking is the mirror image of that
+        left = after != '' and not after.isspace() and (after_word or not before_word)
+        right = before != '' and not before.isspace() and (before_word or not after_word)
         return left, right
 
-    def body_crosses_span_borders(self, open: re.Match[str], close: re.Match[str]):
+    def body_crosses_span_borders(self, open: _DelimiterRun, close: _DelimiterRun) -> bool:
         '''
         Checks if the body of an emphasis crosses a span border
 
@@ -2964,42 +5772,92 @@ class GFMItalicAndBoldProcessor(Extra):
         Returns:
             True if the emphasis crosses a span border (invalid). False if not
         '''
-        text = open.string[open.end(): close.start()]
-        if len(text) < 7:
-            # 7 chars min is needed for '</a><a>'
-            return False
-        return self._body_crosses_span_borders(text)
-
-    @functools.lru_cache(maxsize=64)
-    def _body_crosses_span_borders(self, text: str):
-        '''Cached version of `body_crosses_span_borders`'''
+        if type(self.md)._tag_is_closed is Markdown._tag_is_closed:
+            if self._span_tags is None:
+                self._span_tags = _SpanTags(self._text, self.md._span_tags)
+            crosses = self._span_tags.crosses(open.end, close.start)
+            if crosses is not None:
+                return crosses
+
+        text = self._text[open.end: close.start]
         for tag in set(re.findall(rf'</?({self.md._span_tags})', text)):
             if not self.md._tag_is_closed(tag, text):
                 return True
 
         return False
 
-    def _next_run(self, delim_runs_iter: Iterator[re.Match[str]]):
-        '''
-        Gets the next delimiter run from an iterator of delimiter runs
-
-        Returns:
-            A tuple containing the run, and matches dictating whether it is left or right flanking
-            respectively. Returns nothing if no valid runs left
-        '''
-        try:
-            while True:
-                delim_run = next(delim_runs_iter)
-                left, right = self.delimiter_left_or_right(delim_run)
-                if left or right:
-                    return (delim_run, left, right)
-        except StopIteration:
-            return
-
     def test(self, text: str):
         return text.count('*') > 1 or text.count('_') > 1
 
 
+class _LinkBrackets:
+    '''
+    Finds the `]` that matches each `[`, and the `)` that matches each `(`, for
+    `LinkProcessor.run`, from pairs found with a stack in one pass over the text. The text
+    changes as links are replaced by their HTML, but from `start` onwards it's still the
+    indexed text, shifted by `offset`. Brackets before that are matched by scanning, as are
+    all of them in text with too few links to be worth indexing.
+    '''
+    __slots__ = ('closes', 'start', 'offset')
+    _bracket_re = re.compile(r'[\[\]()]')
+    _square_bracket_re = re.compile(r'[\[\]]')
+    _min_indexed = 16
+
+    def __init__(self, text: str):
+        # `[` and `(` are never at the same index, so the pairs of both can share a dict
+        self.closes: dict[int, int] = {}
+        self.offset = 0
+        if text.count('[') < self._min_indexed:
+            self.start = sys.maxsize
+            return
+        squares = []
+        parens = []
+        for match in self._bracket_re.finditer(text):
+            char = match.group()
+            if char == '[':
+                squares.append(match.start())
+            elif char == '(':
+                parens.append(match.start())
+            elif char == ']':
+                if squares:
+                    self.closes[squares.pop()] = match.start()
+            elif parens:
+                self.closes[parens.pop()] = match.start()
+        self.start = 0
+
+    def find_close(self, text: str, pos: int, limit: int) -> int:
+        '''The index of the `]` matching the `[` at `pos`, or -1 if there isn't one within `limit` characters'''
+        if pos >= self.start:
+            close = self.closes.get(pos + self.offset)
+            if close is None or close - self.offset - pos >= limit:
+                return -1
+            return close - self.offset
+
+        depth = 0
+        for match in self._square_bracket_re.finditer(text, pos + 1, min(pos + limit, len(text))):
+            if match.group() == '[':
+                depth += 1
+            else:
+                depth -= 1
+                if depth < 0:
+                    return match.start()
+        return -1
+
+    def find_paren_end(self, md: Markdown, text: str, pos: int) -> int:
+        '''The index just after the `)` matching the `(` at `pos`, or the end of the text if there isn't one'''
+        if pos < self.start:
+            return md._find_balanced(text, pos + 1, '(', ')')
+        close = self.closes.get(pos + self.offset)
+        if close is None:
+            return len(text)
+        return close - self.offset + 1
+
+    def moved(self, start: int, delta: int):
+        '''The text has changed, but from `start` onwards, each character is the one `delta` along in the old text'''
+        self.start = max(start, self.start - delta)
+        self.offset += delta
+
+
 class _LinkProcessorExtraOpts(TypedDict, total=False):
     '''Options for the `LinkProcessor` extra'''
     tags: List[str]
@@ -3011,13 +5869,19 @@ class _LinkProcessorExtraOpts(TypedDict, total=False):
 
 
 class LinkProcessor(Extra):
+    '''
+    Turns inline and reference links and images into HTML, with hooks for subclasses to
+    change how they're parsed and rendered.
+
+    The `text` given to the parsing hooks has the link at `start_idx`. Links before that
+    may not have been replaced by their HTML yet, and any changes a hook makes to `text`
+    should come after `start_idx` and before the end of the link that it returns.
+    '''
     name = 'link-processor'
     order = (Stage.ITALIC_AND_BOLD,), (Stage.ESCAPE_SPECIAL,)
+    triggers = '(['
     options: _LinkProcessorExtraOpts
-
-    def __init__(self, md: Markdown, options: Optional[dict]):
-        options = options or {}
-        super().__init__(md, options)
+    _brackets: Optional[_LinkBrackets] = None
 
     def parse_inline_anchor_or_image(self, text: str, _link_text: str, start_idx: int) -> Optional[Tuple[str, str, Optional[str], int]]:
         '''
@@ -3044,7 +5908,14 @@ class LinkProcessor(Extra):
         has_anglebrackets = text[idx] == "<"
         if has_anglebrackets:
             end_idx = self.md._find_balanced(text, end_idx+1, "<", ">")
-        end_idx = self.md._find_balanced(text, end_idx, "(", ")")
+            end_idx = self.md._find_balanced(text, end_idx, "(", ")")
+        elif self._brackets:
+            end_idx = self._brackets.find_paren_end(self.md, text, start_idx)
+        else:
+            end_idx = self.md._find_balanced(text, end_idx, "(", ")")
+        if not text.endswith((')', ')\n'), idx, end_idx):
+            # unclosed, so `_inline_link_title` can't match and needn't search the rest of the text
+            return
         match = self.md._inline_link_title.search(text, idx, end_idx)
         if not match:
             return
@@ -3053,6 +5924,8 @@ class LinkProcessor(Extra):
             url = self.md._strip_anglebrackets.sub(r'\1', url)
         return text, url, title, end_idx
 
+    _no_tail_re = re.compile(r'[ ]?(?:\n[ ]*)?(?!\[)')
+
     def process_link_shortrefs(self, text: str, link_text: str, start_idx: int) -> Tuple[Optional[re.Match[str]], str]:
         '''
         Detects shortref links within a string and converts them to normal references
@@ -3070,18 +5943,14 @@ class LinkProcessor(Extra):
         '''
         match = None
         # check if there's no tailing id section
-        if link_text and re.match(r'[ ]?(?:\n[ ]*)?(?!\[)', text[start_idx:]):
-            # try a match with `[]` inserted into the text
-            match = self.md._tail_of_reference_link_re.match(f'{text[:start_idx]}[]{text[start_idx:]}', start_idx)
-            if match:
-                # if we get a match, we'll have to modify the `text` variable to insert the `[]`
-                # but we ONLY want to do that if the link_id is valid. This makes sure that we
-                # don't get stuck in any loops and also that when a user inputs `[abc]` we don't
-                # output `[abc][]` in the final HTML
-                if (match.group("id").lower() or link_text.lower()) in self.md.urls:
-                    text = f'{text[:start_idx]}[]{text[start_idx:]}'
-                else:
-                    match = None
+        if link_text and self._no_tail_re.match(text, start_idx):
+            # with `[]` inserted into the text, the id would be empty, so the link text is the id.
+            # We'll have to modify the `text` variable to insert the `[]` but we ONLY want to do
+            # that if the link_id is valid. This makes sure that we don't get stuck in any loops
+            # and also that when a user inputs `[abc]` we don't output `[abc][]` in the final HTML
+            if link_text.lower() in self.md.urls:
+                text = f'{text[:start_idx]}[]{text[start_idx:]}'
+                match = self.md._tail_of_reference_link_re.match(text, start_idx)
 
         return match, text
 
@@ -3170,9 +6039,37 @@ class LinkProcessor(Extra):
     def run(self, text: str):
         MAX_LINK_TEXT_SENTINEL = 3000  # markdown2 issue 24
 
+        # Nothing before `curr_pos` changes once it's been passed, so rather than splicing
+        # the HTML for each link into `text`, it goes into `output` along with the text
+        # before it, and `text[flushed:]` is what comes after. When there are more links
+        # within the HTML (eg: an image in the text of an anchor), `text` becomes the HTML
+        # and the text it was cut from goes on `segments`, along with where to carry on in it.
+        output: list[str] = []
+        output_len = 0
+        flushed = 0
+        segments: list[tuple[str, _LinkBrackets, int]] = []
+        brackets = _LinkBrackets(text)
+        outer_brackets, self._brackets = self._brackets, brackets
+
+        def flush(end: int, html: str):
+            nonlocal output_len
+            if end > flushed:
+                output.append(text[flushed:end])
+                output_len += end - flushed
+            if html:
+                output.append(html)
+                output_len += len(html)
+
+        # for the anchor whose text is being processed in place, the end of its text, the HTML
+        # that replaces the rest of its markup, and the end of its markup
+        anchor_text_end = -1
+        anchor_tail = ''
+        anchor_end = -1
+
         # `anchor_allowed_pos` is used to support img links inside
         # anchors, but not anchors inside anchors. An anchor's start
-        # pos must be `>= anchor_allowed_pos`.
+        # pos must be `>= anchor_allowed_pos`. This is a position in the
+        # whole text so far, ie: `output` followed by `text[flushed:]`.
         anchor_allowed_pos = 0
 
         curr_pos = 0
@@ -3193,30 +6090,28 @@ class LinkProcessor(Extra):
             #   These have already been stripped in
             #   _strip_link_definitions() so no need to watch for them.
             # - not markup:         [...anything else...
-            try:
-                start_idx = text.index('[', curr_pos)
-            except ValueError:
-                break
+            start_idx = text.find('[', curr_pos, len(text) if anchor_text_end == -1 else anchor_text_end)
+            if start_idx == -1:
+                if anchor_text_end == -1:
+                    if not segments:
+                        break
+                    flush(len(text), '')
+                    text, brackets, flushed = segments.pop()
+                    self._brackets = brackets
+                    curr_pos = flushed
+                    continue
+                flush(anchor_text_end, anchor_tail)
+                flushed = curr_pos = anchor_end
+                anchor_text_end = -1
+                continue
 
             # Find the matching closing ']'.
             # Markdown.pl allows *matching* brackets in link text so we
             # will here too. Markdown.pl *doesn't* currently allow
             # matching brackets in img alt text -- we'll differ in that
             # regard.
-            bracket_depth = 0
-
-            for p in range(
-                start_idx + 1,
-                min(start_idx + MAX_LINK_TEXT_SENTINEL, len(text))
-            ):
-                ch = text[p]
-                if ch == ']':
-                    bracket_depth -= 1
-                    if bracket_depth < 0:
-                        break
-                elif ch == '[':
-                    bracket_depth += 1
-            else:
+            p = brackets.find_close(text, start_idx, MAX_LINK_TEXT_SENTINEL)
+            if p == -1:
                 # Closing bracket not found within sentinel length.
                 # This isn't markup.
                 curr_pos = start_idx + 1
@@ -3237,13 +6132,15 @@ class LinkProcessor(Extra):
                         # insert special footnote marker that's easy to find and match against later
                         f'<a href="#fn-{normed_id}">{self.md._footnote_marker}-{normed_id}</a></sup>'
                     )
-                    text = text[:start_idx] + result + text[p+1:]
+                    flush(start_idx, result)
+                    flushed = curr_pos = p + 1
                 else:
                     # This id isn't defined, leave the markup alone.
                     curr_pos = p + 1
                 continue
 
             # Now determine what this is by the remainder.
+            close_idx = p
             p += 1
 
             # -- Extract the URL, title and end index from the link
@@ -3260,7 +6157,7 @@ class LinkProcessor(Extra):
                     curr_pos = start_idx + 1
                     continue
 
-                text, url, title, url_end_idx = parsed
+                new_text, url, title, url_end_idx = parsed
                 url = self.md._unhash_html_spans(url, code=True)
             # reference anchor or reference img
             else:
@@ -3273,12 +6170,16 @@ class LinkProcessor(Extra):
                     curr_pos = start_idx + 1
                     continue
 
-                text, url, title, url_end_idx = parsed
-                if url is None:
-                    # This id isn't defined, leave the markup alone.
-                    # set current pos to end of link title and continue from there
-                    curr_pos = p
-                    continue
+                new_text, url, title, url_end_idx = parsed
+
+            if new_text is not text:
+                brackets.moved(url_end_idx, len(text) - len(new_text))
+                text = new_text
+            if url is None:
+                # This id isn't defined, leave the markup alone.
+                # set current pos to end of link title and continue from there
+                curr_pos = p
+                continue
 
             # -- Encode and hash the URL and title to avoid conflicts with italics/bold
 
@@ -3302,7 +6203,12 @@ class LinkProcessor(Extra):
 
             # -- Process the anchor/image
 
-            is_img = start_idx > 0 and text[start_idx-1] == "!"
+            whole_start_idx = output_len + start_idx - flushed
+            if whole_start_idx and start_idx == flushed:
+                # the link comes right after the HTML of the one before
+                is_img = output[-1].endswith("!")
+            else:
+                is_img = whole_start_idx > 0 and text[start_idx-1] == "!"
             if is_img:
                 if 'img' not in self.options.get('tags', ['img']):
                     curr_pos = start_idx + 1
@@ -3312,9 +6218,16 @@ class LinkProcessor(Extra):
                     # expose span contents for escaping - fix #699, #703
                     link_text = self.md._unhash_html_spans(link_text, spans=True, code=True)
 
-                start_idx -= 1
+                whole_start_idx -= 1
+                if start_idx > flushed:
+                    start_idx -= 1
+                else:
+                    output[-1] = output[-1][:-1]
+                    output_len -= 1
+                    if not output[-1]:
+                        output.pop()
                 result, skip = self.process_image(url, title_str, link_text)
-            elif start_idx >= anchor_allowed_pos:
+            elif whole_start_idx >= anchor_allowed_pos:
                 if 'a' not in self.options.get('tags', ['a']):
                     curr_pos = start_idx + 1
                     continue
@@ -3331,11 +6244,85 @@ class LinkProcessor(Extra):
             # <img> allowed from curr_pos onwards, <a> allowed from anchor_allowed_pos onwards.
             # this means images can exist within `<a>` tags but anchors can only come after the
             # current anchor has been closed
-            curr_pos = start_idx + skip
-            anchor_allowed_pos = start_idx + len(result)
-            text = text[:start_idx] + result + text[url_end_idx:]
+            anchor_allowed_pos = whole_start_idx + len(result)
+            rest = result[skip:]
+            if '[' not in rest:
+                flush(start_idx, result)
+                flushed = curr_pos = url_end_idx
+            elif (
+                anchor_text_end == -1 and rest.startswith(link_text) and '[' not in rest[len(link_text):]
+                and text.startswith(link_text, close_idx - len(link_text)) and self._parses_within(link_text)
+            ):
+                # (only anchors get here, images being processed whole)
+                flush(start_idx, result[:skip])
+                flushed = curr_pos = close_idx - len(link_text)
+                anchor_text_end, anchor_tail, anchor_end = close_idx, rest[len(link_text):], url_end_idx
+            else:
+                flush(start_idx, result[:skip])
+                if anchor_text_end != -1:
+                    # within anchor text being processed in place, so its tail goes along too
+                    rest += text[url_end_idx:anchor_text_end] + anchor_tail
+                    url_end_idx = anchor_end
+                    anchor_text_end = -1
+                if self._parses_alone(rest):
+                    segments.append((text, brackets, url_end_idx))
+                    text = rest
+                    brackets = _LinkBrackets(rest)
+                else:
+                    brackets.moved(len(rest), url_end_idx - len(rest))
+                    text = rest + text[url_end_idx:]
+                self._brackets = brackets
+                flushed = curr_pos = 0
 
-        return text
+        flush(len(text), '')
+        self._brackets = outer_brackets
+        return ''.join(output)
+
+    _paren_angle_re = re.compile(r'\(\s*<')
+
+    def _parses_alone(self, html: str) -> bool:
+        '''
+        Whether parsing a link that starts within `html`, the rest of the HTML for a link,
+        can't look past the end of it, so that the links in it can be processed without
+        splicing it into the text. It could unless the parsing hooks are the ones here, each
+        `[` and `(` in it is closed, none of its URLs are in `<>` and it doesn't end with `]`.
+        '''
+        if html.rstrip(' \n').endswith(']') or self._paren_angle_re.search(html):
+            return False
+        for hook in ('parse_inline_anchor_or_image', 'parse_ref_anchor_or_ref_image', 'process_link_shortrefs'):
+            if getattr(type(self), hook) is not getattr(LinkProcessor, hook):
+                return False
+        squares = parens = 0
+        for char in _LinkBrackets._bracket_re.findall(html):
+            if char == '[':
+                squares += 1
+            elif char == '(':
+                parens += 1
+            elif char == ']':
+                squares = max(squares - 1, 0)
+            else:
+                parens = max(parens - 1, 0)
+        return not squares and not parens
+
+    def _parses_within(self, link_text: str) -> bool:
+        '''
+        Whether parsing a link that starts within `link_text` can't look past the end of it,
+        so that links within the text of an anchor needn't be copied along with the rest of
+        the text. It could unless the hooks are the ones here, there are no link shortrefs,
+        and the text has no `<` or unclosed parentheses.
+        '''
+        if '<' in link_text or 'link-shortrefs' in self.md.extras:
+            return False
+        for hook in ('parse_inline_anchor_or_image', 'parse_ref_anchor_or_ref_image', 'process_anchor', 'process_image'):
+            if getattr(type(self), hook) is not getattr(LinkProcessor, hook):
+                return False
+        opens = 0
+        for paren in re.findall(r'[()]', link_text):
+            if paren == '(':
+                opens += 1
+            elif opens:
+                opens -= 1
+        return not opens
 
     def test(self, text: str):
         return '(' in text or '[' in text
@@ -3352,6 +6339,7 @@ class Admonitions(Extra):
 
     name = 'admonitions'
     order = (Stage.BLOCK_GAMUT, Stage.LINK_DEFS), ()
+    triggers = ':'
 
     admonitions = r'admonition|attention|caution|danger|error|hint|important|note|tip|warning'
 
@@ -3364,8 +6352,10 @@ class Admonitions(Extra):
         re.IGNORECASE | re.MULTILINE | re.VERBOSE
     )
 
+    takes_test_result = True
+
     def test(self, text: str):
-        return self.admonitions_re.search(text) is not None
+        return self.admonitions_re.search(text)
 
     def sub(self, match: re.Match[str]) -> str:
         lead_indent, admonition_name, title, body = match.groups()
@@ -3395,8 +6385,11 @@ class Admonitions(Extra):
         # now indent the whole admonition back to where it started
         return self.md._uniform_indent(admonition, lead_indent, False)
 
-    def run(self, text: str):
-        return self.admonitions_re.sub(self.sub, text)
+    def run(self, text: str, match: Optional[re.Match[str]] = None):
+        if match is None:
+            return self.admonitions_re.sub(self.sub, text)
+        # carry on from the first admonition, which `test` found
+        return _sub_from(self.admonitions_re, self.sub, text, match.start())
 
 
 class Alerts(Extra):
@@ -3407,6 +6400,7 @@ class Alerts(Extra):
 
     name = 'alerts'
     order = (), (Stage.BLOCK_QUOTES, )
+    triggers = '<'
 
     alert_re = re.compile(r'''
         <blockquote>\s*
@@ -3445,6 +6439,7 @@ class _BreaksExtraOpts(TypedDict, total=False):
 class Breaks(Extra):
     name = 'breaks'
     order = (), (Stage.ITALIC_AND_BOLD,)
+    triggers = '\n'
     options: _BreaksExtraOpts
 
     def run(self, text: str):
@@ -3472,61 +6467,37 @@ class CodeFriendly(GFMItalicAndBoldProcessor):
     '''
     name = 'code-friendly'
     order = (Stage.ITALIC_AND_BOLD,), (Stage.ITALIC_AND_BOLD,)
+    triggers = '*_' + _PLACEHOLDER_CHAR
 
     def __init__(self, md, options):
         super().__init__(md, options)
         self.hash_table = {}
 
+    def reset(self):
+        self.hash_table = {}
+
     def run(self, text: str):
         if self.md.order < Stage.ITALIC_AND_BOLD:
+            # hash the underscores so that neither this nor the main emphasis pass can use them
+            text = re.sub(r'_+', lambda m: self._hash_text(m.group(0)), text)
             text = super().run(text)
         else:
-            orig_text = ''
-            while orig_text != text:
-                orig_text = text
-                for key, substr in self.hash_table.items():
-                    text = text.replace(key, substr)
+            text = _restore_placeholders(text, self.hash_table.get)
         return text
 
-    def process_span(
-        self, open: re.Match[str], close: re.Match[str], middle: Optional[re.Match[str]] = None,
-        open_syntax: Optional[str] = None, close_syntax: Optional[str] = None
-    ):
-        text = open.string[open.start(): close.end()]
-        open_syntax = open_syntax or cast(str, open.group(1))
-        close_syntax = close_syntax or cast(str, close.group(1))
-
-        if '_' in open_syntax:
-            # if using _this_ syntax, hash it to avoid processing, but don't hash the contents incase of nested syntax
-            text = re.sub(r'_+', lambda m: self._hash_text(m.group(0)), text)
-            return [text], None
-        elif '_' in text:
-            # if the text within the bold/em markers contains '_' then hash those chars to protect them from em_re
-            text = (
-                text[len(open_syntax): -len(close_syntax)]
-                .replace('__', self._hash_text('__'))
-                .replace('_', self._hash_text('_'))
-            )
-            return [open_syntax, text, close_syntax], None
-
-        return super().process_span(open, close, middle, open_syntax, close_syntax)
-
     def _hash_text(self, text: str):
         '''
         Wrapper around `_hash_text` that updates the entries in `self.hash_table`
         '''
-        # perf: avoid calling _hash_text if we can. Lookup in existing hash table
-        if text in self.hash_table.values():
-            return tuple(self.hash_table.keys())[tuple(self.hash_table.values()).index(text)]
-
-        # add a prefix to it so we don't interfere with escaped/hashed chars from other stages
-        hashed = _hash_text(self.name + text)
+        # add a prefix to it so we don't interfere with escaped/hashed chars from other stages.
+        # The same text always gets the same hash
+        hashed = self.md._hash_text(self.name + text)
         self.hash_table[hashed] = text
         return hashed
 
     def test(self, text: str):
         return super().test(text) or (
-            self.hash_table and re.search(r'md5-[0-9a-z]{32}', text)
+            self.hash_table and _PLACEHOLDER_CHAR in text
         )
 
 
@@ -3536,20 +6507,26 @@ class Emojis(Extra):
     '''
     name = 'emojis'
     order = (), (Stage.PARAGRAPHS,)
+    triggers = ':'
+    takes_test_result = True
 
     def __init__(self, md: Markdown, options: Optional[dict]):
         super().__init__(md, options)
         self.options.setdefault('language', 'alias')
 
-    def run(self, text):
+    def run(self, text, match: Optional[re.Match[str]] = None):
         try:
             import emoji
         except ImportError:
             raise ImportError('the "emoji" extra requires the "emoji" package to be installed')
 
+        start = 0
+        if match is not None and 'delimiters' not in self.options:
+            # no emoji identifier can start before the first one that `test` found
+            start = match.start()
         if self.options:
-            return emoji.emojize(text, **self.options)
-        return emoji.emojize(text)
+            return text[:start] + emoji.emojize(text[start:], **self.options)
+        return text[:start] + emoji.emojize(text[start:])
 
     def test(self, text):
         # emoji identifiers can have all sorts of chars (eg: `:A_button_(blood_type):`)
@@ -3567,6 +6544,7 @@ class FencedCodeBlocks(Extra):
 
     name = 'fenced-code-blocks'
     order = (Stage.LINK_DEFS, Stage.BLOCK_GAMUT), (Stage.PREPROCESS,)
+    triggers = '`'
 
     fenced_code_block_re = re.compile(r'''
         (?:\n+|\A\n?|(?<=\n))
@@ -3601,8 +6579,7 @@ class FencedCodeBlocks(Extra):
         formatter_opts = self.md.extras['fenced-code-blocks'] or {}
 
         def unhash_code(codeblock):
-            for key, sanitized in list(self.md.html_spans.items()):
-                codeblock = codeblock.replace(key, sanitized)
+            codeblock = _restore_placeholders(codeblock, self.md.html_spans.get)
             replacements = [
                 ("&amp;", "&"),
                 ("&lt;", "<"),
@@ -3614,7 +6591,9 @@ class FencedCodeBlocks(Extra):
         # remove leading indent from code block
         _, codeblock = self.md._uniform_outdent(codeblock, max_outdent=leading_indent)
 
-        codeblock = unhash_code(codeblock)
+        codeblock = unhash_code(codeblock).replace(
+            _reserved_placeholders[_PLACEHOLDER_CHAR], _reserved_placeholders[_CODE_PLACEHOLDER_CHAR]
+        )
         colored = self.md._color_with_pygments(codeblock, lexer,
                                                **formatter_opts)
 
@@ -3697,7 +6676,13 @@ class Latex(Extra):
     _single_re = re.compile(r'(?<!`)(`)(.*?)(?<!`)\1(?!`)') # Wrapped in a single `
 
     converter = None
-    code_blocks = {}
+
+    def __init__(self, md: Markdown, options: Optional[dict]):
+        super().__init__(md, options)
+        self.code_blocks = {}
+
+    def reset(self):
+        self.code_blocks = {}
 
     def _convert_single_match(self, match):
         return self.converter.convert(match.group(1))
@@ -3795,9 +6780,7 @@ class LinkPatterns(Extra):
                 link = '<a href="{}">{}</a>'.format(escaped_href, text[start:end])
                 hash = self.md._hash_span(link, link_from_hash)
                 text = text[:start] + hash + text[end:]
-        for hash, link in list(link_from_hash.items()):
-            text = text.replace(hash, link)
-        return text
+        return _restore_placeholders(text, link_from_hash.get)
 
     def test(self, text: str):
         return True
@@ -3812,6 +6795,7 @@ class MarkdownInHTML(Extra):
     '''
     name = 'markdown-in-html'
     order = (), (Stage.HASH_HTML,)
+    triggers = '<'
 
     def run(self, text: str):
         def callback(block: str):
@@ -3839,6 +6823,7 @@ class MarkdownFileLinks(LinkProcessor):
 
     name = 'markdown-file-links'
     order = (Stage.LINKS,), (Stage.LINK_DEFS,)
+    triggers = '(['
     options: _MarkdownFileLinksExtraOpts
 
     def __init__(self, md: Markdown, options: Optional[dict]):
@@ -3886,6 +6871,7 @@ class MiddleWordEm(GFMItalicAndBoldProcessor):
     '''
     name = 'middle-word-em'
     order = (CodeFriendly,), (Stage.ITALIC_AND_BOLD,)
+    triggers = '*_' + _PLACEHOLDER_CHAR
 
     def __init__(self, md: Markdown, options: Union[dict, bool, None]):
         '''
@@ -3903,29 +6889,43 @@ class MiddleWordEm(GFMItalicAndBoldProcessor):
         options.setdefault('allowed', True)
         super().__init__(md, options)
 
-        escaped_hashes = '|'.join(md._escape_table.values())
+        self.middle_word_em_re = self._middle_word_em_re(tuple(md._escape_table.values()))
+        self.reset()
+
+    def reset(self):
+        # add a prefix to it so we don't interfere with escaped/hashed chars from other stages.
+        # Placeholders are numbered per document, so these are too
+        self.hash_table = {
+            '_': self.md._hash_text(self.name + '_'),
+            '*': self.md._hash_text(self.name + '*')
+        }
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def _middle_word_em_re(escapes: tuple[str, ...]) -> re.Pattern[str]:
+        '''
+        Compile the regex for em chars in the middle of words. Every document of a profile
+        starts with the same escape table, so this only gets compiled once per profile
+        '''
+        escaped_hashes = '|'.join(escapes)
+        # placeholders vary in length, so each needs its own look-behind
+        not_after_escaped_hashes = ''.join('(?<!%s)' % key for key in escapes)
 
-        self.middle_word_em_re = re.compile(
+        return re.compile(
             r'''
             (?<!^)         # To be middle of a word, it cannot be at the start of the input
             (?<![*_\W])    # cannot be preceeded by em char or non word char (must be in middle of word)
-            (?<!%s)        # cannot be preceeded by a hashed escape char either
+            %s             # cannot be preceeded by a hashed escape char either
             ([*_])         # em char
             (?=\S)         # must be followed by non-whitespace char
             (?!
                 [*_]|$|\W  # cannot be followed by another em char, EOF or a non-word char
                 |%s        # Also cannot be followed by any of the escaped non-word chars
             )
-            ''' % (escaped_hashes, escaped_hashes),
+            ''' % (not_after_escaped_hashes, escaped_hashes),
             re.X | re.M
         )
 
-        # add a prefix to it so we don't interfere with escaped/hashed chars from other stages
-        self.hash_table = {
-            '_': _hash_text(self.name + '_'),
-            '*': _hash_text(self.name + '*')
-        }
-
     def run(self, text: str):
         if self.options['allowed']:
             # if middle word em is allowed, do nothing. This extra's only use is to prevent them
@@ -3951,7 +6951,7 @@ class MiddleWordEm(GFMItalicAndBoldProcessor):
 
     def test(self, text: str):
         return super().test(text) or (
-            self.hash_table and re.search(r'md5-[0-9a-z]{32}', text)
+            self.hash_table and _PLACEHOLDER_CHAR in text
         )
 
 
@@ -3963,6 +6963,7 @@ class Numbering(Extra):
 
     name = 'numbering'
     order = (Stage.LINK_DEFS,), ()
+    triggers = '['
 
     def run(self, text: str):
         # First pass to define all the references
@@ -4028,6 +7029,7 @@ class PyShell(Extra):
 
     name = 'pyshell'
     order = (), (Stage.LISTS,)
+    triggers = '>'
 
     def test(self, text: str):
         return ">>>" in text
@@ -4046,13 +7048,7 @@ class PyShell(Extra):
         return s
 
     def run(self, text: str):
-        less_than_tab = self.md.tab_width - 1
-        _pyshell_block_re = re.compile(r"""
-            ^([ ]{0,%d})>>>[ ].*\n  # first line
-            ^(\1[^\S\n]*\S.*\n)*    # any number of subsequent lines with at least one character
-            (?=^\1?\n|\Z)           # ends with a blank line or end of document
-            """ % less_than_tab, re.M | re.X)
-
+        _pyshell_block_re = _pyshell_block_re_from_tab_width(self.md.tab_width)
         return _pyshell_block_re.sub(self.sub, text)
 
 
@@ -4064,6 +7060,7 @@ class SmartyPants(Extra):
     '''
     name = 'smarty-pants'
     order = (), (Stage.SPAN_GAMUT,)
+    triggers = '\'"-.'
 
     _opening_single_quote_re = re.compile(r"(?<!\S)'(?=\S)")
     _opening_double_quote_re = re.compile(r'(?<!\S)"(?=\S)')
@@ -4135,6 +7132,7 @@ class Strike(Extra):
     '''
     name = 'strike'
     order = (Stage.ITALIC_AND_BOLD,), ()
+    triggers = '~'
 
     _strike_re = re.compile(r"~~(?=\S)(.+?)(?<=\S)~~", re.S)
 
@@ -4153,34 +7151,13 @@ class Tables(Extra):
     '''
     name = 'tables'
     order = (), (Stage.LISTS,)
+    triggers = '|'
 
     def run(self, text: str):
         """Copying PHP-Markdown and GFM table syntax. Some regex borrowed from
         https://github.com/michelf/php-markdown/blob/lib/Michelf/Markdown.php#L2538
         """
-        less_than_tab = self.md.tab_width - 1
-        table_re = re.compile(r'''
-                (?:(?<=\n)|\A\n?)             # leading blank line
-
-                ^[ ]{0,%d}                      # allowed whitespace
-                (.*[|].*)[ ]*\n                   # $1: header row (at least one pipe)
-
-                ^[ ]{0,%d}                      # allowed whitespace
-                (                               # $2: underline row
-                    # underline row with leading bar
-                    (?:  \|\ *:?-+:?\ *  )+  \|? \s?[ ]*\n
-                    |
-                    # or, underline row without leading bar
-                    (?:  \ *:?-+:?\ *\|  )+  (?:  \ *:?-+:?\ *  )? \s?[ ]*\n
-                )
-
-                (                               # $3: data rows
-                    (?:
-                        ^[ ]{0,%d}(?!\ )         # ensure line begins with 0 to less_than_tab spaces
-                        .*\|.*[ ]*\n
-                    )*
-                )
-            ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
+        table_re = _table_re_from_tab_width(self.md.tab_width)
         return table_re.sub(self.sub, text)
 
     @staticmethod
@@ -4243,6 +7220,7 @@ class Tables(Extra):
 class TelegramSpoiler(Extra):
     name = 'tg-spoiler'
     order = (), (Stage.ITALIC_AND_BOLD,)
+    triggers = '|'
 
     _tg_spoiler_re = re.compile(r"\|\|\s?(.+?)\s?\|\|", re.S)
 
@@ -4259,6 +7237,7 @@ class Underline(Extra):
     '''
     name = 'underline'
     order = (Stage.ITALIC_AND_BOLD,), ()
+    triggers = '-'
 
     _underline_re = re.compile(r"(?<!<!)--(?!>)(?=\S)(.+?)(?<=\S)(?<!<!)--(?!>)", re.S)
 
@@ -4287,10 +7266,14 @@ class Wavedrom(Extra):
     name = 'wavedrom'
     order = (Stage.CODE_BLOCKS, FencedCodeBlocks), ()
     options: _WavedromExtraOpts
+    takes_test_result = True
 
     def test(self, text: str):
+        # only if the first fenced code block is a wavedrom one
         match = FencedCodeBlocks.fenced_code_block_re.search(text)
-        return match is None or match.group(2) == 'wavedrom'
+        if match is not None and match.group(2) == 'wavedrom':
+            return match
+        return None
 
     def sub(self, match: re.Match[str]) -> str:
         # dedent the block for processing
@@ -4310,15 +7293,18 @@ class Wavedrom(Extra):
                 pass
 
         # hash SVG to prevent <> chars being messed with
-        self.md._escape_table[waves] = _hash_text(waves)
+        self.md._escape_table[waves] = self.md._hash_text(waves)
 
         return self.md._uniform_indent(
             '\n{}{}{}\n'.format(open_tag, self.md._escape_table[waves], close_tag),
             lead_indent, include_empty_lines=True
         )
 
-    def run(self, text: str):
-        return FencedCodeBlocks.fenced_code_block_re.sub(self.sub, text)
+    def run(self, text: str, match: Optional[re.Match[str]] = None):
+        if match is None:
+            return FencedCodeBlocks.fenced_code_block_re.sub(self.sub, text)
+        # carry on from the first fenced code block, which `test` found
+        return _sub_from(FencedCodeBlocks.fenced_code_block_re, self.sub, text, match.start())
 
 
 class WikiTables(Extra):
@@ -4328,14 +7314,10 @@ class WikiTables(Extra):
     '''
     name = 'wiki-tables'
     order = (Tables,), ()
+    triggers = '|'
 
     def run(self, text: str):
-        less_than_tab = self.md.tab_width - 1
-        wiki_table_re = re.compile(r'''
-            (?:(?<=\n\n)|\A\n?)            # leading blank line
-            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
-            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
-            ''' % less_than_tab, re.M | re.X)
+        wiki_table_re = _wiki_table_re_from_tab_width(self.md.tab_width)
         return wiki_table_re.sub(self.sub, text)
 
     def sub(self, match: re.Match[str]) -> str:
@@ -4452,6 +7434,63 @@ class UnicodeWithAttrs(str):
     """
     metadata: Optional[dict[str, str]] = None
     toc_html: Optional[str] = None
+    stats: Optional[ConversionStats] = None
+    '''How long the conversion took, with `Markdown(stats=...)`'''
+
+    def __reduce__(self):
+        # keep the attributes when pickled, eg: when returned from a worker process
+        return (_unicode_with_attrs, (str(self), self.toc_html, self.metadata, self.stats))
+
+
+def _counts_header_ids(extras: Mapping[str, Any]) -> bool:
+    '''Whether the `header-ids` extra is enabled and counts the ids across documents'''
+    header_ids = extras.get('header-ids')
+    return isinstance(header_ids, dict) and not header_ids.get('reset-count', False)
+
+
+def _result_size(rv: UnicodeWithAttrs) -> int:
+    '''Approximate size in bytes of a conversion result'''
+    size = sys.getsizeof(rv)
+    if rv.toc_html is not None:
+        size += sys.getsizeof(rv.toc_html)
+    if rv.metadata is not None:
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in rv.metadata.items())
+    return size
+
+
+def _unicode_with_attrs(
+    text: str,
+    toc_html: Optional[str],
+    metadata: Optional[dict[str, str]],
+    stats: Optional[ConversionStats] = None
+) -> UnicodeWithAttrs:
+    rv = UnicodeWithAttrs(text)
+    if toc_html is not None:
+        rv.toc_html = toc_html
+    if metadata is not None:
+        rv.metadata = metadata
+    if stats is not None:
+        rv.stats = stats
+    return rv
+
+
+def _copy_result(rv: UnicodeWithAttrs) -> UnicodeWithAttrs:
+    '''Copy a conversion result and its (possibly nested) metadata, leaving out its stats'''
+    return _unicode_with_attrs(str(rv), rv.toc_html, _copy_option(rv.metadata))
+
+
+# The `Markdown` instance used by a `Markdown.convert_many` worker process
+_worker_markdown: Optional[Markdown] = None
+
+
+def _init_worker(md: Markdown):
+    global _worker_markdown
+    _worker_markdown = md
+
+
+def _convert_in_worker(texts: list[str]) -> list[UnicodeWithAttrs]:
+    assert _worker_markdown is not None
+    return [_worker_markdown.convert(text) for text in texts]
 
 ## {{{ http://code.activestate.com/recipes/577257/ (r1)
 _slugify_strip_re = re.compile(r'[^\w\s-]')
@@ -4601,27 +7640,43 @@ def _dedent(text: str, tabsize: int = 8, skip_first_line: bool = False) -> str:
     return ''.join(lines)
 
 
+_MEMOIZED_CACHE_SIZE = 128
+
+
 class _memoized:
     """Decorator that caches a function's return value each time it is called.
     If called later with the same arguments, the cached value is returned, and
-    not re-evaluated.
+    not re-evaluated. Only the `_MEMOIZED_CACHE_SIZE` most recently used values
+    are kept, as some are keyed on text from the input (eg: tag names) or on
+    classes that would otherwise be kept alive.
 
     http://wiki.python.org/moin/PythonDecoratorLibrary
     """
     def __init__(self, func):
         self.func = func
-        self.cache = {}
+        self.cache: OrderedDict[tuple, Any] = OrderedDict()
 
     def __call__(self, *args):
         try:
-            return self.cache[args]
+            value = self.cache[args]
         except KeyError:
-            self.cache[args] = value = self.func(*args)
+            value = self.cache[args] = self.func(*args)
+            while len(self.cache) > _MEMOIZED_CACHE_SIZE:
+                try:
+                    self.cache.popitem(last=False)
+                except KeyError:
+                    break
             return value
         except TypeError:
             # uncachable -- for instance, passing a list as an argument.
             # Better to not cache than to blow up entirely.
             return self.func(*args)
+        try:
+            self.cache.move_to_end(args)
+        except KeyError:
+            # evicted by another thread in the meantime
+            pass
+        return value
 
     def __repr__(self):
         """Return the function's docstring."""
@@ -4670,6 +7725,253 @@ def _hr_tag_re_from_tab_width(tab_width: int) -> re.Pattern[str]:
 _hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
 
 
+def _html_tag_line_re(tags: str, allow_indent: bool) -> re.Pattern[str]:
+    """Regex for a line opening or closing one of `tags`, used by `Markdown._strict_tag_block_sub`."""
+    return re.compile(
+        r'^(\s{{0,{}}})(?:</code>(?=</pre>))?(</?({})\b>?)'.format('' if allow_indent else '0', tags)
+    )
+_html_tag_line_re = _memoized(_html_tag_line_re)
+
+
+def _tag_open_re(tag_name: str) -> re.Pattern[str]:
+    """Regex for the opening tags of `tag_name`, used by `Markdown._tag_is_closed`."""
+    return re.compile('<%s(?:.*?)>' % tag_name)
+_tag_open_re = _memoized(_tag_open_re)
+
+
+def _balanced_re(open_c: str, close_c: str) -> re.Pattern[str]:
+    """Regex for either of a pair of characters, used by `Markdown._find_balanced`."""
+    return re.compile('[%s%s]' % (re.escape(open_c), re.escape(close_c)))
+_balanced_re = _memoized(_balanced_re)
+
+
+def _extra_attr(klass: type['Extra'], attr: str, *methods: str) -> Any:
+    '''
+    An attribute of an `Extra` class that describes some of its methods (eg: `triggers`
+    for `test`), if the class that set it defines those methods or inherits them. If not,
+    the methods have been overridden since, so the attribute's default is returned.
+    '''
+    owner = next(k for k in klass.__mro__ if attr in vars(k))
+    for method in methods:
+        if not issubclass(owner, next(k for k in klass.__mro__ if method in vars(k))):
+            return getattr(Extra, attr)
+    return getattr(klass, attr)
+_extra_attr = _memoized(_extra_attr)
+
+
+def _extra_is_reusable(klass: type['Extra']) -> bool:
+    '''
+    Whether an `Extra` class's instances can be copied for each document. Only if the class
+    that defines its `reset` defines or inherits its `__init__`, so that `reset` knows about
+    any state that `__init__` sets up
+    '''
+    reset_owner = next(k for k in klass.__mro__ if 'reset' in vars(k))
+    return issubclass(reset_owner, next(k for k in klass.__mro__ if '__init__' in vars(k)))
+_extra_is_reusable = _memoized(_extra_is_reusable)
+
+
+def _sub_from(pattern: re.Pattern[str], repl: Callable[[re.Match[str]], str], text: str, pos: int) -> str:
+    '''`pattern.sub(repl, text)`, for a text that the pattern doesn't match before `pos`'''
+    parts = []
+    end = 0
+    for match in pattern.finditer(text, pos):
+        parts.append(text[end:match.start()])
+        parts.append(repl(match))
+        end = match.end()
+    if not parts:
+        return text
+    parts.append(text[end:])
+    return ''.join(parts)
+
+
+def _span_passes_for(cls: type['Markdown']) -> tuple[tuple[str, Optional[Stage], Optional[str]], ...]:
+    """
+    `Markdown._span_passes` for a `Markdown` class. Passes that the class overrides
+    can't be skipped, so what they look for is `None`.
+    """
+    return tuple(
+        (name, stage, looks_for if getattr(cls, name) is getattr(Markdown, name) else None)
+        for name, stage, looks_for in cls._span_passes
+    )
+_span_passes_for = _memoized(_span_passes_for)
+
+
+def _outdent_re_from_tab_width(tab_width: int) -> re.Pattern[str]:
+    return re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
+_outdent_re_from_tab_width = _memoized(_outdent_re_from_tab_width)
+
+
+def _link_def_re_from_tab_width(tab_width: int) -> re.Pattern[str]:
+    """Link definition regex, used by `Markdown._strip_link_definitions`."""
+    # Link defs are in the form:
+    #   [id]: url "optional title"
+    return re.compile(r"""
+        ^[ ]{0,%d}\[(.+)\]: # id = \1
+          [ \t]*
+          \n?               # maybe *one* newline
+          [ \t]*
+        <?(.+?)>?           # url = \2
+          [ \t]*
+        (?:
+            \n?             # maybe one newline
+            [ \t]*
+            (?<=\s)         # lookbehind for whitespace
+            ['"(]
+            ([^\n]*)        # title = \3
+            ['")]
+            [ \t]*
+        )?  # title is optional
+        (?:\n+|\Z)
+        """ % (tab_width - 1), re.X | re.M | re.U)
+_link_def_re_from_tab_width = _memoized(_link_def_re_from_tab_width)
+
+
+def _footnote_def_re_from_tab_width(tab_width: int) -> re.Pattern[str]:
+    """Footnote definition regex, used by `Markdown._strip_footnote_definitions`."""
+    return re.compile(r'''
+        ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
+        [ \t]*
+        (                       # footnote text = \2
+          # First line need not start with the spaces.
+          (?:\s*.*\n+)
+          (?:
+            (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
+            .*\n+
+          )*
+        )
+        # Lookahead for non-space at line-start, or end of doc.
+        (?:(?=^[ ]{0,%d}\S)|\Z)
+        ''' % (tab_width - 1, tab_width, tab_width),
+        re.X | re.M)
+_footnote_def_re_from_tab_width = _memoized(_footnote_def_re_from_tab_width)
+
+
+def _find_code_close(text: str, pos: int) -> tuple[int, bool]:
+    """
+    Used by `Markdown._do_code_blocks` to tell whether `pos` is inside the `<code>` of a
+    highlighted code block, that is, whether only text and `<span>` tags come before
+    the next `</code>`. Returns the position of the `<` where the search stopped (or
+    the length of the text) and whether it's a `</code>`.
+    """
+    while True:
+        pos = text.find('<', pos)
+        if pos == -1:
+            return len(text), False
+        if text.startswith('</code>', pos):
+            return pos, True
+        if text.startswith('<span', pos):
+            pos += 5
+        elif text.startswith('</span', pos):
+            pos += 6
+        else:
+            return pos, False
+
+
+def _list_res_from_tab_width(tab_width: int, sublist: bool) -> tuple[re.Pattern[str], re.Pattern[str]]:
+    """Whole-list regexes (unordered, then ordered), used by `Markdown._do_lists`.
+
+    We match ul and ol separately to avoid adjacent lists of different
+    types running into each other (see issue #16).
+    """
+    list_res = []
+    for marker_pat in (Markdown._marker_ul, Markdown._marker_ol):
+        other_marker_pat = Markdown._marker_ul if marker_pat == Markdown._marker_ol else Markdown._marker_ol
+        whole_list = r'''
+            (                   # \1 = whole list
+              (                 # \2
+                ([ ]{0,%d})     # \3 = the indentation level of the list item marker
+                (%s)            # \4 = first list item marker
+                [ \t]+
+                (?!\ *\4\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+              )
+              (?:.+?)
+              (                 # \5
+                  \Z
+                |
+                  \n{2,}
+                  (?=\S)
+                  (?!           # Negative lookahead for another list item marker
+                    [ \t]*
+                    %s[ \t]+
+                  )
+                |
+                  \n+
+                  (?=
+                    \3          # lookahead for a different style of list item marker
+                    %s[ \t]+
+                  )
+              )
+            )
+        ''' % (tab_width - 1, marker_pat, marker_pat, other_marker_pat)
+        if sublist:
+            list_res.append(re.compile("^"+whole_list, re.X | re.M | re.S))
+        else:
+            list_res.append(re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
+                                       re.X | re.M | re.S))
+    return tuple(list_res)
+_list_res_from_tab_width = _memoized(_list_res_from_tab_width)
+
+
+def _list_start_res_from_tab_width(tab_width: int) -> tuple[re.Pattern[str], re.Pattern[str]]:
+    """
+    Regexes (unordered, then ordered) for the first line of a list, as matched by
+    `_list_res_from_tab_width`. Used by `_TreeBuilder`.
+    """
+    return tuple(
+        re.compile(r'([ ]{0,%d})(%s)[ \t]+(?!\ *\2\ )' % (tab_width - 1, marker_pat))
+        for marker_pat in (Markdown._marker_ul, Markdown._marker_ol)
+    )
+_list_start_res_from_tab_width = _memoized(_list_start_res_from_tab_width)
+
+
+def _pyshell_block_re_from_tab_width(tab_width: int) -> re.Pattern[str]:
+    """Python interactive shell session regex, used by the `PyShell` extra."""
+    return re.compile(r"""
+        ^([ ]{0,%d})>>>[ ].*\n  # first line
+        ^(\1[^\S\n]*\S.*\n)*    # any number of subsequent lines with at least one character
+        (?=^\1?\n|\Z)           # ends with a blank line or end of document
+        """ % (tab_width - 1), re.M | re.X)
+_pyshell_block_re_from_tab_width = _memoized(_pyshell_block_re_from_tab_width)
+
+
+def _table_re_from_tab_width(tab_width: int) -> re.Pattern[str]:
+    """GFM table regex, used by the `Tables` extra."""
+    less_than_tab = tab_width - 1
+    return re.compile(r'''
+            (?:(?<=\n)|\A\n?)             # leading blank line
+
+            ^[ ]{0,%d}                      # allowed whitespace
+            (.*[|].*)[ ]*\n                   # $1: header row (at least one pipe)
+
+            ^[ ]{0,%d}                      # allowed whitespace
+            (                               # $2: underline row
+                # underline row with leading bar
+                (?:  \|\ *:?-+:?\ *  )+  \|? \s?[ ]*\n
+                |
+                # or, underline row without leading bar
+                (?:  \ *:?-+:?\ *\|  )+  (?:  \ *:?-+:?\ *  )? \s?[ ]*\n
+            )
+
+            (                               # $3: data rows
+                (?:
+                    ^[ ]{0,%d}(?!\ )         # ensure line begins with 0 to less_than_tab spaces
+                    .*\|.*[ ]*\n
+                )*
+            )
+        ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
+_table_re_from_tab_width = _memoized(_table_re_from_tab_width)
+
+
+def _wiki_table_re_from_tab_width(tab_width: int) -> re.Pattern[str]:
+    """Google Code wiki table regex, used by the `WikiTables` extra."""
+    return re.compile(r'''
+        (?:(?<=\n\n)|\A\n?)            # leading blank line
+        ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
+        (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
+        ''' % (tab_width - 1), re.M | re.X)
+_wiki_table_re_from_tab_width = _memoized(_wiki_table_re_from_tab_width)
+
+
 def _xml_escape_attr(attr: str, skip_single_quote: bool = True) -> str:
     """Escape the given string for use in an HTML/XML tag attribute.
 
@@ -0,0 +1,637 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for markdown2.
+
+Usage:
+    python perf/bench.py            # run all benchmarks
+    python perf/bench.py NAME ...   # run the named benchmarks
+    python perf/bench.py --list     # list the available benchmarks
+"""
+
+import asyncio
+import gc
+import resource
+import sys
+import time
+import timeit
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+LIB_DIR = Path(__file__).parent.parent / "lib"
+sys.path.insert(0, str(LIB_DIR))
+
+import markdown2  # noqa: E402
+
+
+# Short, chat sized messages where the cost of setting up a converter is
+# comparable to the cost of the conversion itself
+CHAT_MESSAGES = [
+    "Hello *world*!",
+    "Sure, try `pip install markdown2` and then run it again.",
+    "1. first\n2. second\n3. third\n",
+    "See [the docs](https://github.com/trentm/python-markdown2/wiki) for **more**.",
+    "```python\nprint('hi')\n```\n",
+    "> quoted text\n\nand a reply",
+]
+
+CHAT_EXTRAS = ["fenced-code-blocks", "tables", "strike", "footnotes", "toc", "code-friendly"]
+
+
+def _report(label, seconds, calls):
+    print(f"  {label:<40} {seconds / calls * 1e6:10.1f} us/call")
+
+
+def _best_of(fn, number, repeat=5):
+    return min(timeit.repeat(fn, number=number, repeat=repeat))
+
+
+def per_call_overhead(number=2000):
+    """
+    Per-call cost of converting small messages with a new `Markdown` each time,
+    the module level `markdown()` function and a reused `MarkdownProfile`.
+    """
+    texts = CHAT_MESSAGES
+    calls = number * len(texts)
+
+    def new_instance():
+        for text in texts:
+            markdown2.Markdown(extras=CHAT_EXTRAS).convert(text)
+
+    def module_function():
+        for text in texts:
+            markdown2.markdown(text, extras=CHAT_EXTRAS)
+
+    profile = markdown2.MarkdownProfile(extras=CHAT_EXTRAS)
+
+    def reused_profile():
+        for text in texts:
+            profile.convert(text)
+
+    md = markdown2.Markdown(extras=CHAT_EXTRAS)
+
+    def reused_instance():
+        for text in texts:
+            md.convert(text)
+
+    for label, fn in (
+        ("Markdown(...).convert(text)", new_instance),
+        ("markdown(text, ...)", module_function),
+        ("MarkdownProfile.convert(text)", reused_profile),
+        ("reused Markdown.convert(text)", reused_instance),
+    ):
+        _report(label, _best_of(fn, number), calls)
+
+
+# Every extra that can be used without an optional dependency or extra argument
+ALL_EXTRAS = [
+    "admonitions", "alerts", "breaks", "code-friendly", "cuddled-lists", "fenced-code-blocks",
+    "footnotes", "header-ids", "markdown-file-links", "markdown-in-html", "middle-word-em",
+    "smarty-pants", "strike", "tables", "tag-friendly", "task_list", "toc", "underline", "wiki-tables",
+]
+
+
+def extras_setup(number=2000):
+    """
+    Per-call cost of converting small messages with lots of extras enabled, where
+    setting the extras up for each document is comparable to converting it.
+    """
+    texts = CHAT_MESSAGES
+    calls = number * len(texts)
+    md = markdown2.Markdown(extras=ALL_EXTRAS)
+
+    def module_function():
+        for text in texts:
+            markdown2.markdown(text, extras=ALL_EXTRAS)
+
+    def reused_instance():
+        for text in texts:
+            md.convert(text)
+
+    def new_document():
+        for _ in texts:
+            md._new_document()
+
+    for label, fn in (
+        ("markdown(text, ...)", module_function),
+        ("reused Markdown.convert(text)", reused_instance),
+        ("setting up a document", new_document),
+    ):
+        _report(label, _best_of(fn, number), calls)
+
+
+def _document(i):
+    """A medium sized document with per-document footnotes, link defs and headers."""
+    return (
+        f"# Document {i}\n\n"
+        f"Some *text* with a [link][ref{i}] and a footnote.[^n{i}]\n\n"
+        "## Details\n\n"
+        + "".join(f"- item {j} with `code {j}` and **bold**\n" for j in range(20))
+        + "\n```python\nprint('hello')\n```\n\n"
+        f"[ref{i}]: https://example.com/{i}\n\n"
+        f"[^n{i}]: Footnote for document {i}.\n"
+    )
+
+
+def thread_scaling(docs=400):
+    """
+    Throughput of a single shared `Markdown` instance converting documents from
+    1, 2, 4 and 8 threads, checking every result against a serial conversion.
+    """
+    texts = [_document(i) for i in range(docs)]
+    md = markdown2.Markdown(extras=CHAT_EXTRAS)
+    expected = [md.convert(text) for text in texts]
+
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print(f"  (GIL {'enabled' if gil else 'disabled'})")
+
+    baseline = None
+    for threads in (1, 2, 4, 8):
+        with ThreadPoolExecutor(threads) as pool:
+            start = time.perf_counter()
+            results = list(pool.map(md.convert, texts))
+            elapsed = time.perf_counter() - start
+        for result, html in zip(results, expected):
+            assert result == html and result.toc_html == html.toc_html, "thread interference"
+        baseline = baseline or elapsed
+        print(f"  {threads} thread(s): {docs / elapsed:10.1f} docs/s  ({baseline / elapsed:.2f}x)")
+
+
+def async_latency(size=200_000):
+    """
+    Longest event loop stall while converting a large (~200KB) document inline,
+    with `convert_async` in a thread and with `convert_async` in a process pool.
+    """
+    block = _document(0)
+    text = block * (size // len(block))
+    md = markdown2.Markdown(extras=CHAT_EXTRAS)
+
+    async def measure(convert):
+        stalls = [0.0]
+
+        async def ticker():
+            last = time.perf_counter()
+            while True:
+                await asyncio.sleep(0.001)
+                now = time.perf_counter()
+                stalls.append(now - last)
+                last = now
+
+        tick = asyncio.ensure_future(ticker())
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        await convert()
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.01)  # let the ticker see any stall at the end
+        tick.cancel()
+        return elapsed, max(stalls)
+
+    async def inline():
+        md.convert(text)
+
+    async def threaded():
+        await md.convert_async(text)
+
+    with ProcessPoolExecutor(1) as pool:
+        async def process():
+            await md.convert_async(text, executor=pool)
+
+        for label, convert in (
+            ("inline convert()", inline),
+            ("convert_async, thread", threaded),
+            ("convert_async, process", process),
+        ):
+            elapsed, stall = asyncio.run(measure(convert))
+            print(f"  {label:<40} {elapsed:8.2f}s total, longest stall {stall * 1000:8.1f}ms")
+
+
+def incremental_edit(size=200_000, edits=20):
+    """
+    Re-converting a large (~200KB) document after a one character edit, with
+    `Markdown.convert` and with `IncrementalMarkdown.convert`.
+    """
+    block = _document(0)
+    text = block * (size // len(block))
+    md = markdown2.Markdown(extras=CHAT_EXTRAS)
+    incremental = markdown2.IncrementalMarkdown(md)
+    incremental.convert(text)
+
+    middle = len(text) // 2
+    versions = [text[:middle] + "x" * (i + 1) + text[middle:] for i in range(edits)]
+    for label, convert in (
+        ("Markdown.convert", md.convert),
+        ("IncrementalMarkdown.convert", incremental.convert),
+    ):
+        start = time.perf_counter()
+        for version in versions:
+            convert(version)
+        _report(label, time.perf_counter() - start, edits)
+    print(f"  (blocks re-converted by the last edit: {incremental.blocks_converted})")
+    assert incremental.convert(versions[-1]) == md.convert(versions[-1])
+
+
+def _log_entry(i):
+    """A section of a log-style document."""
+    return (
+        f"### {i:06d} worker-{i % 8}\n\n"
+        f"Processed request `{i}` in **{i % 97}ms**.\n\n"
+        f"    trace {i:08x}\n    status ok\n\n"
+    )
+
+
+def stream_conversion(size=800_000):
+    """
+    Time to the first HTML, total time and peak memory converting a large log-style
+    document with `convert` and with `convert_stream` reading it a line at a time.
+    """
+    entry = _log_entry(0)
+    count = size // len(entry)
+    text = "".join(_log_entry(i) for i in range(count))
+    md = markdown2.Markdown(extras=CHAT_EXTRAS)
+
+    def convert():
+        yield md.convert(text)
+
+    def stream():
+        return md.convert_stream(_log_entry(i) for i in range(count))
+
+    for label, fn in (
+        ("convert(text)", convert),
+        ("convert_stream(lines)", stream),
+    ):
+        start = time.perf_counter()
+        first = None
+        for _ in fn():
+            first = first or time.perf_counter() - start
+        elapsed = time.perf_counter() - start
+
+        # measured separately, as tracing allocations slows everything down
+        tracemalloc.start()
+        for _ in fn():
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"  {label:<40} first HTML {first:8.3f}s, total {elapsed:8.2f}s, peak {peak / 1e6:8.1f}MB")
+    print(f"  (input {len(text) / 1e6:.1f}MB)")
+
+
+def _chat_reply(size):
+    """A chat reply of about `size` characters, with a mix of block types."""
+    section = (
+        "Here's how you'd do it, with **some** `inline code` and a [link](https://example.com):\n\n"
+        "```\nfor i in range(10):\n    print(i)\n```\n\n"
+        "- first point\n- second *point*\n- third point\n\n"
+        "| a | b |\n|---|---|\n| 1 | 2 |\n\n"
+    )
+    return section * (size // len(section))
+
+
+def streaming_append(size=10_000, delta=8):
+    """
+    Rendering a ~10KB chat reply as it arrives a few characters at a time, by
+    re-converting all of the text so far and with `StreamingMarkdown.append`.
+    """
+    text = _chat_reply(size)
+    deltas = [text[i:i + delta] for i in range(0, len(text), delta)]
+    md = markdown2.Markdown(extras=CHAT_EXTRAS)
+
+    def reconvert():
+        so_far = ""
+        for piece in deltas:
+            so_far += piece
+            html = md.convert(so_far)
+        return html
+
+    def append():
+        stream = markdown2.StreamingMarkdown(md)
+        final = ""
+        for piece in deltas:
+            new, tail = stream.append(piece)
+            final += new
+        return final + tail
+
+    assert reconvert() == append()
+    for label, fn in (
+        ("Markdown.convert(text so far)", reconvert),
+        ("StreamingMarkdown.append(delta)", append),
+    ):
+        _report(label, _best_of(fn, 1, repeat=3), len(deltas))
+    print(f"  ({len(deltas)} deltas of {delta} characters)")
+
+
+def _code_heavy_document(size):
+    """A document that is mostly code spans, fenced code blocks and backslash escapes."""
+    section = (
+        "Call `foo(a, b)` or `bar[i]` with `**kwargs`, not \\*args\\* or \\_private\\_.\n\n"
+        "```\nfor (i = 0; i < n; i++) {\n    total += values[i] * 2;\n}\n```\n\n"
+        "```\n$ make && make install\n$ ./run --flag=1\n```\n\n"
+    )
+    return section * (size // len(section))
+
+
+def _link_heavy_document(size):
+    """A document that is mostly inline links, reference links and auto links."""
+    section = (
+        "See [the docs](https://example.com/docs?page=1&lang=en \"Docs\"), the [wiki][wiki], "
+        "<https://example.com/issues> and ![a logo](https://example.com/logo.png).\n\n"
+        "[wiki]: https://example.com/wiki?a=1&b=2\n\n"
+    )
+    return section * (size // len(section))
+
+
+def placeholder_throughput(size=100_000, number=5):
+    """
+    Conversion throughput of (~100KB) documents that are heavy on code and on links,
+    which have lots of text swapped out for placeholders while they're converted.
+    """
+    md = markdown2.Markdown(extras=CHAT_EXTRAS)
+    for label, text in (
+        ("code-heavy document", _code_heavy_document(size)),
+        ("link-heavy document", _link_heavy_document(size)),
+    ):
+        seconds = _best_of(lambda: md.convert(text), number, repeat=3) / number
+        print(f"  {label:<40} {len(text) / seconds / 1e6:10.2f} MB/s")
+
+
+def _span_heavy_paragraphs(spans):
+    """Paragraphs of code spans, inline links, images and backslash escapes."""
+    return "".join(
+        f"`c{i}` [l{i}](https://example.com/{i} \"t{i}\") ![a{i}](i{i}.png) \\*x{i}\\*"
+        + ("\n\n" if i % 10 == 9 else " ")
+        for i in range(spans)
+    )
+
+
+def placeholder_restoration(sizes=(500, 2000, 8000)):
+    """
+    Conversion time of documents with 500, 2000 and 8000 code spans, links, images
+    and escapes, which should go up linearly with the number of placeholders.
+    """
+    md = markdown2.Markdown(extras=CHAT_EXTRAS)
+    previous = None
+    for spans in sizes:
+        text = _span_heavy_paragraphs(spans)
+        seconds = _best_of(lambda: md.convert(text), 1, repeat=3)
+        growth = f"  ({seconds / previous:.1f}x)" if previous else ""
+        previous = seconds
+        print(f"  {spans:>6} spans ({len(text) / 1e3:6.0f}KB)              {seconds * 1000:10.1f} ms{growth}")
+
+
+def _emphasis_heavy_document(size):
+    """Paragraphs of nested, adjacent and unmatched emphasis and strong delimiters."""
+    section = (
+        "Some *em*, **strong** and ***both***, *a **nested *em* in** it*, snake_case_names, "
+        "**a* b* c**, a * b ** c and an *unclosed **one.\n\n"
+    )
+    return section * (size // len(section))
+
+
+def emphasis_scaling(sizes=(25_000, 50_000, 100_000, 200_000)):
+    """
+    Conversion time of emphasis heavy documents of 25KB to 200KB, which should
+    double along with the size of the document.
+    """
+    md = markdown2.Markdown()
+    previous = None
+    for size in sizes:
+        text = _emphasis_heavy_document(size)
+        seconds = _best_of(lambda: md.convert(text), 1, repeat=3)
+        growth = f"  ({seconds / previous:.1f}x)" if previous else ""
+        previous = seconds
+        print(f"  {len(text) / 1e3:6.0f}KB document                       {seconds * 1000:10.1f} ms{growth}")
+
+
+def _block_heavy_document(size):
+    """Lots of short bulleted lists, between paragraphs, headers, blockquotes and code blocks."""
+    section = (
+        "## Steps\n\nFirst:\n\n- check the *input*\n- check the output\n\n    print(it)\n\n"
+        "Then:\n\n- run it\n- run it again\n\n> a note\n> about it\n\n"
+    )
+    return section * (size // len(section))
+
+
+def _checklist(items):
+    """A nested task list with a paragraph of notes every 150 items."""
+    parts = []
+    for i in range(items // 3):
+        parts.append(f"- [ ] task {i}\n    - [x] step {i}\n    - [ ] step {i} *done*\n")
+        if i % 50 == 49:
+            parts.append(f"\nNotes for section {i}.\n\n")
+    return "".join(parts)
+
+
+def list_scaling(sizes=(12_500, 25_000, 50_000)):
+    """
+    Conversion time of nested checklists of 12,500 to 50,000 items, which should
+    double along with the number of items.
+    """
+    md = markdown2.Markdown(extras=["task_list"])
+    previous = None
+    for items in sizes:
+        text = _checklist(items)
+        seconds = _best_of(lambda: md.convert(text), 1, repeat=1)
+        growth = f"  ({seconds / previous:.1f}x)" if previous else ""
+        previous = seconds
+        print(f"  {items:>6} items ({len(text) / 1e3:6.0f}KB)              {seconds * 1000:10.1f} ms{growth}")
+
+
+def _indented_snippets(snippets):
+    """Short paragraphs, each introducing an indented code block."""
+    return "".join(
+        f"Step {i}, see `run`:\n\n    run --step {i}\n    check {i} <output>\n\n" for i in range(snippets)
+    )
+
+
+def code_block_scaling(sizes=(1250, 2500, 5000)):
+    """
+    Conversion time of documents with 1,250 to 5,000 indented code blocks, which should
+    double along with the number of blocks.
+    """
+    md = markdown2.Markdown()
+    previous = None
+    for snippets in sizes:
+        text = _indented_snippets(snippets)
+        seconds = _best_of(lambda: md.convert(text), 1, repeat=3)
+        growth = f"  ({seconds / previous:.1f}x)" if previous else ""
+        previous = seconds
+        print(f"  {snippets:>6} blocks ({len(text) / 1e3:6.0f}KB)             {seconds * 1000:10.1f} ms{growth}")
+
+
+def _html_heavy_document(posts):
+    """Exported CMS content: `<div>`s and comments between paragraphs, and the odd unclosed tag."""
+    parts = []
+    for i in range(posts):
+        parts.append(
+            f'<div class="post" id="p{i}">\n<p>Post {i} with <a href="/p/{i}">a link</a>.</p>\n'
+            f'<!-- meta: {i} -->\n</div>\n\n<!-- separator {i} -->\n\nSome *markdown* about post {i}.\n\n'
+        )
+        if i % 10 == 0:
+            parts.append(f'<section class="unclosed">\n\n<span class="note">\nnote {i}</span>\n\n')
+    return "".join(parts)
+
+
+def html_block_scaling(sizes=(1000, 2000, 4000)):
+    """
+    Conversion time of documents with 1,000 to 4,000 posts of block HTML and comments,
+    which should double along with the number of posts.
+    """
+    md = markdown2.Markdown()
+    previous = None
+    for posts in sizes:
+        text = _html_heavy_document(posts)
+        seconds = _best_of(lambda: md.convert(text), 1, repeat=3)
+        growth = f"  ({seconds / previous:.1f}x)" if previous else ""
+        previous = seconds
+        print(f"  {posts:>6} posts ({len(text) / 1e3:6.0f}KB)              {seconds * 1000:10.1f} ms{growth}")
+
+
+def _link_index(links):
+    """A generated API index: a single paragraph of inline, reference and image links."""
+    parts = [
+        f"[`func{i}`](api/m.html#f{i} \"f {i}\"), [ref {i}][r{i % 50}] [![icon](i/{i}.png)](api/{i}) [x]\n"
+        for i in range(links // 3)
+    ]
+    parts.extend(f"\n[r{i}]: /refs/{i}\n" for i in range(50))
+    return "".join(parts)
+
+
+def link_scaling(sizes=(3000, 6000, 12000)):
+    """
+    Conversion time of a paragraph with 3,000 to 12,000 links, which should double along
+    with the number of links.
+    """
+    md = markdown2.Markdown()
+    previous = None
+    for links in sizes:
+        text = _link_index(links)
+        seconds = _best_of(lambda: md.convert(text), 1, repeat=3)
+        growth = f"  ({seconds / previous:.1f}x)" if previous else ""
+        previous = seconds
+        print(f"  {links:>6} links ({len(text) / 1e3:6.0f}KB)              {seconds * 1000:10.1f} ms{growth}")
+
+
+def _table_heavy_document(rows):
+    """A table of short cells, most of them plain text."""
+    return "| id | name | value | notes |\n|---|---|---|---|\n" + "".join(
+        f"| {i} | name {i} | `v{i}` | some *text* here |\n" for i in range(rows)
+    )
+
+
+def _list_heavy_document(items):
+    """A long bulleted list of short items with a little markup in each."""
+    return "".join(f"- item {i} with **bold** and a [link](/{i})\n" for i in range(items))
+
+
+def span_throughput(rows=5000, number=3):
+    """
+    Conversion throughput of a table and of a list with thousands of short
+    cells and items, each of which goes through the span gamut.
+    """
+    md = markdown2.Markdown(extras=["tables"])
+    for label, text in (
+        ("table-heavy document", _table_heavy_document(rows)),
+        ("list-heavy document", _list_heavy_document(rows * 2)),
+    ):
+        seconds = _best_of(lambda: md.convert(text), number, repeat=3) / number
+        print(f"  {label:<40} {len(text) / seconds / 1e6:10.2f} MB/s")
+
+
+def parse_tree(size=200_000, number=3):
+    """
+    Time taken to get the structure of a ~200KB document with `Markdown.parse`, compared
+    to converting it and then parsing the HTML with `html.parser`.
+    """
+    from html.parser import HTMLParser
+
+    text = _block_heavy_document(size // 2) + _link_heavy_document(size // 2)
+    md = markdown2.Markdown()
+    document = md.parse(text)
+
+    def convert_and_parse_html():
+        parser = HTMLParser()
+        parser.feed(md.convert(text))
+        parser.close()
+
+    for label, fn in (
+        ("parse", lambda: md.parse(text)),
+        ("render", lambda: md.render(document)),
+        ("convert", lambda: md.convert(text)),
+        ("convert + html.parser", convert_and_parse_html),
+    ):
+        seconds = _best_of(fn, number, repeat=3) / number
+        print(f"  {label:<40} {seconds * 1000:10.1f} ms")
+
+
+def _soak_document(i):
+    """A small document with text that's different every time, so that nothing can be reused."""
+    return (
+        _document(i)
+        + f"Some *emphasis {i}* and *a <span>span {i}</span> in* it_{i}_too.\n\n"
+        + _span_heavy_paragraphs(20).replace("example.com", f"example{i}.com")
+    )
+
+
+def soak(batches=10, docs=500):
+    """
+    Conversion time and peak RSS over batches of 500 different documents converted by
+    one long lived `Markdown` instance, checking that neither grows as it goes on.
+    """
+    md = markdown2.Markdown(extras={**dict.fromkeys(CHAT_EXTRAS), "middle-word-em": False})
+    times = []
+    rss = []
+    for batch in range(batches):
+        texts = [_soak_document(batch * docs + i) for i in range(docs)]
+        start = time.perf_counter()
+        for text in texts:
+            md.convert(text)
+        times.append(time.perf_counter() - start)
+        gc.collect()
+        # KB on Linux, bytes on macOS
+        rss.append(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1e3 if sys.platform != "darwin" else 1e6))
+        print(f"  batch {batch:<3} {times[-1] / docs * 1e6:10.1f} us/doc, peak RSS {rss[-1]:8.1f}MB")
+
+    # the first batch warms things up (caches, the allocator etc.). Compare the fastest
+    # batches from the start and the end of the run, as those are the least noisy
+    assert min(times[-3:]) < min(times[1:4]) * 1.5, "conversion time grew over the run"
+    assert rss[-1] - rss[1] < 10, "memory grew over the run"
+
+
+# whack everything in a dict for easy lookup later on
+BENCHMARKS = {
+    fn.__name__: fn
+    for fn in [
+        per_call_overhead,
+        extras_setup,
+        thread_scaling,
+        async_latency,
+        incremental_edit,
+        stream_conversion,
+        streaming_append,
+        placeholder_throughput,
+        placeholder_restoration,
+        emphasis_scaling,
+        list_scaling,
+        code_block_scaling,
+        html_block_scaling,
+        link_scaling,
+        span_throughput,
+        parse_tree,
+        soak,
+    ]
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:]
+    if "--list" in names:
+        for name, fn in BENCHMARKS.items():
+            print(f"{name}: {' '.join(fn.__doc__.split())}")
+        sys.exit(0)
+
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        sys.exit(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    for name in names or BENCHMARKS:
+        print(f"-- {name}")
+        BENCHMARKS[name]()
@@ -15,6 +15,9 @@ import difflib
 import doctest
 from json import loads as json_loads
 import warnings
+import gc
+import weakref
+import threading
 
 sys.path.insert(0, join(dirname(dirname(abspath(__file__)))))
 try:
@@ -389,6 +392,718 @@ versions of markdown2.py this was pathologically slow:</p>
         self.assertEqual(expected_toc_html, md.convert(html).toc_html)
     test_toc_with_persistent_object.tags = ["toc", "issue208"]
 
+    def test_profile_is_hashable_and_reusable(self):
+        extras = {"header-ids": "pre", "breaks": {"on_backslash": True}}
+        profile = markdown2.MarkdownProfile(extras=extras)
+        self.assertEqual(profile, markdown2.MarkdownProfile(extras=extras))
+        self.assertEqual(hash(profile), hash(markdown2.MarkdownProfile(extras=extras)))
+        self.assertNotEqual(profile, markdown2.MarkdownProfile(extras=["header-ids"]))
+        with self.assertRaises(AttributeError):
+            profile.tab_width = 8
+        # normalising the options must not modify the caller's dict
+        self.assertEqual(extras, {"header-ids": "pre", "breaks": {"on_backslash": True}})
+
+        expected = '<h1 id="pre-title">Title</h1>\n'
+        self.assertEqual(profile.convert('# Title'), expected)
+        self.assertEqual(profile.convert('# Title'), expected)
+        self.assertEqual(markdown2.Markdown(profile=profile).convert('# Title'), expected)
+        self.assertEqual(markdown2.markdown('# Title', extras=extras), expected)
+    test_profile_is_hashable_and_reusable.tags = ["profile", "extras"]
+
+    def test_shared_instance_across_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        md = markdown2.Markdown(extras=["footnotes", "toc", "fenced-code-blocks"])
+        texts = [
+            "# Doc %d\n\nSee [here][%d] and note.[^%d]\n\n"
+            "```\ncode %d\n```\n\n[%d]: /doc/%d\n\n[^%d]: note %d\n" % ((i,) * 8)
+            for i in range(50)
+        ]
+        expected = [markdown2.Markdown(extras=["footnotes", "toc", "fenced-code-blocks"]).convert(t)
+                    for t in texts]
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(md.convert, texts * 4))
+        for result, html in zip(results, expected * 4):
+            self.assertEqual(result, html)
+            self.assertEqual(result.toc_html, html.toc_html)
+    test_shared_instance_across_threads.tags = ["threads"]
+
+    def test_convert_many(self):
+        texts = ["# Title %d\n\nSome *text*" % i for i in range(40)]
+        md = markdown2.Markdown(extras=["toc"])
+        expected = [md.convert(text) for text in texts]
+
+        results = list(md.convert_many(texts, workers=2, chunksize=3))
+        self.assertEqual(results, expected)
+        self.assertEqual([r.toc_html for r in results], [e.toc_html for e in expected])
+
+        results = sorted(markdown2.markdown_many(
+            iter(texts), workers=2, chunksize=5, ordered=False, extras=["toc"]))
+        self.assertEqual(results, list(enumerate(expected)))
+    test_convert_many.tags = ["batch"]
+
+    def test_pickle_result_attrs(self):
+        import pickle
+        html = markdown2.markdown("---\ntitle: Hi\n---\n# Body\n", extras=["toc", "metadata"])
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            unpickled = pickle.loads(pickle.dumps(html, protocol))
+            self.assertIsInstance(unpickled, markdown2.UnicodeWithAttrs)
+            self.assertEqual(unpickled, html)
+            self.assertEqual(unpickled.toc_html, html.toc_html)
+            self.assertEqual(unpickled.metadata, {"title": "Hi"})
+    test_pickle_result_attrs.tags = ["batch", "toc", "metadata"]
+
+    def test_convert_async(self):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        texts = ["# Title %d\n\nSome *text*" % i for i in range(10)]
+        md = markdown2.Markdown(extras=["toc"])
+        expected = [md.convert(text) for text in texts]
+        threads = threading.active_count()
+
+        async def convert_all(executor):
+            return await asyncio.gather(*(md.convert_async(text, executor=executor) for text in texts))
+
+        with ThreadPoolExecutor(2) as executor:
+            for executor in (None, executor):
+                results = asyncio.run(convert_all(executor))
+                self.assertEqual(results, expected)
+                self.assertEqual([r.toc_html for r in results], [e.toc_html for e in expected])
+        self.assertEqual(asyncio.run(markdown2.markdown_async("*hi*")), "<p><em>hi</em></p>\n")
+        # the default executor is the event loop's, which is shut down along with the loop
+        self.assertEqual(threading.active_count(), threads)
+    test_convert_async.tags = ["async"]
+
+    def test_conversion_cache(self):
+        cache = markdown2.ConversionCache(max_entries=2)
+        md = markdown2.Markdown(extras=["toc", "metadata"], cache=cache)
+        text = "---\ntitle: Hi\n---\n# Body\n"
+        html = md.convert(text)
+        cached = md.convert(text)
+        self.assertEqual(cached, html)
+        self.assertEqual(html.toc_html, markdown2.markdown(text, extras=["toc", "metadata"]).toc_html)
+        self.assertEqual(cached.toc_html, html.toc_html)
+        self.assertEqual(html.metadata, {"title": "Hi"})
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 1, 0))
+        # each hit gets its own copy of the result, so changes to one don't reach the others
+        self.assertIsNot(cached, html)
+        html.metadata["title"] = "Changed"
+        cached.metadata["title"] = "Changed"
+        self.assertEqual(md.convert(text).metadata, {"title": "Hi"})
+
+        # different options or converter classes don't share results
+        self.assertEqual(markdown2.markdown(text, cache=cache), "<hr />\n\n<h2>title: Hi</h2>\n\n<h1>Body</h1>\n")
+        self.assertEqual(markdown2.markdown(text, cache=cache, extras=["metadata"]), "<h1>Body</h1>\n")
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (2, 3, 1))
+        self.assertEqual(len(cache), 2)
+
+        cache = markdown2.ConversionCache(max_entries=None, max_bytes=2000)
+        for i in range(20):
+            markdown2.markdown("paragraph %d " % i * 10, cache=cache)
+        self.assertLessEqual(cache.nbytes, 2000)
+        self.assertEqual(len(cache) + cache.evictions, 20)
+        self.assertGreater(cache.evictions, 0)
+
+        # header ids counted across documents carry on from the conversions before, so
+        # aren't cached
+        cache = markdown2.ConversionCache()
+        md = markdown2.Markdown(extras={"header-ids": {"reset-count": False}}, cache=cache)
+        self.assertEqual(md.convert("# Head\n"), '<h1 id="head">Head</h1>\n')
+        self.assertEqual(md.convert("# Head\n"), '<h1 id="head-2">Head</h1>\n')
+        self.assertEqual((len(cache), cache.hits, cache.misses), (0, 0, 0))
+
+        # nor are the results of options that can't be compared by value, which no other
+        # instance could look up
+        class Linker:
+            def __call__(self, match):
+                return "/" + match.group(0)
+            def __eq__(self, other):
+                return isinstance(other, Linker)
+        md = markdown2.Markdown(extras=["link-patterns"], link_patterns=[(re.compile("x"), Linker())], cache=cache)
+        for _ in range(2):
+            self.assertEqual(md.convert("x\n"), '<p><a href="/x">x</a></p>\n')
+        self.assertEqual((len(cache), cache.hits, cache.misses), (0, 0, 0))
+    test_conversion_cache.tags = ["cache"]
+
+    def test_markdown_path_disk_cache(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "doc.md")
+            with open(path, "w") as f:
+                f.write("---\ntitle: Hi\n---\n# Body\n")
+            cache = markdown2.DiskCache(os.path.join(tmp, "cache"))
+            extras = ["toc", "metadata"]
+
+            html = markdown2.markdown_path(path, extras=extras, cache=cache)
+            self.assertEqual(html, markdown2.markdown_path(path, extras=extras))
+            cached = markdown2.markdown_path(path, extras=extras, cache=cache)
+            self.assertEqual(cached, html)
+            self.assertEqual(cached.toc_html, html.toc_html)
+            self.assertEqual(cached.metadata, {"title": "Hi"})
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # other options, or a changed file, are misses
+            markdown2.markdown_path(path, cache=cache)
+            with open(path, "w") as f:
+                f.write("# Changed\n")
+            self.assertEqual(markdown2.markdown_path(path, extras=extras, cache=cache),
+                             '<h1 id="changed">Changed</h1>\n')
+            self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+            # a shared directory works between caches (eg: in other processes)
+            other = markdown2.DiskCache(os.path.join(tmp, "cache"))
+            markdown2.markdown_path(path, extras=extras, cache=other)
+            self.assertEqual(other.hits, 1)
+
+            small = markdown2.DiskCache(os.path.join(tmp, "small"), max_bytes=1000)
+            for i in range(20):
+                with open(path, "w") as f:
+                    f.write("paragraph %d " % i * 10)
+                markdown2.markdown_path(path, cache=small)
+            self.assertGreater(small.evictions, 0)
+            self.assertLessEqual(sum(e.stat().st_size for e in os.scandir(small.directory)), 1000)
+    test_markdown_path_disk_cache.tags = ["cache"]
+
+    def test_markdown_path_disk_cache_link_pattern_callbacks(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "doc.md")
+            with open(path, "w") as f:
+                f.write("see Issue 1\n")
+            cache = markdown2.DiskCache(os.path.join(tmp, "cache"))
+            pattern = re.compile(r"Issue \d+")
+
+            # callbacks with the same shape (but that call other methods) don't share results
+            upper = markdown2.markdown_path(path, extras=["link-patterns"], cache=cache,
+                                            link_patterns=[(pattern, lambda m: m.group().upper())])
+            lower = markdown2.markdown_path(path, extras=["link-patterns"], cache=cache,
+                                            link_patterns=[(pattern, lambda m: m.group().lower())])
+            self.assertIn('href="ISSUE 1"', upper)
+            self.assertIn('href="issue 1"', lower)
+            self.assertEqual(cache.hits, 0)
+
+            # nor do ones whose defaults differ
+            def prefixed(m, prefix="a/"):
+                return prefix + m.group()
+            first = markdown2.markdown_path(path, extras=["link-patterns"], cache=cache,
+                                            link_patterns=[(pattern, prefixed)])
+            prefixed.__defaults__ = ("b/",)
+            second = markdown2.markdown_path(path, extras=["link-patterns"], cache=cache,
+                                             link_patterns=[(pattern, prefixed)])
+            self.assertIn('href="a/Issue 1"', first)
+            self.assertIn('href="b/Issue 1"', second)
+            self.assertEqual(cache.hits, 0)
+    test_markdown_path_disk_cache_link_pattern_callbacks.tags = ["cache"]
+
+    def test_conversion_stats(self):
+        text = "- one *two*\n\n    > three\n\n- four\n\n```\ncode\n```\n"
+        self.assertIsNone(markdown2.markdown(text).stats)
+
+        seen = []
+        md = markdown2.Markdown(extras=["fenced-code-blocks"], stats=seen.append)
+        html = md.convert(text)
+        self.assertEqual(html, markdown2.markdown(text, extras=["fenced-code-blocks"]))
+        self.assertEqual(seen, [html.stats])
+        timings = html.stats.timings
+        # the list items go through the block gamut again, but are only timed once
+        self.assertEqual(timings[markdown2.Stage.BLOCK_GAMUT].calls, 4)
+        self.assertLessEqual(timings[markdown2.Stage.LISTS].seconds, timings[markdown2.Stage.BLOCK_GAMUT].seconds)
+        self.assertLessEqual(timings[markdown2.Stage.BLOCK_GAMUT].seconds, html.stats.seconds)
+        self.assertEqual(timings["fenced-code-blocks.run"].calls, 1)
+        self.assertGreater(timings["fenced-code-blocks.run"].chars_out, timings["fenced-code-blocks.run"].chars_in)
+        self.assertEqual(timings[markdown2.Stage.POSTPROCESS].chars_out, len(html) - 1)
+        self.assertIn("fenced-code-blocks.run", str(html.stats))
+
+        # each conversion gets its own stats
+        md.convert(text)
+        self.assertEqual(len(seen), 2)
+        self.assertIsNot(seen[0], seen[1])
+
+        # stages with none of their trigger characters are skipped, rather than called
+        timings = markdown2.Markdown(stats=True).convert("plain text\n").stats.timings
+        self.assertEqual((timings[markdown2.Stage.HEADERS].calls, timings[markdown2.Stage.HEADERS].skips), (0, 1))
+        self.assertEqual(timings[markdown2.Stage.PARAGRAPHS].skips, 0)
+
+        # results from the cache get stats of their own, and the cache doesn't keep any
+        seen = []
+        cache = markdown2.ConversionCache()
+        md = markdown2.Markdown(cache=cache, stats=seen.append)
+        first, second = md.convert(text), md.convert(text)
+        self.assertEqual(first, second)
+        self.assertEqual((first.stats.cached, second.stats.cached), (False, True))
+        self.assertEqual(second.stats.timings, {})
+        self.assertEqual(seen, [first.stats, second.stats])
+        self.assertIsNone(markdown2.Markdown(cache=cache).convert(text).stats)
+
+        # the callback isn't sent to worker processes, but called in this one
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor
+        seen = []
+        md = markdown2.Markdown(stats=lambda stats: seen.append(stats))
+        results = list(md.convert_many(["*a*", "*b*"], workers=1))
+        with ProcessPoolExecutor(1) as executor:
+            results.append(asyncio.run(md.convert_async("*c*", executor=executor)))
+        self.assertEqual(results, ["<p><em>%s</em></p>\n" % c for c in "abc"])
+        self.assertEqual(seen, [result.stats for result in results])
+    test_conversion_stats.tags = ["stats"]
+
+    def test_incremental_markdown(self):
+        extras = ["footnotes", "toc", "fenced-code-blocks"]
+        md = markdown2.Markdown(extras=extras)
+        incremental = markdown2.IncrementalMarkdown(extras=extras)
+        paragraphs = ["Paragraph %d with a [link][ref]." % i for i in range(10)]
+        versions = [
+            ["# Intro", "A footnote.[^1]"] + paragraphs + ["[ref]: /a", "[^1]: First."],
+            # an edit to one paragraph
+            ["# Intro", "A footnote.[^1]"] + paragraphs[:5] + ["Edited."] + paragraphs[6:]
+            + ["[ref]: /a", "[^1]: First."],
+            # a changed link definition is used by every paragraph
+            ["# Intro", "A footnote.[^1]"] + paragraphs + ["[ref]: /b", "[^1]: First."],
+            # a changed footnote
+            ["# Intro", "A footnote.[^1]"] + paragraphs + ["[ref]: /b", "[^1]: Second."],
+            # a new header changes the ids of the headers after it
+            ["# Intro", "A footnote.[^1]"] + paragraphs + ["# Intro", "[ref]: /b", "[^1]: Second."],
+            ["# Intro", "```\ncode\n\n# not a header\n```"] + paragraphs + ["# Intro", "[ref]: /b"],
+            ["- # Intro"] + paragraphs + ["# Intro", "[ref]: /b"],
+        ]
+        converted = []
+        for version in versions:
+            text = "\n\n".join(version) + "\n"
+            html = incremental.convert(text)
+            expected = md.convert(text)
+            self.assertEqual(html, expected)
+            self.assertEqual(html.toc_html, expected.toc_html)
+            converted.append(incremental.blocks_converted)
+        self.assertEqual(converted[:5], [12, 1, 10, 2, 2])
+        self.assertTrue(all(converted))
+
+        # options that need the whole document fall back to full conversions
+        incremental = markdown2.IncrementalMarkdown(extras=["numbering"])
+        text = "[#fig]: # (Figure #)\n\nSee [#fig].\n"
+        self.assertEqual(incremental.convert(text), markdown2.markdown(text, extras=["numbering"]))
+
+        # block quotes that run on into the blocks after them
+        for extras, text in (
+            (["pyshell"], " >>> 1 + 1\n>>> 2 + 2\n\n4\n"),
+            (["alerts"], "> [!NOTE]\n\n> Advises about risks ...\n"),
+            ([], "> quote\n## Head ##\n    code\n\npara\n"),
+            (["fenced-code-blocks"], "> # h\n\n    ```\n    code\n    ```\n\n```\nb\n```\n"),
+        ):
+            md = markdown2.Markdown(extras=extras)
+            expected = md.convert(text)
+            self.assertEqual(markdown2.IncrementalMarkdown(extras=extras).convert(text), expected)
+            self.assertEqual("".join(md.convert_stream(text.splitlines(True))), expected)
+            stream = markdown2.StreamingMarkdown(extras=extras)
+            self.assertEqual(stream.append(text)[0] + stream.close(), expected)
+    test_incremental_markdown.tags = ["incremental"]
+
+    def test_convert_stream(self):
+        extras = ["footnotes", "toc", "metadata", "fenced-code-blocks"]
+        text = (
+            "---\ntitle: Stream\n---\n# One\r\n\r\nA [link][ref] and a note.[^1]\n\n"
+            "```\n\ncode\n\n```\n\n# One\n\n\tindented café\n\n"
+            "[ref]: /url\n[^1]: The note.\n"
+        )
+        md = markdown2.Markdown(extras=extras)
+        expected = md.convert(text)
+        for chunks in (list(text), text.splitlines(True), [text.encode("utf-8")[i:i + 3] for i in range(0, 200, 3)]):
+            parts = list(md.convert_stream(chunks))
+            self.assertEqual("".join(parts), expected)
+            self.assertEqual(parts[-1].toc_html, expected.toc_html)
+            self.assertEqual(parts[-1].metadata, {"title": "Stream"})
+
+        consumed = []
+        def lines():
+            for line in ["# Title\n", "\n", "Some [text][].\n", "\n", "More.\n", "\n", "[text]: /url\n"]:
+                consumed.append(line)
+                yield line
+        stream = md.convert_stream(lines())
+        # the first block is output as soon as the next one starts
+        self.assertEqual(next(stream), '<h1 id="title">Title</h1>')
+        self.assertEqual(len(consumed), 3)
+        # but one with an undefined link waits, in case it's defined later
+        self.assertEqual(next(stream), '\n\n<p>Some <a href="/url">text</a>.</p>')
+        self.assertEqual(len(consumed), 7)
+        self.assertEqual("".join(md.convert_stream(lines(), wait_for_definitions=False)),
+                         '<h1 id="title">Title</h1>\n\n<p>Some [text][].</p>\n\n<p>More.</p>\n')
+
+        # options that need the whole document are converted in one piece
+        parts = list(markdown2.markdown_stream(["[#fig]: # (Figure #)\n\n", "See [#fig].\n"], extras=["numbering"]))
+        self.assertEqual(len(parts), 1)
+
+        # code hashed in blocks that are converted again together, or in definitions
+        md = markdown2.Markdown(extras=["fenced-code-blocks", "toc", "footnotes"])
+        for text in self._streamed_code_texts:
+            self.assertEqual("".join(md.convert_stream([text])), md.convert(text))
+    test_convert_stream.tags = ["stream"]
+
+    _streamed_code_texts = (
+        "```\n```\n> # h in quote",
+        "a\n\n```\nb\n```\n\n> # h\n\n```\nb\n```\n",
+        "```\n```\n> # h\n",
+        "x[^1]\n\n[^1]: note\n\n    ```\n    code\n    ```\n\ny\n",
+    )
+
+    def test_streaming_markdown(self):
+        extras = ["footnotes", "toc", "fenced-code-blocks", "tables"]
+        text = (
+            "# Reply\n\nHere's *some* code:\n\n```python\nprint('hi')\n\n```\n\n"
+            "| a | b |\n|---|---|\n| 1 | 2 |\n\n- one\n- two[^1]\n\n[^1]: A note.\n"
+        )
+        md = markdown2.Markdown(extras=extras)
+        stream = markdown2.StreamingMarkdown(md)
+        final = ""
+        for i in range(0, len(text), 7):
+            new, tail = stream.append(text[i:i + 7])
+            final += new
+            expected = md.convert(text[:i + 7])
+            self.assertEqual(final + tail, expected)
+            self.assertEqual(tail.toc_html, expected.toc_html)
+        # most of the document has been output by the end
+        self.assertTrue(final.startswith('<h1 id="reply">Reply</h1>\n\n<p>Here\'s <em>some</em> code:</p>'))
+        self.assertEqual(final + stream.close(), md.convert(text))
+        self.assertRaises(ValueError, stream.append, "more")
+        self.assertRaises(ValueError, stream.close)
+
+        for text in self._streamed_code_texts:
+            stream = markdown2.StreamingMarkdown(md)
+            self.assertEqual(stream.append(text)[0] + stream.close(), md.convert(text))
+
+        # options that need the whole document re-convert it all each time
+        stream = markdown2.StreamingMarkdown(extras=["numbering"])
+        self.assertEqual(stream.append("[#fig]: # (Figure #)\n\nSee [#fig].\n"),
+                         ("", markdown2.markdown("[#fig]: # (Figure #)\n\nSee [#fig].\n", extras=["numbering"])))
+    test_streaming_markdown.tags = ["stream"]
+
+    def test_placeholder_char_in_input(self):
+        # text made up to look like placeholders is left alone
+        char = markdown2._PLACEHOLDER_CHAR
+        text = "".join(f"{char}{n}h " for n in range(30)) + "`code` \\* [^1]\n\n[^1]: note\n"
+        html = markdown2.markdown(text, extras=["footnotes"])
+        self.assertTrue(html.startswith(
+            "<p>" + "".join(f"&#xa66e;{n}h " for n in range(30)) + "<code>code</code> * <sup"
+        ))
+        self.assertNotIn(char, html)
+
+        # but otherwise, and in code, they're output as they are
+        text = f"# {char}\n\n{char} `{char}1h`\n\n    {char}2h\n"
+        html = markdown2.markdown(text, extras=["toc"])
+        self.assertEqual(html, (
+            f'<h1 id="{char}">{char}</h1>\n\n<p>{char} <code>{char}1h</code></p>\n\n'
+            f'<pre><code>{char}2h\n</code></pre>\n'
+        ))
+        self.assertEqual(html.toc_html, f'<ul>\n  <li><a href="#{char}">{char}</a></li>\n</ul>\n')
+    test_placeholder_char_in_input.tags = ["unicode"]
+
+    def test_documents_not_kept_alive(self):
+        # nothing should hang on to the state of a conversion once it's done
+        documents = []
+
+        class Markdown(markdown2.Markdown):
+            def _new_document(self, *args, **kwargs):
+                md = super()._new_document(*args, **kwargs)
+                documents.append(weakref.ref(md))
+                return md
+
+        md = Markdown(extras={"code-friendly": None, "middle-word-em": False})
+        for i in range(3):
+            md.convert(f"some *em {i}* and *more <span>text</span> here* in_the_middle\n")
+        gc.collect()
+        self.assertEqual(len(documents), 3)
+        self.assertEqual([ref for ref in documents if ref() is not None], [])
+    test_documents_not_kept_alive.tags = ["memory"]
+
+    def test_memoized_caches_are_bounded(self):
+        # what's worked out for each `Markdown` class is cached, but only for so many classes
+        classes = []
+        for i in range(markdown2._MEMOIZED_CACHE_SIZE + 10):
+            cls = type(f"Markdown{i}", (markdown2.Markdown,), {})
+            self.assertEqual(cls().convert("*a*\n"), "<p><em>a</em></p>\n")
+            classes.append(weakref.ref(cls))
+        del cls
+        gc.collect()
+        self.assertLessEqual(len(markdown2._span_passes_for.cache), markdown2._MEMOIZED_CACHE_SIZE)
+        self.assertIsNone(classes[0]())
+    test_memoized_caches_are_bounded.tags = ["memory"]
+
+    def test_document_state_after_convert(self):
+        # the state of the last conversion can still be read from the instance
+        md = markdown2.Markdown(extras=["footnotes", "metadata", "toc", "strike"])
+        md.convert("---\ntitle: Hi\n---\n# Head\n\n<div>x</div>\n\nnote[^1]\n\n[^1]: text\n[a]: /url\n")
+        self.assertEqual(md.urls, {"a": "/url"})
+        self.assertEqual(md.metadata, {"title": "Hi"})
+        self.assertEqual(list(md.footnotes), ["1"])
+        self.assertEqual(md._toc, [(1, "head", "Head")])
+        self.assertTrue(md.html_blocks)
+        self.assertIs(md.extra_classes["strike"].md, md)
+
+        md.convert("# Other\n")
+        self.assertEqual(md.urls, {})
+        self.assertEqual(md._toc, [(1, "other", "Other")])
+
+        # header ids counted across documents stay unique between threads
+        import pickle
+        from concurrent.futures import ThreadPoolExecutor
+        md = markdown2.Markdown(extras={"header-ids": {"reset-count": False}})
+        with ThreadPoolExecutor(4) as pool:
+            html = "".join(pool.map(md.convert, ["# Same\n" * 20] * 20))
+        ids = re.findall(r'id="([^"]+)"', html)
+        self.assertEqual(len(ids), 400)
+        self.assertEqual(len(set(ids)), 400)
+        self.assertEqual(pickle.loads(pickle.dumps(md)).convert("# Same\n"), '<h1 id="same-401">Same</h1>\n')
+    test_document_state_after_convert.tags = ["threads"]
+
+    def test_many_lists(self):
+        # adjacent lists of different styles stay separate (issue #16)
+        html = markdown2.markdown("- a\n- b\n1. c\n2. d\n- e\n")
+        self.assertEqual(html.count("<ul>"), 2)
+        self.assertEqual(html.count("<ol>"), 1)
+
+        html = markdown2.markdown("para\n\n- a\n- b\n\n1. c\n\n" * 500)
+        self.assertEqual(html.count("<ul>"), 500)
+        self.assertEqual(html.count("<ol>"), 500)
+        self.assertEqual(html.count("<p>para</p>"), 500)
+    test_many_lists.tags = ["lists"]
+
+    def test_many_code_blocks(self):
+        html = markdown2.markdown("para\n\n    code\n    more\n\n" * 500)
+        self.assertEqual(html.count("<pre><code>code\nmore\n</code></pre>"), 500)
+
+        md = markdown2.Markdown()
+        md.reset()
+        # indented lines inside highlighted code are left alone
+        text = '<pre><code>\n\n    <span class="k">def</span> f():\n\n</code></pre>\n'
+        self.assertEqual(md._do_code_blocks(text), text)
+        # a block that can't run on to the end of its lines ends before the last line
+        # indented by exactly a tab-width of spaces
+        html = md._do_code_blocks("\n    one\n    two\n\t three\n   \tfour\n")
+        self.assertTrue(html.startswith("\n<pre><code>"))
+        self.assertTrue(html.endswith("\n</code></pre>\n    two\n\t three\n   \tfour\n"))
+    test_many_code_blocks.tags = ["code"]
+
+    def test_many_html_blocks(self):
+        text = (
+            '<div class="post">\n<p>A <a href="/">post</a>.</p>\n<!-- meta -->\n</div>\n\n'
+            '<!-- separator -->\n\nSome *markdown*.\n\n<section>\n\nnever closed\n\n'
+        ) * 200
+        html = markdown2.markdown(text)
+        self.assertEqual(html.count('<div class="post">\n<p>A <a href="/">post</a>.</p>\n<!-- meta -->\n</div>'), 200)
+        self.assertEqual(html.count('\n\n<!-- separator -->\n\n'), 200)
+        self.assertEqual(html.count('<p>Some <em>markdown</em>.</p>'), 200)
+        self.assertEqual(html.count('<p><section></p>'), 200)
+    test_many_html_blocks.tags = ["html"]
+
+    def test_many_links(self):
+        text = "[a](/a) [![i](/i.png)](/b) [c][] [not a link] [^1] ![d][c]\n" * 300 + "\n[c]: /c\n"
+        html = markdown2.markdown(text)
+        self.assertEqual(html.count('<a href="/a">a</a>'), 300)
+        self.assertEqual(html.count('<a href="/b"><img src="/i.png" alt="i" /></a>'), 300)
+        self.assertEqual(html.count('<a href="/c">c</a>'), 300)
+        self.assertEqual(html.count('<img src="/c" alt="d" />'), 300)
+        self.assertEqual(html.count('[not a link] [^1]'), 300)
+        # links in the HTML of links, parentheses in URLs, and parentheses that aren't closed
+        text = "[<b>x</b> ![i](/i.png)](/x) [e](/e(f)) [g](h (i) ( j\n" * 300
+        html = markdown2.markdown(text)
+        self.assertEqual(html.count('<a href="/x"><b>x</b> <img src="/i.png" alt="i" /></a>'), 300)
+        self.assertEqual(html.count('<a href="/e(f)">e</a>'), 300)
+        self.assertEqual(html.count('[g](h (i) ( j'), 300)
+    test_many_links.tags = ["links"]
+
+    def test_overridden_span_pass(self):
+        # passes with nothing to do are skipped, but not if a subclass overrides them
+        class ShoutingMarkdown(markdown2.Markdown):
+            def _do_auto_links(self, text):
+                return text.upper()
+
+        self.assertEqual(markdown2.markdown("| a | b |\n|---|---|\n| c | d |\n", extras=["tables"]).count("<td>c</td>"), 1)
+        self.assertEqual(ShoutingMarkdown().convert("plain text"), "<p>PLAIN TEXT</p>\n")
+    test_overridden_span_pass.tags = ["extensibility"]
+
+    def test_custom_extra_stages(self):
+        class Recorder(markdown2.Extra):
+            name = 'recorder'
+            order = (markdown2.Stage.CODE_SPANS,), (markdown2.Stage.CODE_SPANS,)
+
+            def run(self, text):
+                self.md.recorded.append(self.md.order)
+                return text
+
+            def test(self, text):
+                return 'code' in text
+
+        Recorder.register()
+        try:
+            md = markdown2.Markdown(extras=['recorder'])
+            md.recorded = []
+            md.convert("plain text\n\nsome `code`\n")
+            self.assertEqual(md.recorded, [markdown2.Stage.CODE_SPANS - 0.5, markdown2.Stage.CODE_SPANS + 0.5])
+            md = markdown2.Markdown()
+            md.recorded = []
+            md.convert("some `code`\n")
+            self.assertEqual(md.recorded, [])
+        finally:
+            Recorder.deregister()
+    test_custom_extra_stages.tags = ["extensibility"]
+
+    def test_extra_triggers(self):
+        class Backticks(markdown2.Extra):
+            name = 'backticks'
+            order = (markdown2.Stage.CODE_SPANS,), ()
+            triggers = '`'
+
+            def run(self, text):
+                self.md.recorded.append(text)
+                return text
+
+        class AllText(Backticks):
+            # overriding `test` means the triggers aren't inherited
+            name = 'all-text'
+
+            def test(self, text):
+                return True
+
+        for klass, recorded in ((Backticks, ['some `code`']), (AllText, ['plain text', 'some `code`'])):
+            klass.register()
+            try:
+                md = markdown2.Markdown(extras=[klass.name])
+                md.recorded = []
+                md.convert("plain text\n\nsome `code`\n")
+                self.assertEqual(md.recorded, recorded)
+            finally:
+                klass.deregister()
+    test_extra_triggers.tags = ["extensibility"]
+
+    def test_extra_takes_test_result(self):
+        class FirstWord(markdown2.Extra):
+            name = 'first-word'
+            order = (markdown2.Stage.CODE_SPANS,), ()
+            takes_test_result = True
+
+            def test(self, text):
+                return re.search(r'\w+', text)
+
+            def run(self, text, match=None):
+                self.md.recorded.append(match and match.group())
+                return text
+
+        class SearchesAgain(FirstWord):
+            # overriding `run` means it isn't handed the result of `test`
+            name = 'searches-again'
+
+            def run(self, text):
+                self.md.recorded.append(text)
+                return text
+
+        for klass, recorded in ((FirstWord, ['plain', 'some']), (SearchesAgain, ['plain text', 'some `code`'])):
+            klass.register()
+            try:
+                md = markdown2.Markdown(extras=[klass.name])
+                md.recorded = []
+                md.convert("plain text\n\nsome `code`\n")
+                self.assertEqual(md.recorded, recorded)
+            finally:
+                klass.deregister()
+    test_extra_takes_test_result.tags = ["extensibility"]
+
+    def test_extra_reset(self):
+        class Collector(markdown2.Extra):
+            name = 'collector'
+            order = (markdown2.Stage.CODE_SPANS,), ()
+            created = 0
+
+            def __init__(self, md, options):
+                super().__init__(md, options)
+                type(self).created += 1
+                self.seen = []
+
+            def reset(self):
+                self.seen = []
+
+            def run(self, text):
+                self.seen.append(text)
+                return text
+
+        class Forgetful(Collector):
+            # overriding `__init__` but not `reset` means it's created for each document
+            name = 'forgetful'
+            created = 0
+
+            def __init__(self, md, options):
+                super().__init__(md, options)
+
+        for klass, created in ((Collector, 1), (Forgetful, 3)):
+            klass.register()
+            try:
+                md = markdown2.Markdown(extras=[klass.name])
+                for text in ('one', 'two', 'three'):
+                    doc = md._new_document()
+                    doc._convert(text)
+                    extra = doc.extra_classes[klass.name]
+                    self.assertIs(extra.md, doc)
+                    self.assertEqual(extra.seen, [text])
+                self.assertEqual(klass.created, created)
+            finally:
+                klass.deregister()
+    test_extra_reset.tags = ["extensibility"]
+
+    def test_parse_and_render(self):
+        import pickle
+        text = (
+            "---\ntitle: Doc\n---\n# Title\n\nSome *text* and <b>html</b>\n\n"
+            "- one\n- two\n    1. nested\n\n> quote\n> > nested\n\n    code\n\n"
+            "```python\nfenced\n```\n\n---\n\n[ref]: /url \"Title\"\n[^1]: A footnote\n"
+        )
+        extras = ["metadata", "fenced-code-blocks", "footnotes"]
+        md = markdown2.Markdown(extras=extras)
+        doc = pickle.loads(pickle.dumps(md.parse(text)))
+        self.assertEqual(doc.metadata, {"title": "Doc"})
+        self.assertEqual(
+            [(node.kind, node.info, doc.source(node)) for node in doc.children],
+            [
+                ("header", 1, "# Title"),
+                ("paragraph", None, "Some *text* and <b>html</b>"),
+                ("list", "-", "- one\n- two\n    1. nested"),
+                ("quote", None, "> quote\n> > nested"),
+                ("code", None, "    code"),
+                ("code", "python", "```python\nfenced\n```"),
+                ("hr", None, "---"),
+                ("definition", ("ref", "/url", "Title"), '[ref]: /url "Title"'),
+                ("footnote", "1", "[^1]: A footnote"),
+            ]
+        )
+        self.assertEqual(
+            [(node.kind, doc.source(node)) for node in doc.children[2].walk()],
+            [
+                ("list", "- one\n- two\n    1. nested"),
+                ("item", "- one"), ("paragraph", "one"),
+                ("item", "- two\n    1. nested"), ("paragraph", "two"),
+                ("list", "1. nested"), ("item", "1. nested"), ("paragraph", "nested"),
+            ]
+        )
+
+        # the blocks that are rendered one at a time
+        self.assertEqual(
+            [doc.text[start:end] for start, end in doc.blocks],
+            [
+                "# Title", "Some *text* and <b>html</b>\n\n- one\n- two\n    1. nested",
+                '> quote\n> > nested\n\n    code\n\n```python\nfenced\n```\n\n---\n\n[ref]: /url "Title"\n[^1]: A footnote',
+            ]
+        )
+
+        html = md.render(doc)
+        expected = markdown2.Markdown(extras=extras).convert(text)
+        self.assertEqual(html, expected)
+        self.assertEqual(html.metadata, expected.metadata)
+        # the same document can be rendered with other options, including ones that
+        # split the text into other blocks
+        for options in ({"safe_mode": "escape"}, {"tab_width": 2}, {"extras": ["pyshell"]}):
+            options = {"extras": extras, **options}
+            self.assertEqual(
+                markdown2.Markdown(**options).render(doc), markdown2.Markdown(**options).convert(doc.text)
+            )
+    test_parse_and_render.tags = ["parse"]
+
 
 class DocTestsTestCase(unittest.TestCase):
     def test_api(self):
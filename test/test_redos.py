@@ -43,6 +43,12 @@ def issue_668():
     return 'a_b **x***y* c_d'
 
 
+def emphasis_across_span_tags():
+    # not a redos either, but each closer used to search the text after every opener for
+    # span tags, so it took quadratic time
+    return '*a <b>' * 8000 + '*'
+
+
 # whack everything in a dict for easy lookup later on
 CASES = {
     fn.__name__: (fn, extras)
@@ -54,6 +60,7 @@ CASES = {
         (issue493, None),
         (issue_633, None),
         (issue_668, ['code-friendly']),
+        (emphasis_across_span_tags, None),
     ]
 }
 